@@ -5,6 +5,16 @@ Write BAM file coverage info to a WIG file and BED file.
 Run with no arguments for usage info. The script requires pysam [1] and is
 partly inspired by [2].
 
+The coverage is written to standard output unless a file is given with -c,
+so it can be piped into coverage-wiggle-to-bed.py. The summary per region is
+only written if a file is given with -s. Output filenames ending in .gz are
+written gzipped.
+
+If BAM_FILE is - the BAM file is read from standard input, for example from
+'samtools view -b'. It must be sorted by position. Without an index there is
+no pileup, so coverage per reference is calculated from the aligned parts of
+the reads in one pass (no maximum depth), and -r cannot be used.
+
 Todo: Implement the window_size argument.
 Todo: Use default filenames for coverage_file and summary_file based on
       bam_file.
@@ -20,28 +30,56 @@ Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 from __future__ import division
 
 import os
+import sys
+from collections import defaultdict
 from contextlib import contextmanager
 from itertools import repeat
 
 import argparse
 import pysam
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import close_file, open_file
+import instrument
+
+
+# Reads not counted in the coverage (unmapped, secondary, QC failure, and
+# duplicate), as in the pileup
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# Flags of anomalous read pairs (paired but not in a proper pair), which are
+# not counted in the pileup either
+ANOMALOUS_FLAGS = 0x1, 0x1 | 0x2
 
-def main(bam_file, coverage_file, summary_file, regions_file=None,
+# Number of positions after which coverage from a stream is written
+COVERAGE_WINDOW = 100000
+
+
+def main(bam_file, coverage_file='-', summary_file=None, regions_file=None,
          split=False, window_size=1):
     #if not coverage_file:
     #    coverage_file = '%s.wig' % os.path.splitext(bam_file)[0]
-    with open(coverage_file, 'w') as coverage:
-        regions = write_coverage(bam_file, coverage, regions_file, split)
-    with open(summary_file, 'w') as summary:
+    instrument.add_input(bam_file)
+    instrument.add_output(coverage_file)
+    coverage = instrument.timed_writer(open_file(coverage_file, 'w'))
+    regions = write_coverage(bam_file, coverage, regions_file, split)
+    close_file(coverage_file, coverage)
+    if summary_file:
+        instrument.add_output(summary_file)
+        summary = instrument.timed_writer(open_file(summary_file, 'w'))
         write_summary(regions, summary)
+        close_file(summary_file, summary)
 
 
 @contextmanager
 def indexed_bam(bam_file):
-    if not os.path.exists(bam_file + '.bai'):
-        pysam.index(bam_file)
-    bam = pysam.Samfile(bam_file, 'rb')
+    if bam_file == '-':
+        bam = pysam.Samfile('-', 'rb')
+    else:
+        if not os.path.exists(bam_file + '.bai'):
+            pysam.index(bam_file)
+        bam = pysam.Samfile(bam_file, 'rb')
     yield bam
     bam.close()
 
@@ -55,11 +93,26 @@ def read_regions(regions_file):
             yield name, int(start), int(end)
 
 
-def write_coverage(bam_file, coverage, regions_file=None, split=False):
+def write_track(bam_file, coverage):
+    name = 'stdin' if bam_file == '-' else bam_file
     coverage.write('track %s\n' % ' '.join(['type=wiggle_0',
-        'name=%s' % os.path.splitext(os.path.split(bam_file)[-1])[0],
+        'name=%s' % os.path.splitext(os.path.split(name)[-1])[0],
         'visibility=full']))
+
+
+def write_coverage(bam_file, coverage, regions_file=None, split=False):
+    write_track(bam_file, coverage)
     with indexed_bam(bam_file) as bam:
+        if bam_file == '-':
+            counter = CoverageCounter(bam.references, bam.lengths, coverage,
+                                      split)
+            try:
+                for read in instrument.timed(bam, 'pysam'):
+                    counter.add(read)
+            except ValueError as error:
+                print >>sys.stderr, error
+                sys.exit(1)
+            return counter.finish()
         regions = []
         if regions_file is not None:
             guide = read_regions(regions_file)
@@ -69,7 +122,8 @@ def write_coverage(bam_file, coverage, regions_file=None, split=False):
             if not regions or name != regions[-1][0]:
                 coverage.write('variableStep chrom=%s\n' % name)
             summed_coverage = 0
-            for column in bam.pileup(name, start, end):
+            for column in instrument.timed(bam.pileup(name, start, end),
+                                           'pysam'):
                 if start <= column.pos < end:
                     if split:
                         n = sum(1 for r in column.pileups if not r.is_del)
@@ -82,6 +136,95 @@ def write_coverage(bam_file, coverage, regions_file=None, split=False):
     return regions
 
 
+class CoverageCounter(object):
+    """
+    Coverage per position from reads sorted by position, without pileup
+    (and thus without index). Each read adds one at the start and subtracts
+    one at the end of its aligned span (or of each aligned block if {split}
+    is True) in a sparse difference array, from which the coverage is
+    written to the open file {coverage} in WIG format as soon as the reads
+    have passed a position.
+    """
+    def __init__(self, references, lengths, coverage, split=False):
+        self.references = references
+        self.lengths = lengths
+        self.coverage = coverage
+        self.split = split
+        self.regions = []
+        self.tid = -1
+        self.changes = defaultdict(int)
+        self.position = self.written = self.depth = self.summed = 0
+
+    def add(self, read):
+        """
+        Add the coverage of {read}.
+        """
+        if read.flag & SKIP_FLAGS or \
+               read.flag & ANOMALOUS_FLAGS[1] == ANOMALOUS_FLAGS[0]:
+            return
+        if read.tid != self.tid:
+            if read.tid < self.tid:
+                raise ValueError('BAM file is not sorted by position: %s'
+                                 % read.qname)
+            while self.tid < read.tid:
+                self.next_reference()
+        elif read.pos < self.position:
+            raise ValueError('BAM file is not sorted by position: %s'
+                             % read.qname)
+        if read.pos >= self.position + COVERAGE_WINDOW:
+            self.write(read.pos)
+        changes = self.changes
+        for start, end in read.blocks if self.split \
+                else [(read.pos, read.aend)]:
+            changes[start] += 1
+            changes[end] -= 1
+
+    def next_reference(self):
+        """
+        Write the coverage of the current reference and start the next one.
+        """
+        if self.tid >= 0:
+            self.write(self.lengths[self.tid])
+            self.regions.append( (self.references[self.tid], 0,
+                                  self.lengths[self.tid], self.summed) )
+        self.tid += 1
+        self.changes.clear()
+        self.position = self.written = self.depth = self.summed = 0
+        if self.tid < len(self.references):
+            self.coverage.write('variableStep chrom=%s\n'
+                                % self.references[self.tid])
+
+    def write(self, end):
+        """
+        Write the coverage for the positions up to {end}, which no read
+        starting at or after {end} can change.
+        """
+        write = self.coverage.write
+        depth = self.depth
+        position = self.written
+        for change in sorted(p for p in self.changes if p < end) + [end]:
+            if depth > 0 and change > position:
+                value = ' %.1f\n' % depth
+                write(''.join('%d%s' % (p + 1, value)
+                              for p in xrange(position, change)))
+                self.summed += depth * (change - position)
+            if change < end:
+                depth += self.changes.pop(change)
+            position = change
+        self.depth = depth
+        self.written = self.position = end
+
+    def finish(self):
+        """
+        Write the coverage of the remaining references and return a list of
+        regions as tuples (name, start, end, summed coverage), one for every
+        reference.
+        """
+        while self.tid < len(self.references):
+            self.next_reference()
+        return self.regions
+
+
 def write_summary(regions, summary):
     for name, start, end, coverage in regions:
         summary.write('%s\t%i\t%i\t-\t%i\n' % (name, start, end, coverage))
@@ -92,9 +235,10 @@ if __name__ == '__main__':
     group = parser.add_argument_group()
     group.add_argument('bam_file', metavar='BAM_FILE',
                        help='file in BAM format to determine coverage for')
-    group.add_argument('-c', dest='coverage_file', required=True,
-                       help='write coverage in WIG format')
-    group.add_argument('-s', dest='summary_file', required=True,
+    group.add_argument('-c', dest='coverage_file', default='-',
+                       help='write coverage in WIG format (default: standard '
+                       'output)')
+    group.add_argument('-s', dest='summary_file',
                        help='write coverage per region in BED format')
     parser.add_argument('-r', dest='regions_file',
                         help='regions to calculate coverage for in BED format')
@@ -103,6 +247,12 @@ if __name__ == '__main__':
                         'intervals')
     parser.add_argument('-w', dest='window_size', default=1, type=int,
                         help='window size for COVERAGE_FILE (default: 1)')
+    instrument.add_arguments(parser)
     args = parser.parse_args()
-    main(args.bam_file, args.coverage_file, args.summary_file,
-         args.regions_file, args.split, args.window_size)
+    if args.bam_file == '-' and args.regions_file:
+        parser.error('regions cannot be used with standard input')
+    if args.coverage_file == '-' and args.summary_file == '-':
+        parser.error('only one output can be written to standard output')
+    instrument.configure(args)
+    instrument.run(main, args.bam_file, args.coverage_file, args.summary_file,
+                   args.regions_file, args.split, args.window_size)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""
+Calculate coverage, count read directions and flags, and extract paired end
+reads from a BAM file in one pass.
+
+Running bam_coverage.py, read-directions.py, and bam_to_fastq.py on the same
+BAM file decompresses and decodes every read three times. This script reads
+the BAM file once and hands every read to the consumers for the outputs that
+are given:
+
+  -c, -s  Coverage in WIG format and summed coverage per reference in BED
+          format, as written by bam_coverage.py for a BAM file read from
+          standard input (calculated from the aligned parts of the reads,
+          without pileup).
+  -d      The number of reads not mapped in a proper pair, and forward and
+          reverse among them, as reported by read-directions.py, followed by
+          the number of reads per flag.
+  -1, -2  Paired end reads in FASTQ format, as written by bam_to_fastq.py.
+
+Output filenames ending in .gz are written gzipped, and an output filename
+of - is standard output. If BAM_FILE is - the BAM file is read from standard
+input. The BAM file is decompressed by THREADS additional threads (using the
+multi-threaded BGZF reader of pysam [1]).
+
+For coverage, the BAM file must be sorted by position. The reads are then
+not sorted by name, so mates are paired by keeping the FASTQ record of the
+first mate seen until its other mate is read. Pairs are written when their
+second mate is read, and remaining reads without a mate are written at the
+end (unless --sync-pairs is given). Secondary and supplementary alignments
+are not written. A read duplicated (by name) before its mate is read
+replaces the earlier copy, but a pair duplicated after it was written (as
+from 'samtools merge' of overlapping files) is written again.
+Memory use grows with the number of pairs whose mates are far apart (e.g.,
+on different references).
+
+Run with no arguments for usage info. The script requires pysam [1].
+
+[1] http://code.google.com/p/pysam/
+
+Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+"""
+
+
+from __future__ import division
+
+import os
+import sys
+from collections import defaultdict
+
+import argparse
+import pysam
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for directory in 'lib', 'bam-coverage', 'bam-to-fastq':
+    sys.path.insert(0, os.path.join(ROOT, directory))
+from formats import open_file
+from bam_coverage import CoverageCounter, write_summary, write_track
+from bam_to_fastq import format_read
+import instrument
+
+
+# Number of additional threads decompressing the BAM file
+THREADS = 2
+
+# Alignments not written to FASTQ (secondary and supplementary)
+SKIP_FASTQ_FLAGS = 0x100 | 0x800
+
+# Flags counted with -d, in order of reporting
+FLAGS = [(0x1, 'Paired'),
+         (0x2, 'Proper pair'),
+         (0x4, 'Unmapped'),
+         (0x8, 'Mate unmapped'),
+         (0x10, 'Reverse'),
+         (0x40, 'First in pair'),
+         (0x80, 'Second in pair'),
+         (0x100, 'Secondary'),
+         (0x200, 'QC failure'),
+         (0x400, 'Duplicate'),
+         (0x800, 'Supplementary')]
+
+
+def main(bam_file, coverage_file=None, summary_file=None,
+         directions_file=None, left_file=None, right_file=None, split=False,
+         sync_pairs=False, threads=THREADS):
+    """
+    Read {bam_file} once and write the given outputs.
+    """
+    instrument.add_input(bam_file)
+    try:
+        bam = pysam.Samfile(bam_file, 'rb', threads=threads)
+    except (IOError, ValueError):
+        print >>sys.stderr, 'Could not read BAM file: %s' % bam_file
+        sys.exit(1)
+
+    outputs = []
+    consumers = []
+
+    if coverage_file or summary_file:
+        coverage = open_output(coverage_file or os.devnull, outputs)
+        write_track(bam_file, coverage)
+        counter = CoverageCounter(bam.references, bam.lengths, coverage,
+                                  split)
+        consumers.append( ('coverage', counter) )
+
+    if directions_file:
+        directions = DirectionCounter()
+        consumers.append( ('directions', directions) )
+
+    if left_file:
+        pairer = FastqPairer(open_output(left_file, outputs),
+                             open_output(right_file, outputs), sync_pairs)
+        consumers.append( ('fastq', pairer) )
+
+    adds = [timed_add(consumer.add, name) for name, consumer in consumers]
+
+    try:
+        for read in instrument.timed(bam, 'pysam'):
+            for add in adds:
+                add(read)
+    except ValueError as error:
+        print >>sys.stderr, error
+        sys.exit(1)
+    bam.close()
+
+    if coverage_file or summary_file:
+        regions = counter.finish()
+        if summary_file:
+            write_summary(regions, open_output(summary_file, outputs))
+
+    if directions_file:
+        directions.write(open_output(directions_file, outputs), bam_file)
+
+    if left_file:
+        pairer.finish()
+
+    for filename, output in outputs:
+        if filename != '-':
+            output.close()
+
+
+def open_output(filename, outputs):
+    """
+    Open {filename} for writing (timed with --stats) and add it to the list
+    {outputs} as tuple (filename, file) to be closed when done.
+    """
+    instrument.add_output(filename)
+    try:
+        output = instrument.timed_writer(open_file(filename, 'w'))
+    except IOError as (_, message):
+        print >>sys.stderr, 'Could not write output file: %s' % filename
+        sys.exit(1)
+    outputs.append( (filename, output) )
+    return output
+
+
+def timed_add(add, phase):
+    """
+    Return {add}, timed as {phase} if statistics are enabled.
+    """
+    if not instrument.enabled():
+        return add
+    def add_timed(read):
+        instrument.begin(phase)
+        try:
+            add(read)
+        finally:
+            instrument.end()
+    return add_timed
+
+
+class DirectionCounter(object):
+    """
+    Count the number of reads per flag value, from which the read directions
+    and the number of reads per flag are calculated when done. Only reads
+    with a reference are counted for the directions, as in read-directions.py
+    for an indexed BAM file.
+    """
+    def __init__(self):
+        self.flags = defaultdict(int)
+        self.placed = defaultdict(int)
+
+    def add(self, read):
+        """
+        Count {read}.
+        """
+        if read.tid >= 0:
+            self.placed[read.flag] += 1
+        else:
+            self.flags[read.flag] += 1
+
+    def write(self, report, description):
+        """
+        Write the counts to the open file {report}.
+        """
+        total = sum(self.placed.values())
+        forward = sum(count for flag, count in self.placed.items()
+                      if not flag & 0x2 and not flag & 0x10)
+        reverse = sum(count for flag, count in self.placed.items()
+                      if not flag & 0x2 and flag & 0x10)
+        both = forward + reverse
+        report.write('%s\n' % description)
+        report.write('Unpaired: %9d (%6.3f%%)\n'
+                     % (both, percentage(both, total)))
+        report.write('Forward:  %9d (%6.3f%%)\n'
+                     % (forward, percentage(forward, both)))
+        report.write('Reverse:  %9d (%6.3f%%)\n'
+                     % (reverse, percentage(reverse, both)))
+        report.write('\n')
+
+        flags = defaultdict(int, self.flags)
+        for flag, count in self.placed.items():
+            flags[flag] += count
+        reads = sum(flags.values())
+        report.write('Reads:          %9d\n' % reads)
+        for bit, name in FLAGS:
+            count = sum(n for flag, n in flags.items() if flag & bit)
+            report.write('%-15s %9d (%6.3f%%)\n'
+                         % (name + ':', count, percentage(count, reads)))
+
+
+def percentage(count, total):
+    """
+    Return {count} as percentage of {total}, or 0 if {total} is 0.
+    """
+    if not total:
+        return 0
+    return count / total * 100
+
+
+class FastqPairer(object):
+    """
+    Write reads in any order in pairs to the open FASTQ files {left} and
+    {right}. The FASTQ record of a read is kept until its mate is read.
+    """
+    def __init__(self, left, right, sync_pairs=False):
+        self.left = left
+        self.right = right
+        self.sync_pairs = sync_pairs
+        self.pending = {}
+
+    def add(self, read):
+        """
+        Add {read}, writing its pair if its mate was already read.
+        """
+        if read.flag & SKIP_FASTQ_FLAGS:
+            return
+        name = read.qname
+        is_left = read.is_read1
+        mate = self.pending.pop(name, None)
+        if mate is None or mate[0] == is_left:
+            # A duplicate of the same side replaces the pending read.
+            self.pending[name] = is_left, format_read(read)
+        elif is_left:
+            self.left.write(format_read(read))
+            self.right.write(mate[1])
+        else:
+            self.left.write(mate[1])
+            self.right.write(format_read(read))
+
+    def finish(self):
+        """
+        Write the reads without a mate, sorted by name.
+        """
+        if not self.sync_pairs:
+            for name in sorted(self.pending):
+                is_left, record = self.pending[name]
+                if is_left:
+                    self.left.write(record)
+                else:
+                    self.right.write(record)
+        self.pending.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__.split('\n\n')[0])
+    group = parser.add_argument_group()
+    group.add_argument('bam_file', metavar='BAM_FILE',
+                       help='file in BAM format to read')
+    group.add_argument('-c', dest='coverage_file',
+                       help='write coverage in WIG format')
+    group.add_argument('-s', dest='summary_file',
+                       help='write coverage per reference in BED format')
+    group.add_argument('-d', dest='directions_file',
+                       help='write read directions and counts per flag')
+    group.add_argument('-1', dest='left_file', help='file in FASTQ format to'
+                       ' write left paired reads to')
+    group.add_argument('-2', dest='right_file', help='file in FASTQ format to'
+                       ' write right paired reads to')
+    parser.add_argument('-p', '--split', dest='split', action='store_true',
+                        help='treat split reads as distinct coverage '
+                        'intervals')
+    parser.add_argument('--sync-pairs', dest='sync_pairs',
+                        action='store_true', help='synchronize paired end '
+                        'reads')
+    parser.add_argument('-t', dest='threads', default=THREADS, type=int,
+                        help='number of additional threads decompressing '
+                        'the BAM file (default: %d)' % THREADS)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    outputs = [args.coverage_file, args.summary_file, args.directions_file,
+               args.left_file, args.right_file]
+    if not any(outputs):
+        parser.error('at least one of -c, -s, -d, -1 and -2 is required')
+    if bool(args.left_file) != bool(args.right_file):
+        parser.error('-1 and -2 must be given together')
+    if outputs.count('-') > 1:
+        parser.error('only one output can be written to standard output')
+    instrument.configure(args)
+    instrument.run(main, args.bam_file, args.coverage_file,
+                   args.summary_file, args.directions_file, args.left_file,
+                   args.right_file, args.split, args.sync_pairs, args.threads)
@@ -11,6 +11,11 @@ file is assumed to be sorted by read name.
 Quality scores are written as-is from the BAM file, thus in Sanger (Phred+33)
 ASCII representations.
 
+The BAM file is read from standard input if BAM_FILE is -, for example from
+'samtools sort -n -o'. A FASTQ file is written to standard output if its
+filename is -. If both are -, the pairs are written interleaved. Filenames
+ending in .gz are written gzipped.
+
 
 Run with no arguments for usage info. The script requires pysam [1].
 
@@ -25,10 +30,16 @@ Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 
 
 import os
+import sys
 
 import argparse
 import pysam
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import close_file, open_file
+import instrument
+
 
 # DNA base complements
 COMPLEMENT = {'A': 'T',
@@ -43,14 +54,22 @@ def main(bam_file, left_file=None, right_file=None, sync_pairs=False):
     Open involved files and write BAM reads to FASTQ files.
     """
     name, _ = os.path.splitext(bam_file)
+    if bam_file == '-' and not (left_file and right_file):
+        print 'Output files are required when reading from standard input.'
+        sys.exit(1)
     if not left_file:
         left_file = name + '_1.fq'
     if not right_file:
         right_file = name + '_2.fq'
+    instrument.add_input(bam_file)
+    instrument.add_output(left_file)
+    instrument.add_output(right_file)
     with pysam.Samfile(bam_file, 'rb') as bam:
-        with open(left_file, 'w') as left:
-            with open(right_file, 'w') as right:
-                process_bam(bam, left, right, sync_pairs)
+        left = instrument.timed_writer(open_file(left_file, 'w'))
+        right = instrument.timed_writer(open_file(right_file, 'w'))
+        process_bam(bam, left, right, sync_pairs)
+        close_file(left_file, left)
+        close_file(right_file, right)
 
 
 def process_bam(bam, left, right, sync_pairs=False):
@@ -59,7 +78,7 @@ def process_bam(bam, left, right, sync_pairs=False):
     files. Duplicate reads (by name) are only written once.
     """
     name = read_left = read_right = None
-    for read in bam:
+    for read in instrument.timed(bam, 'pysam'):
         if name is not None and read.qname != name:
             if read_left and (not sync_pairs or read_right):
                 write_read(left, read_left)
@@ -81,6 +100,13 @@ def write_read(fastq, read):
     """
     Write read to open FASTQ file.
     """
+    fastq.write(format_read(read))
+
+
+def format_read(read):
+    """
+    Return read as FASTQ record.
+    """
     info = {'index': int(not read.is_read1) + 1,
             'name':  read.qname}
     if read.is_reverse:
@@ -89,7 +115,7 @@ def write_read(fastq, read):
     else:
         info.update({'quality':  read.qual,
                      'sequence': read.seq})
-    fastq.write('@{name}/{index}\n{sequence}\n+\n{quality}\n'.format(**info))
+    return '@{name}/{index}\n{sequence}\n+\n{quality}\n'.format(**info)
 
 
 def reverse_complement(sequence):
@@ -112,5 +138,8 @@ if __name__ == '__main__':
                        ' write right paired reads to (default: BAM_FILE_2.fq')
     group.add_argument('-s', '--sync-pairs', dest='sync_pairs',
                        action='store_true', help='synchronize paired end reads')
+    instrument.add_arguments(parser)
     args = parser.parse_args()
-    main(args.bam_file, args.left_file, args.right_file, args.sync_pairs)
+    instrument.configure(args)
+    instrument.run(main, args.bam_file, args.left_file, args.right_file,
+                   args.sync_pairs)
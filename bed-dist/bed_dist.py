@@ -1,95 +1,389 @@
 #!/usr/bin/env python
 
-# From a BED file [1], calculate number of regions per chromosome and
-# the mean of their lengths.
+# From BED files [1], calculate number of regions per chromosome and the
+# distribution of their lengths.
 #
 # Usage:
-#   ./bed_dist.py sample.bed
+#   ./bed_dist.py [-f] [-j processes] sample.bed [sample2.bed.gz] ...
+#
+# Reported per chromosome are the number of regions, the minimum, maximum,
+# mean, and median length, the N50 length, some quantiles of the length
+# (nearest-rank), and the total number of bases in the regions. If more than
+# one BED file is given, they are reported separately and in total.
+#
+# Region lengths are counted in a histogram per chromosome, so memory use
+# does not depend on the number of regions and histograms of several files
+# can be merged. With -j, BED files are read in parallel by that many worker
+# processes. Files compressed with gzip are detected automatically. A BED file
+# is read from standard input if its filename is - (not with -j).
+#
+# With -f, the footprint of the regions is reported instead: per chromosome
+# the number of regions, the number of regions after merging overlapping and
+# adjacent regions, the number of distinct bases covered, the number of
+# bases covered more than once, and a histogram of the number of bases per
+# overlap depth. This is calculated with NumPy [2] on all region starts and
+# ends at once, which are also read from the BED files in bulk.
 #
 # [1] http://genome.ucsc.edu/FAQ/FAQformat.html#format1
+# [2] http://numpy.scipy.org/
 #
-# Todo: Plot length distribution (or do more efficient calculation for the
-#       current simple numbers).
+# Todo: Plot length distribution.
 #
 # Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
 # Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 
 
 from __future__ import division
+import os
 import sys
+import math
+import multiprocessing
 from collections import defaultdict
 
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import open_file, parse_bed, read_blocks
+
+
+# Quantiles of the region lengths to report
+QUANTILES = [0.05, 0.25, 0.75, 0.95]
+
+# First fields of BED lines without a region
+SKIP_BED_LINES = ('track', 'browser', '#')
+
 
 def region_counts(bed_file):
     """
-    Count.
-
-    Todo: This can be done much more efficiently for the simple numbers we
-          are currently printing.
+    Count the number of regions per length per chromosome.
     """
     counts = defaultdict(lambda: defaultdict(int))
-    regions = open(bed_file, 'r')
 
-    while True:
-        line = regions.readline()
-        if not line:
-            break
-        parts = line.split()
-        if len(parts) < 1 or parts[0] == 'track':
-            continue
-        try:
-            chromosome = parts[0]
-            start = int(parts[1])
-            end = int(parts[2])
-        except (IndexError, ValueError):
-            print 'Invalid line in BED file: "%s"' % line
-            sys.exit(1)
-        counts[chromosome][end - start] += 1
+    try:
+        regions = open_file(bed_file)
+    except IOError as (_, message):
+        print 'Could not read BED file: %s' % bed_file
+        sys.exit(1)
 
+    try:
+        for block in read_blocks(regions):
+            for chromosome, start, end, _ in parse_bed(block):
+                counts[chromosome][end - start] += 1
+    except ValueError as error:
+        print error
+        sys.exit(1)
+
+    regions.close()
+
+    # Plain dictionaries can be pickled and returned from worker processes.
+    return dict((chromosome, dict(chromosome_counts))
+                for chromosome, chromosome_counts in counts.items())
+
+
+def merge_counts(counts, other):
+    """
+    Add the region counts in {other} to {counts}.
+    """
+    for chromosome, other_counts in other.items():
+        chromosome_counts = counts.setdefault(chromosome, {})
+        for length, count in other_counts.items():
+            chromosome_counts[length] = chromosome_counts.get(length, 0) + count
     return counts
 
 
-def main(file):
+def length_statistics(chromosome_counts):
     """
-    Print region counts for each chromosome and totals.
+    Calculate statistics from a histogram of region lengths. Return a list
+    of the number of regions, minimum, maximum, mean, median, and N50 length,
+    the quantiles in QUANTILES, and the total number of bases.
     """
-    counts = region_counts(file)
+    lengths = sorted(chromosome_counts)
+    total = sum(chromosome_counts.values())
+    summed = sum(l * chromosome_counts[l] for l in lengths)
 
-    file_total = 0
-    file_minimum = 4000000000
-    file_maximum = 0
-    file_summed = 0
+    # Nearest-rank quantiles from the cumulative counts.
+    ranks = [max(1, int(math.ceil(q * total - 1e-9)))
+             for q in [0.5] + QUANTILES]
+    quantiles = []
+    seen = 0
+    for length in lengths:
+        seen += chromosome_counts[length]
+        while len(quantiles) < len(ranks) and ranks[len(quantiles)] <= seen:
+            quantiles.append(length)
 
-    print 'Chromosome\tRegions\tMinimum length\tMaximum length\tMean length'
+    # The N50 is the length such that regions at least that long cover at
+    # least half of the bases.
+    n50 = 0
+    covered = 0
+    for length in reversed(lengths):
+        covered += length * chromosome_counts[length]
+        if covered * 2 >= summed:
+            n50 = length
+            break
 
-    for chromosome, chromosome_counts in counts.items():
-        lengths = chromosome_counts.keys()
-        lengths.sort()
-        total = sum(chromosome_counts.values())
-        minimum = lengths[0]
-        maximum = lengths[-1]
-        summed = sum((l * chromosome_counts[l] for l in lengths))
+    return ([total, lengths[0], lengths[-1], summed / total, quantiles[0],
+             n50] + quantiles[1:] + [summed])
 
-        print '\t'.join(map(str, [chromosome, total, minimum, maximum,
-                                  summed / total]))
 
-        file_total += total
-        file_minimum = min(minimum, file_minimum)
-        file_maximum = max(maximum, file_maximum)
-        file_summed += summed
+def print_counts(counts):
+    """
+    Print region statistics for each chromosome and totals.
+    """
+    print '\t'.join(['Chromosome', 'Regions', 'Minimum length',
+                     'Maximum length', 'Mean length', 'Median length',
+                     'N50 length'] +
+                    ['%g%% length' % (q * 100) for q in QUANTILES] +
+                    ['Total bases'])
 
-    print '\t'.join(map(str, ['Total', file_total, file_minimum, file_maximum,
-                              file_summed / file_total]))
+    total_counts = {}
 
+    for chromosome in sorted(counts):
+        print '\t'.join(map(str, [chromosome] +
+                            length_statistics(counts[chromosome])))
+        merge_counts(total_counts, {'Total': counts[chromosome]})
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print """From a BED file [1], calculate number of regions per chromosome and
-the mean of their lengths.
+    if total_counts:
+        print '\t'.join(map(str, ['Total'] +
+                            length_statistics(total_counts['Total'])))
+
+
+def read_intervals(bed_file):
+    """
+    Read region starts and ends per chromosome as NumPy arrays. Return a
+    dictionary with per chromosome a tuple (starts, ends).
+    """
+    starts = defaultdict(list)
+    ends = defaultdict(list)
+
+    try:
+        regions = open_file(bed_file)
+    except IOError as (_, message):
+        print 'Could not read BED file: %s' % bed_file
+        sys.exit(1)
+
+    try:
+        for block in read_blocks(regions):
+            for chromosome, block_starts, block_ends in parse_intervals(block):
+                starts[chromosome].append(block_starts)
+                ends[chromosome].append(block_ends)
+    except ValueError as error:
+        print error
+        sys.exit(1)
+
+    regions.close()
+
+    return dict((chromosome,
+                 (numpy.concatenate(starts[chromosome]),
+                  numpy.concatenate(ends[chromosome])))
+                for chromosome in starts)
+
+
+def parse_intervals(lines):
+    """
+    Generate the regions in BED {lines} per chromosome as tuples (chromosome,
+    starts, ends), with starts and ends as NumPy arrays.
+
+    The first three fields of the lines are joined into one string, which
+    is split into tokens at once. The start and end tokens are checked to be
+    digits and converted by NumPy all at once. If that fails, the lines are
+    read with parse_bed, which reports the first line it cannot interpret.
+    """
+    # Keeping a list of fields per line would make the garbage collector
+    # run over all of them again and again.
+    fields = filter(None, ['\t'.join(line.split(None, 3)[:3])
+                           for line in lines
+                           if not line.startswith(SKIP_BED_LINES)])
+    if not fields:
+        return
+
+    tokens = '\n'.join(fields).split()
+    chromosomes = tokens[0::3]
+    positions = tokens[1::3] + tokens[2::3]
+
+    try:
+        if len(tokens) != 3 * len(fields) or \
+               not ''.join(positions).isdigit():
+            raise ValueError
+        positions = numpy.fromstring(' '.join(positions), dtype=numpy.int64,
+                                     sep=' ')
+    except ValueError:
+        records = list(parse_bed(lines))
+        chromosomes = [record.chrom for record in records]
+        positions = numpy.array([record.start for record in records] +
+                                [record.end for record in records],
+                                dtype=numpy.int64)
+
+    starts, ends = positions[:len(chromosomes)], positions[len(chromosomes):]
+
+    # Blocks of sorted BED files are mostly on one chromosome.
+    if chromosomes.count(chromosomes[0]) == len(chromosomes):
+        yield chromosomes[0], starts, ends
+        return
+    names, indices = numpy.unique(chromosomes, return_inverse=True)
+    for index, name in enumerate(names):
+        selected = indices == index
+        yield str(name), starts[selected], ends[selected]
 
-Usage:
-  ./bed_dist.py sample.bed
 
-[1] http://genome.ucsc.edu/FAQ/FAQformat.html#format1""".format(command=sys.argv[0])
+def footprint(starts, ends):
+    """
+    Calculate the footprint of regions with the given starts and ends (NumPy
+    arrays). Return a tuple (regions, merged, covered, depths), where merged
+    is the number of regions after merging overlapping and adjacent regions,
+    covered is the number of distinct bases covered, and depths is a NumPy
+    array with at index i the number of bases covered i times.
+
+    All region starts and ends are sorted at once as events, after which the
+    depth along the chromosome is their cumulative sum.
+    """
+    regions = len(starts)
+    nonempty = ends > starts
+    starts, ends = starts[nonempty], ends[nonempty]
+
+    if not len(starts):
+        return regions, 0, 0, numpy.zeros(1, dtype=numpy.int64)
+
+    positions = numpy.concatenate((starts, ends))
+    changes = numpy.concatenate((numpy.ones(len(starts), dtype=numpy.int64),
+                                 -numpy.ones(len(ends), dtype=numpy.int64)))
+
+    # At equal positions, starts go before ends so adjacent regions merge.
+    order = numpy.lexsort((-changes, positions))
+    positions = positions[order]
+    depth = numpy.cumsum(changes[order])
+
+    depths = numpy.bincount(depth[:-1], weights=numpy.diff(positions))
+    # Starts before ends at equal positions give zero width depth bins.
+    depths = numpy.trim_zeros(depths.astype(numpy.int64), 'b')
+    merged = numpy.count_nonzero(depth[:-1] == 0) + 1
+
+    return regions, merged, int(depths[1:].sum()), depths
+
+
+def footprint_counts(bed_file):
+    """
+    Calculate the footprint per chromosome of the regions in {bed_file}.
+    """
+    return dict((chromosome, footprint(starts, ends)) for chromosome,
+                (starts, ends) in read_intervals(bed_file).items())
+
+
+def print_footprint(footprints):
+    """
+    Print region footprint for each chromosome and totals.
+    """
+    print '\t'.join(['Chromosome', 'Regions', 'Merged regions',
+                     'Covered bases', 'Overlapping bases', 'Maximum depth',
+                     'Bases per depth'])
+
+    def print_row(chromosome, regions, merged, covered, depths):
+        print '\t'.join(map(str, [chromosome, regions, merged, covered,
+                                  depths[2:].sum(), len(depths) - 1,
+                                  ','.join('%d:%d' % (d, n) for d, n
+                                           in enumerate(depths) if d and n)]))
+
+    total_regions = total_merged = total_covered = 0
+    total_depths = numpy.zeros(1, dtype=numpy.int64)
+
+    for chromosome in sorted(footprints):
+        regions, merged, covered, depths = footprints[chromosome]
+        print_row(chromosome, regions, merged, covered, depths)
+        total_regions += regions
+        total_merged += merged
+        total_covered += covered
+        if len(depths) > len(total_depths):
+            total_depths = numpy.concatenate(
+                (total_depths, numpy.zeros(len(depths) - len(total_depths),
+                                           dtype=numpy.int64)))
+        total_depths[:len(depths)] += depths
+
+    if footprints:
+        print_row('Total', total_regions, total_merged, total_covered,
+                  total_depths)
+
+
+def count_file(bed_file):
+    """
+    Count regions in {bed_file} in a worker process.
+    """
+    try:
+        return region_counts(bed_file)
+    except SystemExit:
+        # The error is already reported, but the pool would not notice the
+        # worker exiting.
+        raise RuntimeError('Could not count regions in worker.')
+
+
+def footprint_file(bed_file):
+    """
+    Calculate the footprint of regions in {bed_file} in a worker process.
+    """
+    try:
+        return footprint_counts(bed_file)
+    except SystemExit:
+        raise RuntimeError('Could not calculate footprint in worker.')
+
+
+def main(files, processes=1, footprints=False):
+    """
+    Print region statistics for each file and in total.
+
+    If {footprints} is True, print the region footprint for each file
+    instead.
+    """
+    if footprints:
+        reduce_file, worker = footprint_counts, footprint_file
+    else:
+        reduce_file, worker = region_counts, count_file
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        file_counts = pool.imap(worker, files)
+    else:
+        file_counts = (reduce_file(file) for file in files)
+
+    total_counts = {}
+
+    try:
+        for file, counts in zip(files, file_counts):
+            if len(files) > 1:
+                print file
+            if footprints:
+                print_footprint(counts)
+            else:
+                print_counts(counts)
+                merge_counts(total_counts, counts)
+            if len(files) > 1:
+                print
+    except RuntimeError:
+        pool.terminate()
         sys.exit(1)
-    main(sys.argv[1])
+
+    # Footprints cannot be summed over files.
+    if len(files) > 1 and not footprints:
+        print 'In total over %d files' % len(files)
+        print_counts(total_counts)
+
+    if processes > 1:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='From BED files, calculate '
+                                     'number of regions per chromosome and '
+                                     'the distribution of their lengths.')
+    parser.add_argument('files', metavar='BED_FILE', nargs='+',
+                        help='file in BED format (can be gzipped)')
+    parser.add_argument('-j', dest='processes', default=1, type=int,
+                        help='number of files to read in parallel '
+                        '(default: 1)')
+    parser.add_argument('-f', '--footprint', dest='footprints',
+                        action='store_true', help='report footprint of the '
+                        'regions instead of their length distribution')
+    args = parser.parse_args()
+    if '-' in args.files and args.processes > 1:
+        parser.error('standard input cannot be read by worker processes')
+    main(args.files, args.processes, args.footprints)
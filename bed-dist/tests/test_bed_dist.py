@@ -0,0 +1,82 @@
+"""
+Tests for bed_dist.py.
+
+Run from this directory with:
+
+  python -m unittest discover
+
+Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+"""
+
+
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import bed_dist
+
+
+class TestFootprint(unittest.TestCase):
+    """
+    Calculate the footprint of regions.
+    """
+    def footprint(self, regions):
+        starts = numpy.array([start for start, _ in regions], dtype='l')
+        ends = numpy.array([end for _, end in regions], dtype='l')
+        return bed_dist.footprint(starts, ends)
+
+    def test_overlapping(self):
+        regions, merged, covered, depths = self.footprint([(0, 10), (5, 15)])
+        self.assertEqual((regions, merged, covered), (2, 1, 15))
+        self.assertEqual(list(depths), [0, 10, 5])
+
+    def test_touching(self):
+        regions, merged, covered, depths = self.footprint(
+            [(0, 10), (10, 20), (5, 15), (30, 31)])
+        self.assertEqual((regions, merged, covered), (4, 2, 21))
+        self.assertEqual(list(depths), [10, 11, 10])
+
+    def test_print_touching(self):
+        footprints = {'chr1': self.footprint([(0, 10), (10, 20), (5, 15),
+                                              (30, 31)]),
+                      'chr2': self.footprint([(0, 5), (5, 10)])}
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            bed_dist.print_footprint(footprints)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        rows = [line.split('\t') for line in output.splitlines()[1:]]
+        self.assertEqual(rows[0][4:], ['10', '2', '1:11,2:10'])
+        self.assertEqual(rows[1][4:], ['0', '1', '1:10'])
+        self.assertEqual(rows[2][4:], ['10', '2', '1:21,2:10'])
+
+
+class TestParseIntervals(unittest.TestCase):
+    """
+    Read region starts and ends from BED lines in bulk.
+    """
+    def parse(self, lines):
+        return dict((chromosome, (list(starts), list(ends)))
+                    for chromosome, starts, ends
+                    in bed_dist.parse_intervals(lines))
+
+    def test_chromosomes(self):
+        intervals = self.parse(['track name=regions\n', '# comment\n',
+                                'chr2\t5\t9\n', '\n',
+                                'chr1\t0\t10\tname\t0\t+\n',
+                                'chr1 10 20\n'])
+        self.assertEqual(intervals, {'chr1': ([0, 10], [10, 20]),
+                                     'chr2': ([5], [9])})
+
+    def test_invalid(self):
+        for line in 'chr1\t5\t3a\n', 'chr1\t5\n':
+            self.assertRaises(ValueError, self.parse, ['chr1\t0\t1\n', line])
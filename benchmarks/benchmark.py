@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+Run the scripts in this repository on synthetic input files and report their
+throughput and memory use.
+
+The input files are created with generate.py. Every benchmark runs a script
+in a separate process and measures its elapsed time and its peak resident
+set size (including any worker processes it waits for). Reported are the
+number of input records per second, the number of input megabytes per
+second, and the peak RSS in megabytes. The fastest of several runs is used.
+
+Results can be stored as baseline (with --save) in a JSON file. On later
+runs, each result is compared to the baseline and a benchmark is flagged as
+regression if its records per second dropped or its peak RSS increased by
+more than TOLERANCE. The exit status is 1 if any benchmark regressed or
+failed. Baselines are only meaningful on the same machine and for input
+files generated at the same scale.
+
+Usage:
+  ./generate.py -s 0.5
+  ./benchmark.py --save
+  ./benchmark.py [-r 5] [bed_dist vcf_merge ...]
+
+Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+"""
+
+
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+import argparse
+
+from generate import MANIFEST_FILE, read_manifest
+
+
+# Root directory of the repository
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Default location of the input files and the baseline
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'data')
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baseline.json')
+
+# Relative change in throughput or memory use that is flagged as regression
+TOLERANCE = 0.1
+
+# Benchmarks as tuples (name, script, arguments, record files). Arguments
+# starting with {output} are files in a temporary output directory, other
+# arguments naming a file in the manifest are input files. The records per
+# second are calculated from the number of records in the record files.
+BENCHMARKS = [
+    ('sync_paired_end_reads', 'sync-paired-end-reads/sync_paired_end_reads.py',
+     ['reads.fq', 'reads_1.fq', 'reads_2.fq', '{output}/synced_1.fq',
+      '{output}/synced_2.fq'],
+     ['reads.fq']),
+    ('bam_to_fastq', 'bam-to-fastq/bam_to_fastq.py',
+     ['reads.name.bam', '-1', '{output}/reads_1.fq', '-2',
+      '{output}/reads_2.fq', '-s'],
+     ['reads.name.bam']),
+    ('bam_coverage', 'bam-coverage/bam_coverage.py',
+     ['reads.bam', '-c', '{output}/coverage.wig', '-s',
+      '{output}/coverage.bed'],
+     ['reads.bam']),
+    ('bam_pass', 'bam-pass/bam_pass.py',
+     ['reads.bam', '-c', '{output}/coverage.wig', '-s',
+      '{output}/coverage.bed', '-d', '{output}/directions.txt', '-1',
+      '{output}/reads_1.fq', '-2', '{output}/reads_2.fq'],
+     ['reads.bam']),
+    ('read-directions', 'read-directions/read-directions.py',
+     ['reads.bam'],
+     ['reads.bam']),
+    ('pileup_coverage', 'pileup-coverage/pileup_coverage.py',
+     ['coverage.pileup'],
+     ['coverage.pileup']),
+    ('pileup_coverage_multi_sample', 'pileup-coverage/pileup_coverage.py',
+     ['-m', 'coverage.mpileup'],
+     ['coverage.mpileup']),
+    ('coverage-wiggle-to-bed', 'coverage-wiggle-to-bed/'
+     'coverage-wiggle-to-bed.py',
+     ['coverage.wig', '-s', '20', '-s', '40', '-p', '{output}/regions'],
+     ['coverage.wig']),
+    ('bed_dist', 'bed-dist/bed_dist.py',
+     ['regions.bed'],
+     ['regions.bed']),
+    ('bed_dist_footprint', 'bed-dist/bed_dist.py',
+     ['-f', 'regions.bed'],
+     ['regions.bed']),
+    ('vcf_to_hgvs', 'mutalyzer-vcf/vcf_to_hgvs.py',
+     ['sample_1.vcf'],
+     ['sample_1.vcf']),
+    ('vcf_to_hgvs_reference', 'mutalyzer-vcf/vcf_to_hgvs.py',
+     ['-r', 'genome.fa', 'sample_1.vcf'],
+     ['sample_1.vcf']),
+    ('filter_cds', 'mutalyzer-vcf/filter_cds.py',
+     ['-a', 'refGene.txt', 'sample_1.vcf'],
+     ['sample_1.vcf']),
+    ('vcf_merge', 'vcf-merge/vcf_merge.py',
+     ['-o', '{output}/merged.vcf', 'sample_1.vcf', 'sample_2.vcf',
+      'sample_3.vcf'],
+     ['sample_1.vcf', 'sample_2.vcf', 'sample_3.vcf']),
+    ('nucleotide-counts', 'nucleotide-counts/nucleotide-counts.py',
+     ['genome.fa'],
+     ['genome.fa'])]
+
+
+def main(names=None, directory=DATA_DIRECTORY, baseline_file=BASELINE_FILE,
+         save=False, repeat=3, tolerance=TOLERANCE):
+    """
+    Run the benchmarks in {names} (all if not given) on the input files in
+    {directory} and compare the results to those in {baseline_file}. If
+    {save} is True, store the results in {baseline_file} instead.
+    """
+    manifest = read_manifest(directory)
+    if not manifest:
+        print 'No %s in %s, run generate.py first.' % (MANIFEST_FILE,
+                                                       directory)
+        sys.exit(1)
+
+    baseline = read_baseline(baseline_file)
+    if baseline and baseline.get('scale') != manifest['scale']:
+        print 'Baseline is for scale %s, not comparing to it.' \
+              % baseline.get('scale')
+        baseline = {}
+    baseline_results = baseline.get('results', {})
+
+    print '%-28s %10s %9s %12s %9s %9s  %s' % (
+        'Benchmark', 'Records', 'Seconds', 'Records/s', 'MB/s', 'Peak MB',
+        'Baseline')
+
+    results = {}
+    failed = regressed = False
+
+    for name, script, arguments, record_files in BENCHMARKS:
+        if names and name not in names:
+            continue
+        missing = [f for f in record_files if f not in manifest['files']]
+        if missing:
+            print '%-28s skipped, not generated: %s' % (name,
+                                                       ', '.join(missing))
+            continue
+        result = run_benchmark(script, arguments, record_files, directory,
+                               manifest, repeat)
+        if 'error' in result:
+            print '%-28s failed: %s' % (name, result['error'])
+            failed = True
+            continue
+        results[name] = result
+        change = compare(result, baseline_results.get(name), tolerance)
+        if change.startswith('REGRESSION'):
+            regressed = True
+        print '%-28s %10d %9.2f %12.0f %9.2f %9.1f  %s' % (
+            name, result['records'], result['seconds'],
+            result['records_per_second'], result['megabytes_per_second'],
+            result['peak_megabytes'], change)
+
+    if save:
+        baseline_results.update(results)
+        with open(baseline_file, 'w') as handle:
+            json.dump({'scale': manifest['scale'],
+                       'results': baseline_results},
+                      handle, indent=2, sort_keys=True)
+        print 'Saved baseline to %s' % baseline_file
+
+    if failed or (regressed and not save):
+        sys.exit(1)
+
+
+def run_benchmark(script, arguments, record_files, directory, manifest,
+                  repeat=1):
+    """
+    Run {script} {repeat} times and return a dictionary with the number of
+    records, the elapsed seconds of the fastest run, the records and
+    megabytes per second, and the peak RSS in megabytes. If the script
+    fails, return a dictionary with only an error message.
+    """
+    output = tempfile.mkdtemp(prefix='benchmark-')
+    command = [sys.executable, os.path.join(ROOT, script)]
+    size = 0
+    for argument in arguments:
+        if argument.startswith('{output}'):
+            command.append(argument.format(output=output))
+        elif argument in manifest['files']:
+            command.append(os.path.join(directory, argument))
+            size += os.path.getsize(os.path.join(directory, argument))
+        else:
+            command.append(argument)
+    records = sum(manifest['files'][f] for f in record_files)
+
+    best = None
+    peak = 0
+    try:
+        for _ in range(repeat):
+            seconds, rss, status = run_command(command, output)
+            if status:
+                return {'error': 'exit status %d: %s'
+                        % (status, last_message(output))}
+            best = seconds if best is None else min(best, seconds)
+            peak = max(peak, rss)
+    finally:
+        shutil.rmtree(output)
+
+    return {'records': records,
+            'seconds': best,
+            'records_per_second': records / best,
+            'megabytes_per_second': size / best / 1024 / 1024,
+            'peak_megabytes': peak / 1024}
+
+
+def run_command(command, output):
+    """
+    Run {command} with standard output and standard error written to files
+    in {output}. Return a tuple (seconds, rss, status) with the elapsed
+    time, the peak resident set size in kilobytes, and the exit status.
+
+    The resources are those of this child only, as returned by wait4. The
+    maximum RSS from getrusage(RUSAGE_CHILDREN) would be that of the largest
+    process so far, including previous benchmarks.
+    """
+    with open(os.path.join(output, 'stdout'), 'w') as stdout, \
+             open(os.path.join(output, 'stderr'), 'w') as stderr:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=stdout, stderr=stderr,
+                                   cwd=output)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+    if os.WIFSIGNALED(status):
+        status = 128 + os.WTERMSIG(status)
+    else:
+        status = os.WEXITSTATUS(status)
+    # The process is already reaped, Popen should not wait for it.
+    process.returncode = status
+    # On Linux, ru_maxrss is in kilobytes.
+    return seconds, usage.ru_maxrss, status
+
+
+def last_message(output):
+    """
+    Return the last line written to standard error by the command run in
+    {output}, or to standard output if there is none. Most scripts report
+    errors on standard output.
+    """
+    for name in 'stderr', 'stdout':
+        with open(os.path.join(output, name)) as log:
+            lines = log.read().strip().split('\n')
+        if lines[-1]:
+            return lines[-1]
+    return ''
+
+
+def compare(result, baseline, tolerance=TOLERANCE):
+    """
+    Describe the change of {result} relative to {baseline}, starting with
+    'REGRESSION' if it is worse by more than {tolerance}.
+    """
+    if not baseline:
+        return '-'
+    speed = result['records_per_second'] / baseline['records_per_second'] - 1
+    memory = result['peak_megabytes'] / baseline['peak_megabytes'] - 1
+    change = '%+.0f%% records/s, %+.0f%% peak' % (speed * 100, memory * 100)
+    if speed < -tolerance or memory > tolerance:
+        return 'REGRESSION ' + change
+    return change
+
+
+def read_baseline(baseline_file):
+    """
+    Read the baseline from {baseline_file}, or return an empty one if there
+    is none.
+    """
+    try:
+        with open(baseline_file) as handle:
+            return json.load(handle)
+    except IOError:
+        return {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('names', metavar='BENCHMARK', nargs='*',
+                        help='benchmark to run (default: all of %s)'
+                        % ', '.join(name for name, _, _, _ in BENCHMARKS))
+    parser.add_argument('-d', dest='directory', default=DATA_DIRECTORY,
+                        help='directory with the input files (default: '
+                        'data next to this script)')
+    parser.add_argument('-b', dest='baseline_file', default=BASELINE_FILE,
+                        help='baseline file (default: baseline.json next to '
+                        'this script)')
+    parser.add_argument('--save', dest='save', action='store_true',
+                        help='store the results in the baseline file')
+    parser.add_argument('-r', dest='repeat', default=3, type=int,
+                        help='number of runs per benchmark, the fastest is '
+                        'used (default: 3)')
+    parser.add_argument('-t', dest='tolerance', default=TOLERANCE,
+                        type=float, help='relative change flagged as '
+                        'regression (default: %s)' % TOLERANCE)
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in [n for n, _, _, _ in BENCHMARKS]:
+            parser.error('unknown benchmark: %s' % name)
+    main(args.names, args.directory, args.baseline_file, args.save,
+         args.repeat, args.tolerance)
@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+"""
+Generate synthetic input files for the benchmarks in benchmark.py.
+
+All files are generated from a fixed random seed, so the same scale always
+results in the same files. The sizes are proportional to SCALE:
+
+- genome.fa: reference genome of GENOME_SIZE bases on four chromosomes.
+- reads.fq, reads_1.fq, reads_2.fq: original left reads and both sides of
+  filtered paired end reads (as input for sync_paired_end_reads.py).
+- reads.bam, reads.name.bam: paired end reads at COVERAGE sorted by
+  coordinate (with index) and by read name (requires pysam [1]).
+- sample_1.vcf, ...: variants for SAMPLES samples at overlapping sites.
+- refGene.txt: RefSeq transcripts in UCSC genePred format.
+- regions.bed: regions of varying length.
+- coverage.wig: coverage per position as 'variableStep' and 'fixedStep'.
+- coverage.pileup, coverage.mpileup: coverage per position in pileup format
+  for one sample and for SAMPLES samples (as created by samtools mpileup).
+
+The number of records in every generated file is stored in MANIFEST_FILE in
+the same directory, where benchmark.py reads it from.
+
+[1] http://code.google.com/p/pysam/
+
+Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+"""
+
+
+from __future__ import division
+
+import os
+import sys
+import json
+import heapq
+import random
+from bisect import bisect_right
+
+import argparse
+
+
+# Seed for the random number generators
+SEED = 1103
+
+# Number of bases in the genome, all other sizes are relative to it
+GENOME_SIZE = 1000000
+
+# Chromosome names and their fraction of the genome
+CHROMOSOMES = [('chr1', 0.4), ('chr2', 0.3), ('chr3', 0.2), ('chr4', 0.1)]
+
+# Number of reads in the FASTQ files per genome base
+READS_PER_BASE = 0.2
+
+# Fraction of reads removed from each of the filtered FASTQ files
+FILTERED_FRACTION = 0.05
+
+# Read length, mean and standard deviation of the insert size
+READ_LENGTH = 100
+INSERT_SIZE = 300
+INSERT_DEVIATION = 30
+
+# Mean read coverage in the BAM files
+COVERAGE = 10
+
+# Fraction of read pairs in the BAM files mapped as proper pair
+PROPER_FRACTION = 0.9
+
+# Mean distance between variant sites
+VARIANT_DISTANCE = 20
+
+# Number of samples in the VCF files and the mpileup file
+SAMPLES = 3
+
+# Fraction of samples having a variant at a site
+CARRIER_FRACTION = 0.7
+
+# Number of transcripts and BED regions per genome base
+TRANSCRIPTS_PER_BASE = 0.002
+REGIONS_PER_BASE = 0.1
+
+# Mean length of BED regions
+REGION_LENGTH = 200
+
+# Mean coverage in the Wiggle track and the pileup files
+MEAN_COVERAGE = 30
+
+# Fraction of positions starting a stretch of no coverage
+GAP_FRACTION = 0.0005
+
+# Name of the file listing the number of records per generated file
+MANIFEST_FILE = 'manifest.json'
+
+# Number of different quality strings to choose from
+QUALITIES = 64
+
+# DNA base complements
+COMPLEMENT = {'A': 'T',
+              'T': 'A',
+              'C': 'G',
+              'G': 'C',
+              'N': 'N'}
+
+
+def main(directory, scale=1.0, formats=None):
+    """
+    Generate input files of the given {formats} (all if not given) in
+    {directory}, with sizes relative to {scale}.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    manifest = read_manifest(directory)
+    if manifest.get('scale') != scale or manifest.get('seed') != SEED:
+        manifest = {'scale': scale, 'seed': SEED, 'files': {}}
+
+    genome = generate_genome(scale)
+
+    for name, generator in GENERATORS:
+        if formats and name not in formats:
+            continue
+        print 'Generating %s files...' % name
+        records = generator(directory, genome, scale)
+        manifest['files'].update(records)
+        for filename in sorted(records):
+            print '  %s: %d records' % (filename, records[filename])
+
+    with open(os.path.join(directory, MANIFEST_FILE), 'w') as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+
+
+def read_manifest(directory):
+    """
+    Read the manifest in {directory}, or return an empty one if there is
+    none.
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as handle:
+            return json.load(handle)
+    except IOError:
+        return {}
+
+
+def generate_genome(scale):
+    """
+    Return the genome as a list of tuples (name, sequence).
+    """
+    rng = random.Random(SEED)
+    genome = []
+    for name, fraction in CHROMOSOMES:
+        length = max(READ_LENGTH + INSERT_SIZE * 2,
+                     int(GENOME_SIZE * scale * fraction))
+        genome.append((name, random_sequence(rng, length)))
+    return genome
+
+
+def random_sequence(rng, length, alphabet='ACGT'):
+    """
+    Return a random sequence of {length} characters from {alphabet}.
+    """
+    r = rng.random
+    n = len(alphabet)
+    return ''.join([alphabet[int(r() * n)] for _ in xrange(length)])
+
+
+def reverse_complement(sequence):
+    """
+    Return reverse complement of DNA sequence.
+    """
+    return ''.join(COMPLEMENT[b] for b in sequence[::-1])
+
+
+def random_positions(rng, genome, count, margin=0):
+    """
+    Return a list of {count} random positions on {genome} as tuples (index,
+    position), where index is the index of the chromosome in {genome}. The
+    positions are sorted and at least {margin} from the chromosome end.
+    """
+    offsets = [0]
+    for _, sequence in genome:
+        offsets.append(offsets[-1] + max(0, len(sequence) - margin))
+    positions = []
+    for offset in sorted(rng.randrange(offsets[-1]) for _ in xrange(count)):
+        index = bisect_right(offsets, offset) - 1
+        positions.append((index, offset - offsets[index]))
+    return positions
+
+
+def insert_size(rng):
+    """
+    Return a random insert size.
+    """
+    return min(INSERT_SIZE + 2 * INSERT_DEVIATION,
+               max(READ_LENGTH, int(rng.gauss(INSERT_SIZE, INSERT_DEVIATION))))
+
+
+def quality_strings(rng):
+    """
+    Return a list of QUALITIES quality strings of READ_LENGTH in Sanger
+    (Phred+33) encoding, declining towards the end of the read.
+    """
+    return [''.join(chr(33 + max(2, 40 - i // 5 - rng.randrange(10)))
+                    for i in range(READ_LENGTH))
+            for _ in range(QUALITIES)]
+
+
+def coverage_walk(rng, length):
+    """
+    Generate a random walk of {length} coverage values around
+    MEAN_COVERAGE, including stretches of no coverage.
+    """
+    coverage = MEAN_COVERAGE
+    up, down = (-1, 0, 1, 2), (-2, -1, 0, 1)
+    choice, r = rng.choice, rng.random
+    gap = 0
+    for _ in xrange(length):
+        if gap:
+            gap -= 1
+            yield 0
+            continue
+        if r() < GAP_FRACTION:
+            gap = rng.randint(50, 500)
+            coverage = 0
+        coverage = max(0, coverage + choice(up if coverage < MEAN_COVERAGE
+                                            else down))
+        yield coverage
+
+
+def generate_fasta(directory, genome, scale):
+    """
+    Write the genome in FASTA format, with an index as created by samtools
+    faidx.
+    """
+    with open(os.path.join(directory, 'genome.fa'), 'w') as fasta, \
+             open(os.path.join(directory, 'genome.fa.fai'), 'w') as fai:
+        for name, sequence in genome:
+            fasta.write('>%s\n' % name)
+            fai.write('%s\t%d\t%d\t60\t61\n' % (name, len(sequence),
+                                                 fasta.tell()))
+            for i in xrange(0, len(sequence), 60):
+                fasta.write(sequence[i:i + 60] + '\n')
+    return {'genome.fa': sum(len(sequence) for _, sequence in genome)}
+
+
+def generate_fastq(directory, genome, scale):
+    """
+    Write original left reads and both sides of filtered paired end reads in
+    FASTQ format. Old-style Illumina header lines are used.
+    """
+    rng = random.Random(SEED)
+    qualities = quality_strings(rng)
+    reads = int(GENOME_SIZE * scale * READS_PER_BASE)
+    margin = INSERT_SIZE + 2 * INSERT_DEVIATION
+    counts = {'reads.fq': reads, 'reads_1.fq': 0, 'reads_2.fq': 0}
+
+    positions = random_positions(rng, genome, reads, margin)
+    rng.shuffle(positions)
+
+    with open(os.path.join(directory, 'reads.fq'), 'w') as original, \
+             open(os.path.join(directory, 'reads_1.fq'), 'w') as left, \
+             open(os.path.join(directory, 'reads_2.fq'), 'w') as right:
+        for i, (index, position) in enumerate(positions):
+            sequence = genome[index][1]
+            end = position + insert_size(rng)
+            record = '@read%09d/1\n%s\n+\n%s\n' % (
+                i, sequence[position:position + READ_LENGTH],
+                rng.choice(qualities))
+            original.write(record)
+            if rng.random() >= FILTERED_FRACTION:
+                left.write(record)
+                counts['reads_1.fq'] += 1
+            if rng.random() >= FILTERED_FRACTION:
+                right.write('@read%09d/2\n%s\n+\n%s\n' % (
+                    i, reverse_complement(sequence[end - READ_LENGTH:end]),
+                    rng.choice(qualities)))
+                counts['reads_2.fq'] += 1
+
+    return counts
+
+
+def generate_bam(directory, genome, scale):
+    """
+    Write paired end reads in BAM format, sorted by coordinate (with index)
+    and sorted by read name.
+    """
+    try:
+        import pysam
+    except ImportError:
+        print 'Generating BAM files requires the pysam Python module.'
+        sys.exit(1)
+
+    rng = random.Random(SEED)
+    qualities = quality_strings(rng)
+    pairs = int(GENOME_SIZE * scale * COVERAGE / (2 * READ_LENGTH))
+    margin = INSERT_SIZE + 2 * INSERT_DEVIATION
+
+    # Read pairs are named in order of their leftmost position, so both
+    # sort orders can be written from the same list.
+    fragments = [(index, position, insert_size(rng),
+                  rng.random() < PROPER_FRACTION, rng.random() < 0.5,
+                  rng.choice(qualities), rng.choice(qualities))
+                 for index, position
+                 in random_positions(rng, genome, pairs, margin)]
+
+    def aligned_reads(i, fragment):
+        index, position, insert, proper, left_first, left_quality, \
+               right_quality = fragment
+        sequence = genome[index][1]
+        paired = 0x1 | (0x2 if proper else 0)
+        right_position = position + insert - READ_LENGTH
+        left = aligned_read(pysam, 'pair%09d' % i, index, position,
+                            sequence[position:position + READ_LENGTH],
+                            left_quality,
+                            paired | 0x20 | (0x40 if left_first else 0x80),
+                            right_position, insert)
+        right = aligned_read(pysam, 'pair%09d' % i, index, right_position,
+                             sequence[right_position:position + insert],
+                             right_quality,
+                             paired | 0x10 | (0x80 if left_first else 0x40),
+                             position, -insert)
+        return left, right
+
+    def header(order):
+        return {'HD': {'VN': '1.0', 'SO': order},
+                'SQ': [{'SN': name, 'LN': len(sequence)}
+                       for name, sequence in genome]}
+
+    bam_file = os.path.join(directory, 'reads.bam')
+    with pysam.Samfile(bam_file, 'wb', header=header('coordinate')) as bam:
+        mates = []
+        for i, fragment in enumerate(fragments):
+            left, right = aligned_reads(i, fragment)
+            while mates and mates[0][:2] <= (left.tid, left.pos):
+                bam.write(heapq.heappop(mates)[-1])
+            bam.write(left)
+            heapq.heappush(mates, (right.tid, right.pos, i, right))
+        while mates:
+            bam.write(heapq.heappop(mates)[-1])
+    pysam.index(bam_file)
+
+    with pysam.Samfile(os.path.join(directory, 'reads.name.bam'), 'wb',
+                       header=header('queryname')) as bam:
+        for i, fragment in enumerate(fragments):
+            for read in aligned_reads(i, fragment):
+                bam.write(read)
+
+    return {'reads.bam': 2 * pairs, 'reads.name.bam': 2 * pairs}
+
+
+def aligned_read(pysam, name, index, position, sequence, quality, flag,
+                 mate_position, insert):
+    """
+    Return a read aligned without gaps at {position} on chromosome {index},
+    with its mate on the same chromosome.
+    """
+    read = pysam.AlignedRead()
+    read.qname = name
+    read.flag = flag
+    read.tid = read.mrnm = index
+    read.pos = position
+    read.mapq = 60
+    read.cigar = [(0, len(sequence))]
+    read.mpos = mate_position
+    read.isize = insert
+    read.seq = sequence
+    read.qual = quality
+    return read
+
+
+def generate_vcf(directory, genome, scale):
+    """
+    Write variants for SAMPLES samples in VCF format, one file per sample.
+    Sites are shared between samples, each sample carrying the variant at a
+    site with a probability of CARRIER_FRACTION.
+    """
+    rng = random.Random(SEED)
+    filenames = ['sample_%d.vcf' % (sample + 1) for sample in range(SAMPLES)]
+    counts = dict.fromkeys(filenames, 0)
+    vcfs = [open(os.path.join(directory, filename), 'w')
+            for filename in filenames]
+
+    for sample, vcf in enumerate(vcfs):
+        vcf.write('##fileformat=VCFv4.1\n')
+        for name, sequence in genome:
+            vcf.write('##contig=<ID=%s,length=%d>\n' % (name, len(sequence)))
+        vcf.write('##INFO=<ID=DP,Number=1,Type=Integer,'
+                  'Description="Total Depth">\n'
+                  '##FORMAT=<ID=GT,Number=1,Type=String,'
+                  'Description="Genotype">\n'
+                  '##FORMAT=<ID=DP,Number=1,Type=Integer,'
+                  'Description="Read Depth">\n')
+        vcf.write('#%s\tsample_%d\n' % ('\t'.join(
+            ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO',
+             'FORMAT']), sample + 1))
+
+    for name, sequence in genome:
+        position = 0
+        while True:
+            position += 1 + int(rng.expovariate(1 / VARIANT_DISTANCE))
+            if position + 10 >= len(sequence):
+                break
+            reference = sequence[position - 1]
+            kind = rng.random()
+            if kind < 0.8:
+                alternative = rng.choice([b for b in 'ACGT' if b != reference])
+            elif kind < 0.9:
+                reference = sequence[position - 1:position + rng.randint(1, 5)]
+                alternative = reference[0]
+            else:
+                alternative = reference + random_sequence(rng,
+                                                          rng.randint(1, 5))
+            for vcf, filename in zip(vcfs, filenames):
+                if rng.random() >= CARRIER_FRACTION:
+                    continue
+                depth = rng.randint(5, 60)
+                vcf.write('%s\t%d\t.\t%s\t%s\t%d\tPASS\tDP=%d\tGT:DP\t%s:%d\n'
+                          % (name, position, reference, alternative,
+                             rng.randint(20, 99), depth,
+                             rng.choice(['0/1', '0/1', '1/1']), depth))
+                counts[filename] += 1
+            position += len(reference) - 1
+
+    for vcf in vcfs:
+        vcf.close()
+    return counts
+
+
+def generate_genepred(directory, genome, scale):
+    """
+    Write RefSeq transcripts in UCSC genePred format (without bin column),
+    sorted by chromosome and start.
+    """
+    rng = random.Random(SEED)
+    transcripts = int(GENOME_SIZE * scale * TRANSCRIPTS_PER_BASE)
+
+    with open(os.path.join(directory, 'refGene.txt'), 'w') as annotation:
+        for i, (index, start) in enumerate(
+                random_positions(rng, genome, transcripts, 300)):
+            exons = []
+            position = start
+            for _ in range(rng.randint(1, 10)):
+                length = rng.randint(50, 300)
+                if exons and position + length > len(genome[index][1]):
+                    break
+                exons.append((position, position + length))
+                position += length + rng.randint(100, 2000)
+            cds_start = rng.randint(exons[0][0], exons[0][1] - 1)
+            cds_end = rng.randint(max(cds_start, exons[-1][0]) + 1,
+                                  exons[-1][1])
+            annotation.write('\t'.join(map(str, [
+                'NM_%06d' % (i + 1), genome[index][0], rng.choice('+-'),
+                exons[0][0], exons[-1][1], cds_start, cds_end, len(exons),
+                ''.join('%d,' % s for s, _ in exons),
+                ''.join('%d,' % e for _, e in exons)])) + '\n')
+
+    return {'refGene.txt': transcripts}
+
+
+def generate_bed(directory, genome, scale):
+    """
+    Write regions of exponentially distributed lengths in BED format.
+    """
+    rng = random.Random(SEED)
+    regions = int(GENOME_SIZE * scale * REGIONS_PER_BASE)
+    margin = REGION_LENGTH * 20
+
+    with open(os.path.join(directory, 'regions.bed'), 'w') as bed:
+        bed.write('track name=regions\n')
+        for i, (index, start) in enumerate(
+                random_positions(rng, genome, regions, margin)):
+            length = 1 + min(margin - 1,
+                             int(rng.expovariate(1 / REGION_LENGTH)))
+            bed.write('%s\t%d\t%d\tregion%d\t0\t%s\n'
+                      % (genome[index][0], start, start + length, i + 1,
+                         rng.choice('+-')))
+
+    return {'regions.bed': regions}
+
+
+def generate_wiggle(directory, genome, scale):
+    """
+    Write coverage per position as Wiggle track. The odd chromosomes are
+    written as 'variableStep' without positions of no coverage, the even
+    chromosomes as 'fixedStep'.
+    """
+    rng = random.Random(SEED)
+    lines = 0
+
+    with open(os.path.join(directory, 'coverage.wig'), 'w') as wig:
+        wig.write('track type=wiggle_0 name=coverage visibility=full\n')
+        for i, (name, sequence) in enumerate(genome):
+            coverages = coverage_walk(rng, len(sequence))
+            if i % 2:
+                wig.write('fixedStep chrom=%s start=1 step=1\n' % name)
+                for coverage in coverages:
+                    wig.write('%d\n' % coverage)
+                    lines += 1
+            else:
+                wig.write('variableStep chrom=%s\n' % name)
+                for position, coverage in enumerate(coverages):
+                    if coverage:
+                        wig.write('%d %d\n' % (position + 1, coverage))
+                        lines += 1
+
+    return {'coverage.wig': lines}
+
+
+def generate_pileup(directory, genome, scale):
+    """
+    Write coverage per position in pileup format, for one sample and for
+    SAMPLES samples. Positions of no coverage are omitted.
+    """
+    rng = random.Random(SEED)
+    bases = random_sequence(rng, 4 * MEAN_COVERAGE, '.,.,.,ACGT')
+    qualities = random_sequence(rng, 4 * MEAN_COVERAGE,
+                                ''.join(chr(33 + q) for q in range(20, 41)))
+    counts = {'coverage.pileup': 0, 'coverage.mpileup': 0}
+
+    def columns(coverage):
+        if not coverage:
+            return '0\t*\t*'
+        offset = coverage % MEAN_COVERAGE
+        return '%d\t%s\t%s' % (coverage, bases[offset:offset + coverage],
+                               qualities[offset:offset + coverage])
+
+    with open(os.path.join(directory, 'coverage.pileup'), 'w') as pileup, \
+             open(os.path.join(directory, 'coverage.mpileup'), 'w') \
+             as mpileup:
+        for name, sequence in genome:
+            walks = [coverage_walk(rng, len(sequence))
+                     for _ in range(SAMPLES)]
+            for position, coverages in enumerate(zip(*walks)):
+                if not any(coverages):
+                    continue
+                prefix = '%s\t%d\t%s\t' % (name, position + 1,
+                                           sequence[position])
+                mpileup.write(prefix + '\t'.join(map(columns, coverages))
+                              + '\n')
+                counts['coverage.mpileup'] += 1
+                if coverages[0]:
+                    pileup.write(prefix + columns(coverages[0]) + '\n')
+                    counts['coverage.pileup'] += 1
+
+    return counts
+
+
+# Generators per format in order of generation
+GENERATORS = [('fasta',    generate_fasta),
+              ('fastq',    generate_fastq),
+              ('bam',      generate_bam),
+              ('vcf',      generate_vcf),
+              ('genepred', generate_genepred),
+              ('bed',      generate_bed),
+              ('wig',      generate_wiggle),
+              ('pileup',   generate_pileup)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('formats', metavar='FORMAT', nargs='*',
+                        help='format to generate files for (default: all of '
+                        '%s)' % ', '.join(name for name, _ in GENERATORS))
+    parser.add_argument('-d', dest='directory', default=os.path.join(
+                            os.path.dirname(os.path.abspath(__file__)),
+                            'data'),
+                        help='directory to write the files to (default: '
+                        'data next to this script)')
+    parser.add_argument('-s', dest='scale', default=1.0, type=float,
+                        help='size of the files relative to the default '
+                        '(default: 1)')
+    args = parser.parse_args()
+    for format in args.formats:
+        if format not in dict(GENERATORS):
+            parser.error('unknown format: %s' % format)
+    main(args.directory, args.scale, args.formats)
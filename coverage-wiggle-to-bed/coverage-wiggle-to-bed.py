@@ -2,22 +2,33 @@
 """
 Create BED file with high-coverage regions from a Wiggle track.
 
-Run with no arguments for usage info.
+Run with no arguments for usage info. The script requires NumPy [3].
 
 Regions are defined as consecutive positions that have a coverage exceeding
-a certain threshold. The input Wiggle track should contain only data
-formattted as 'variableStep' with coverage as first data column.
+a certain threshold. The input Wiggle track should contain data formatted as
+'variableStep' or 'fixedStep' with coverage as first data column. The span
+argument is supported for both, in which case the threshold for a data point
+is taken at its first position.
+
+Data is read in chunks of CHUNK_SIZE lines per chromosome, and high-coverage
+regions are found with vectorized operations on these chunks. Chromosomes can
+be processed in parallel, using an index of the sections in the Wiggle track
+that is stored next to it as WIGGLE_FILE.idx. A Wiggle track compressed with
+gzip is decompressed automatically, but cannot be processed in parallel. The
+same holds for a Wiggle track read from standard input (if WIGGLE_FILE is -),
+such as the output of bam_coverage.py.
+
+The BED file has the mean coverage of each region as score column. Several
+static thresholds can be used in one pass, writing one BED file for each.
 
 Note that regions in the BED file are zero-based and open-ended [1], as
 opposed to positions in the Wiggle track [2].
 
 Todo: Do we need a track header line in the BED output?
-Todo: Add average coverage for region as score column.
-Todo: Add overlap behaviour as optional argument.
-Todo: Add support for span argument of variableStep lines.
 
 [1] http://genome.ucsc.edu/FAQ/FAQformat.html#format1
 [2] http://genome.ucsc.edu/goldenPath/help/wiggle.html
+[3] http://numpy.scipy.org/
 
 Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
 Copyright (c) 2011 Jeroen Laros <j.f.j.laros@lumc.nl>
@@ -25,36 +36,238 @@ Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 """
 
 
+from __future__ import division
+
+import os
 import sys
+import multiprocessing
+from collections import defaultdict
+from cStringIO import StringIO
+
 import argparse
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import GZIP_MAGIC, handle_broken_pipe, iter_lines, open_file, \
+     parse_bed, parse_wig_definition
+
 
+# Maximum number of data lines to process at once
+CHUNK_SIZE = 1000000
 
-def main(wig_file, static_threshold=None, thresholds_file=None):
+# Number of bytes to read at once while indexing a Wiggle track
+INDEX_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def main(wig_file, static_thresholds=None, thresholds_file=None,
+         require_all=False, prefix=None, processes=1):
     """
     Write regions in {wig_file} with high coverage as defined by
-    {static_threshold} or in {thresholds_file} as BED file to standard output.
+    {static_thresholds} or in {thresholds_file} as BED file to standard
+    output.
+
+    If more than one static threshold is given, one BED file per threshold
+    is written to {prefix}.<threshold>.bed instead, all in one pass over
+    {wig_file}.
+
+    In case of overlapping regions in {thresholds_file}, the most relaxed
+    threshold is used, or the most strict one if {require_all} is True.
+
+    If {processes} is more than one, the chromosomes in {wig_file} are
+    processed in parallel by that many worker processes.
     """
-    if not static_threshold:
-        static_threshold = float('inf')
+    if not static_thresholds:
+        static_thresholds = [float('inf')]
 
     if thresholds_file:
-        thresholds = read_thresholds(thresholds_file)
+        thresholds = index_thresholds(read_thresholds(thresholds_file),
+                                      max if require_all else min)
+    else:
+        thresholds = {}
+
+    if len(static_thresholds) == 1:
+        handle_broken_pipe()
+        beds = [sys.stdout]
+    else:
+        beds = [open('%s.%s.bed' % (prefix, threshold), 'w')
+                for threshold in static_thresholds]
+
+    if processes > 1:
+        with open(wig_file, 'rb') as wig:
+            if wig.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+                sys.stderr.write('Cannot process a compressed Wiggle track '
+                                 'in parallel.\n')
+                sys.exit(1)
+        write_bed_parallel(wig_file, static_thresholds, thresholds, beds,
+                           processes)
     else:
-        thresholds = []
-
-    def high_coverage(region, position, coverage):
-        matches = [coverage >= threshold
-                   for name, start, length, threshold in thresholds
-                   if region == name and start < position <= length]
-        if matches:
-            # In case of overlap, we choose the most relaxed one (otherwise
-            # use 'all' instead of 'any'. Todo: add as optional argument.
-            return any(matches)
+        with open_file(wig_file) as wig:
+            write_bed(iter_lines(wig),
+                      [(high_coverage(threshold, thresholds), bed)
+                       for threshold, bed in zip(static_thresholds, beds)])
+
+    for bed in beds:
+        if bed is not sys.stdout:
+            bed.close()
+
+
+def high_coverage(static_threshold, thresholds):
+    """
+    Return a function telling for arrays of positions and coverages on a
+    chromosome if they are of interest, given the indexed {thresholds} and
+    {static_threshold} for positions outside of them.
+    """
+    def of_interest(region, positions, coverages):
+        limits = numpy.empty(len(positions))
+        limits.fill(static_threshold)
+        if region in thresholds:
+            boundaries, values = thresholds[region]
+            i = numpy.searchsorted(boundaries, positions) - 1
+            inside = (i >= 0) & (i < len(values))
+            found = values[i[inside]]
+            limits[inside] = numpy.where(numpy.isnan(found),
+                                         static_threshold, found)
+        return coverages >= limits
+    return of_interest
+
+
+def write_bed_parallel(wig_file, static_thresholds, thresholds, beds,
+                       processes):
+    """
+    Write regions with high coverage as BED tracks, processing chromosomes
+    from {wig_file} in parallel. The output is written in the order of the
+    chromosomes in {wig_file}.
+    """
+    jobs = [(wig_file, sections, static_thresholds,
+             {chrom: thresholds[chrom]} if chrom in thresholds else {})
+            for chrom, sections in read_wig_index(wig_file)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for results in pool.imap(process_sections, jobs):
+            for bed, result in zip(beds, results):
+                bed.write(result)
+    except RuntimeError:
+        pool.terminate()
+        sys.exit(1)
+    pool.close()
+    pool.join()
+
+
+def process_sections(job):
+    """
+    Process the sections of one chromosome in a worker process and return
+    the BED output for each static threshold.
+    """
+    wig_file, sections, static_thresholds, thresholds = job
+    beds = [StringIO() for _ in static_thresholds]
+    try:
+        with open(wig_file, 'rb') as wig:
+            write_bed(read_sections(wig, sections),
+                      [(high_coverage(threshold, thresholds), bed)
+                       for threshold, bed in zip(static_thresholds, beds)])
+    except SystemExit:
+        # The error is already reported, but the pool would not notice the
+        # worker exiting.
+        raise RuntimeError('Could not process sections in worker.')
+    return [bed.getvalue() for bed in beds]
+
+
+def read_sections(wig, sections):
+    """
+    Generate the lines from the byte ranges in {sections} of an open Wiggle
+    track.
+    """
+    for start, end in sections:
+        wig.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            line = wig.readline()
+            if not line:
+                break
+            remaining -= len(line)
+            yield line
+
+
+def read_wig_index(wig_file):
+    """
+    Return the byte ranges of the sections in {wig_file} as a list of tuples
+    (chrom, sections), where sections is a list of (start, end) byte offsets
+    of consecutive sections for chrom.
+
+    The index is read from the sidecar file {wig_file}.idx if it is newer
+    than {wig_file}. Otherwise it is created and written to the sidecar file
+    (if possible).
+    """
+    index_file = wig_file + '.idx'
+
+    try:
+        if os.path.getmtime(index_file) >= os.path.getmtime(wig_file):
+            with open(index_file, 'r') as index:
+                ranges = [(chrom, int(start), int(end)) for chrom, start, end
+                          in (line.split() for line in index)]
         else:
-            return coverage >= static_threshold
+            ranges = None
+    except (OSError, IOError, ValueError):
+        ranges = None
 
-    with open(wig_file, 'r') as wig:
-        write_bed(wig, high_coverage)
+    if ranges is None:
+        ranges = index_wig(wig_file)
+        try:
+            with open(index_file, 'w') as index:
+                index.writelines('%s\t%i\t%i\n' % r for r in ranges)
+        except IOError:
+            pass
+
+    chromosomes = []
+    for chrom, start, end in ranges:
+        if chromosomes and chromosomes[-1][0] == chrom:
+            chromosomes[-1][1].append( (start, end) )
+        else:
+            chromosomes.append( (chrom, [(start, end)]) )
+    return chromosomes
+
+
+def index_wig(wig_file):
+    """
+    Find the 'variableStep' and 'fixedStep' definition lines in {wig_file}
+    and return a list of tuples (chrom, start, end) with the byte range of
+    each section.
+
+    The file is scanned in blocks of INDEX_BLOCK_SIZE bytes without parsing
+    the data lines.
+    """
+    keywords = '\nvariableStep', '\nfixedStep'
+    overlap = max(len(keyword) for keyword in keywords) - 1
+
+    offsets = []
+    with open(wig_file, 'rb') as wig:
+        # Pretend there is a newline before the start of the file.
+        tail = '\n'
+        position = 0
+        while True:
+            block = wig.read(INDEX_BLOCK_SIZE)
+            if not block:
+                break
+            data = tail + block
+            base = position - len(tail)
+            for keyword in keywords:
+                i = data.find(keyword)
+                while i >= 0:
+                    offsets.append(base + i + 1)
+                    i = data.find(keyword, i + 1)
+            tail = data[-overlap:]
+            position += len(block)
+
+        offsets.sort()
+        ranges = []
+        for start, end in zip(offsets, offsets[1:] + [position]):
+            wig.seek(start)
+            ranges.append( (read_definition(wig.readline())['chrom'], start,
+                            end) )
+
+    return ranges
 
 
 def read_thresholds(thresholds_file):
@@ -62,24 +275,98 @@ def read_thresholds(thresholds_file):
     Read a BED formatted file with coverage threshold values in the 'score'
     field.
     """
-    with open(thresholds_file, 'r') as thresholds:
-        def parse(line):
-            f = line.split()
-            return (f[0], int(f[1]), int(f[2]), float(f[4]))
-        return map(parse, thresholds)
+    with open_file(thresholds_file) as thresholds:
+        try:
+            return [(chrom, start, end, float(rest.split()[1]))
+                    for chrom, start, end, rest in parse_bed(thresholds)]
+        except (IndexError, ValueError):
+            sys.stderr.write('Error reading thresholds from: %s\n'
+                             % thresholds_file)
+            sys.exit(1)
 
 
-def write_bed(wig, of_interest, bed=sys.stdout):
+def index_thresholds(thresholds, combine=min):
     """
-    Write regions with high coverage as BED track.
+    Index threshold regions per chromosome for fast lookup.
+
+    The regions on each chromosome are split at all their start and end
+    positions into consecutive non-overlapping segments. Overlapping
+    thresholds are combined into one value per segment with {combine}.
+
+    Return a dictionary with per chromosome a tuple (boundaries, values) of
+    NumPy arrays, where values[i] is the threshold (or NaN) for positions p
+    with boundaries[i] < p <= boundaries[i + 1].
     """
-    in_region = False
-    previous_position = 0
-    region_start = region_end = chrom = None
+    events = defaultdict(list)
+    for name, start, end, threshold in thresholds:
+        events[name].append( (start, 1, threshold) )
+        events[name].append( (end, -1, threshold) )
 
-    def write_region():
-        if in_region:
-            bed.write('%s\t%i\t%i\n' % (chrom, region_start - 1, region_end))
+    index = {}
+    for name, chromosome_events in events.items():
+        chromosome_events.sort()
+        active = defaultdict(int)
+        boundaries = []
+        values = []
+        for position, change, threshold in chromosome_events:
+            active[threshold] += change
+            if not active[threshold]:
+                del active[threshold]
+            value = combine(active) if active else numpy.nan
+            if boundaries and boundaries[-1] == position:
+                values[-1] = value
+            else:
+                boundaries.append(position)
+                values.append(value)
+        # The last boundary always closes a segment.
+        index[name] = (numpy.array(boundaries, dtype=numpy.int64),
+                       numpy.array(values[:-1], dtype=float))
+
+    return index
+
+
+def read_chunks(wig):
+    """
+    Read data from a Wiggle track in chunks of at most CHUNK_SIZE lines.
+
+    Generate tuples (chrom, positions, coverages, span, new_section) where
+    positions and coverages are NumPy arrays and new_section is True for the
+    first chunk after a 'variableStep' or 'fixedStep' definition line.
+    """
+    section = None
+    offset = 0
+    lines = []
+
+    def error(line):
+        sys.stderr.write('Error interpreting line: %s\n' % line)
+        sys.exit(1)
+
+    def chunk():
+        columns = 2 if section['step'] is None else 1
+        values = ''.join(lines).split()
+        try:
+            if len(values) != columns * len(lines):
+                raise ValueError
+            data = numpy.array(values, dtype=float).reshape(-1, columns)
+        except ValueError:
+            # Find the first line we cannot interpret.
+            for line in lines:
+                try:
+                    if len(map(float, line.split())) != columns:
+                        raise ValueError
+                except ValueError:
+                    error(line)
+            error(lines[0])
+        if columns == 2:
+            positions = data[:, 0].astype(numpy.int64)
+            coverages = data[:, 1]
+        else:
+            positions = section['start'] + section['step'] * \
+                        numpy.arange(offset, offset + len(lines),
+                                     dtype=numpy.int64)
+            coverages = data[:, 0]
+        return (section['chrom'], positions, coverages, section['span'],
+                offset == 0)
 
     for line in wig:
 
@@ -90,57 +377,159 @@ def write_bed(wig, of_interest, bed=sys.stdout):
             continue
 
         # Definition of new chromosome.
-        if line.startswith('variableStep'):
-            write_region()
-            in_region = False
-            try:
-                p = line.index('chrom=')
-            except ValueError:
-                sys.stderr.write('Error interpreting line: %s\n' % line)
-                sys.exit(1)
-            chrom = line[p + 6:].split()[0]
+        if line.startswith('variableStep') or line.startswith('fixedStep'):
+            if lines:
+                yield chunk()
+            section = read_definition(line)
+            offset = 0
+            lines = []
             continue
 
-        # Position with coverage data.
-        parts = line.split()
-        try:
-            position = int(parts[0])
-            coverage = float(parts[1])
-        except (IndexError, ValueError):
-            sys.stderr.write('Error interpreting line: %s\n' % line)
-            sys.exit(1)
+        if section is None:
+            error(line)
 
-        if not of_interest(chrom, position, coverage):
-            write_region()
-            in_region = False
-        else:
-            if position != previous_position + 1:
-                write_region()
-                in_region = False
-            if not in_region:
-                in_region = True
-                region_start = position
-            region_end = position
+        lines.append(line)
+        if len(lines) >= CHUNK_SIZE:
+            yield chunk()
+            offset += len(lines)
+            lines = []
+
+    if lines:
+        yield chunk()
+
+
+def read_definition(line):
+    """
+    Parse a 'variableStep' or 'fixedStep' definition line and return it as
+    a dictionary with 'chrom', 'start', 'step', and 'span' fields. For
+    'variableStep', the 'start' and 'step' fields are None.
+    """
+    try:
+        return parse_wig_definition(line)
+    except ValueError as error:
+        sys.stderr.write('%s\n' % error)
+        sys.exit(1)
+
+
+def write_bed(wig, tracks):
+    """
+    Write regions with high coverage as BED tracks.
+
+    For every pair (of_interest, bed) in {tracks}, regions of consecutive
+    positions for which of_interest(chrom, positions, coverages) is True are
+    written to the open file bed, with their mean coverage as score.
+
+    Each coverage value is weighted by the number of bases it adds to its
+    region, which is less than the span if the next data point starts
+    within it (span larger than step).
+    """
+    # Per track the region that may continue in the next chunk, as tuple
+    # (chrom, start, end, summed coverage, coverage of the last data point).
+    regions = [None] * len(tracks)
 
-        previous_position = position
+    def write_region(region, bed):
+        if region:
+            chrom, start, end, summed, _ = region
+            bed.write('%s\t%i\t%i\t-\t%.1f\n' %
+                      (chrom, start, end, summed / (end - start)))
 
-    write_region()
+    for chrom, positions, coverages, span, new_section in read_chunks(wig):
+        for track, (of_interest, bed) in enumerate(tracks):
+            region = regions[track]
+
+            if new_section:
+                write_region(region, bed)
+                region = None
+
+            indices = numpy.flatnonzero(of_interest(chrom, positions,
+                                                    coverages))
+            if not len(indices):
+                write_region(region, bed)
+                regions[track] = None
+                continue
+
+            starts = positions[indices] - 1
+            ends = starts + span
+
+            # A region is broken by a position of no interest or by a gap.
+            breaks = numpy.flatnonzero((indices[1:] != indices[:-1] + 1) |
+                                       (starts[1:] > ends[:-1])) + 1
+            firsts = numpy.r_[0, breaks]
+            region_starts = starts[firsts].tolist()
+            region_ends = ends[numpy.r_[breaks - 1, len(indices) - 1]].tolist()
+
+            # Bases added by each data point, up to the start of the next.
+            weights = numpy.empty(len(indices), dtype=numpy.int64)
+            weights[:-1] = numpy.minimum(starts[1:] - starts[:-1], span)
+            weights[breaks - 1] = span
+            weights[-1] = span
+            region_sums = numpy.add.reduceat(coverages[indices] * weights,
+                                             firsts).tolist()
+
+            # Extend the region from the previous chunk if adjacent, without
+            # the part of its last data point overlapping this chunk.
+            if region and indices[0] == 0 and region_starts[0] <= region[2]:
+                region_sums[0] += region[3] - region[4] * \
+                                  (region[2] - region_starts[0])
+                region_starts[0] = region[1]
+            else:
+                write_region(region, bed)
+
+            # Keep the last region open if it ends at the end of the chunk.
+            region = None
+            if indices[-1] == len(positions) - 1:
+                region = (chrom, region_starts.pop(), region_ends.pop(),
+                          region_sums.pop(), coverages[indices[-1]])
+            regions[track] = region
+
+            bed.writelines('%s\t%i\t%i\t-\t%.1f\n' %
+                           (chrom, start, end, summed / (end - start))
+                           for start, end, summed
+                           in zip(region_starts, region_ends, region_sums))
+
+    for region, (_, bed) in zip(regions, tracks):
+        write_region(region, bed)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
                                      epilog="""
 The BED file is written to standard output. If both -s and -f are specified,
-STATIC_THRESHOLD is used outside the regions defined in THRESHOLD_FILE.
+STATIC_THRESHOLD is used outside the regions defined in THRESHOLD_FILE. Where
+regions in THRESHOLD_FILE overlap, the most relaxed threshold is used unless
+-a is specified.
+
+If -s is specified more than once, one BED file per STATIC_THRESHOLD is
+written to PREFIX.STATIC_THRESHOLD.bed in one pass over WIGGLE_FILE.
+
+With -j, chromosomes are processed in parallel using an index of WIGGLE_FILE
+that is created on first use and stored as WIGGLE_FILE.idx.
 """)
     group = parser.add_argument_group()
     group.add_argument('wig_file', metavar='WIGGLE_FILE',
                        help='file in Wiggle format to read coverage from')
-    group.add_argument('-s', dest='static_threshold', type=int,
-                       help='use a static threshold value')
+    group.add_argument('-s', dest='static_thresholds', type=int,
+                       action='append', metavar='STATIC_THRESHOLD',
+                       help='use a static threshold value (can be '
+                       'specified more than once)')
     group.add_argument('-f', dest='thresholds_file',
                        help='read threshold values per region from this file in BED format')
+    group.add_argument('-a', '--all', dest='require_all', action='store_true',
+                       help='require coverage to exceed all thresholds for '
+                       'overlapping regions in THRESHOLD_FILE')
+    group.add_argument('-p', dest='prefix', help='write BED files to '
+                       'PREFIX.STATIC_THRESHOLD.bed (required if -s is '
+                       'specified more than once)')
+    group.add_argument('-j', dest='processes', default=1, type=int,
+                       help='number of chromosomes to process in parallel '
+                       '(default: 1)')
     args = parser.parse_args()
-    if not (args.static_threshold or args.thresholds_file):
+    if not (args.static_thresholds or args.thresholds_file):
         parser.error('no threshold specified, add -s or -f')
-    main(args.wig_file, args.static_threshold, args.thresholds_file)
+    if args.static_thresholds and len(args.static_thresholds) > 1 \
+           and not args.prefix:
+        parser.error('multiple thresholds specified, add -p')
+    if args.wig_file == '-' and args.processes > 1:
+        parser.error('standard input cannot be processed in parallel')
+    main(args.wig_file, args.static_thresholds, args.thresholds_file,
+         args.require_all, args.prefix, args.processes)
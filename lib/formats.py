@@ -0,0 +1,349 @@
+"""
+Streaming parsers for the file formats used by the scripts in this repo.
+
+Lines are read in blocks of about BLOCK_SIZE bytes, and records are returned
+as tuples (namedtuple types), so per-record overhead is small. Files
+compressed with gzip or bgzip are detected by their first bytes and
+decompressed transparently, also when read from a pipe. The filename - stands
+for standard input or standard output.
+
+The parsers take an iterable of lines (such as a block from read_blocks, an
+open file, or the lines of a tabix query) and raise ValueError with a
+message describing the offending line if it cannot be interpreted.
+
+Scripts import this module after adding this directory to the module search
+path:
+
+  sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  os.pardir, 'lib'))
+  from formats import open_file, read_blocks
+
+Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+"""
+
+
+import os
+import sys
+import gzip
+import zlib
+import signal
+from collections import namedtuple
+
+
+# Approximate number of bytes to read at once
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# First bytes of a file compressed with gzip (or bgzip)
+GZIP_MAGIC = '\x1f\x8b'
+
+# Number of bytes to read at once from a pipe
+STREAM_BUFFER_SIZE = 256 * 1024
+
+
+FastqRecord = namedtuple('FastqRecord', 'header sequence plus quality')
+
+VcfRecord = namedtuple('VcfRecord', 'chrom pos id ref alt')
+
+BedRecord = namedtuple('BedRecord', 'chrom start end rest')
+
+PileupRecord = namedtuple('PileupRecord', 'chrom position coverages')
+
+
+def open_file(filename, mode='r'):
+    """
+    Open a file, decompressing it if it is compressed with gzip or bgzip.
+    Files to write are compressed with gzip if the filename ends in .gz.
+
+    The filename - opens standard input (decompressed if needed) or standard
+    output (never compressed).
+    """
+    if 'r' not in mode:
+        if filename == '-':
+            handle_broken_pipe()
+            return sys.stdout
+        if filename.endswith('.gz'):
+            return gzip.open(filename, mode)
+        return open(filename, mode)
+    if filename == '-':
+        return open_stream(sys.stdin)
+    handle = open(filename, 'rb')
+    magic = handle.read(len(GZIP_MAGIC))
+    if magic == GZIP_MAGIC:
+        handle.seek(0)
+        return gzip.GzipFile(fileobj=handle, mode='rb')
+    handle.seek(0)
+    return handle
+
+
+def close_file(filename, handle):
+    """
+    Close the open file {handle} opened with open_file for {filename}, or
+    only flush it if it is standard output, which may be written to again.
+    """
+    if filename == '-':
+        handle.flush()
+    else:
+        handle.close()
+
+
+def handle_broken_pipe():
+    """
+    Exit quietly when standard output is a pipe that is closed by the
+    reading process (such as head), instead of raising IOError.
+    """
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def open_stream(handle):
+    """
+    Return the open file {handle}, decompressed if it is compressed with
+    gzip or bgzip. If {handle} is a pipe, it is read through a StreamFile,
+    since it cannot be rewound after reading its first bytes.
+    """
+    try:
+        seekable = os.lseek(handle.fileno(), 0, os.SEEK_CUR) >= 0
+    except (AttributeError, OSError):
+        seekable = False
+    if seekable:
+        position = handle.tell()
+        magic = handle.read(len(GZIP_MAGIC))
+        handle.seek(position)
+        if magic == GZIP_MAGIC:
+            return gzip.GzipFile(fileobj=handle, mode='rb')
+        return handle
+    magic = handle.read(len(GZIP_MAGIC))
+    return StreamFile(handle, magic, decompress=magic == GZIP_MAGIC)
+
+
+class StreamFile(object):
+    """
+    Read-only file-like object over a pipe, starting with the bytes in
+    {prefix} that were already read from it. If {decompress} is True, the
+    data is decompressed as one or more concatenated gzip members (as in
+    bgzip files), which GzipFile cannot do without seeking.
+    """
+    def __init__(self, handle, prefix='', decompress=False):
+        self.handle = handle
+        self.prefix = prefix
+        self.decompressor = None
+        if decompress:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Add data to the buffer, return False if there is none left.
+        """
+        while not self.eof:
+            if self.prefix:
+                data, self.prefix = self.prefix, ''
+            else:
+                data = self.handle.read(STREAM_BUFFER_SIZE)
+            if not data:
+                self.eof = True
+                if self.decompressor:
+                    data = self.decompressor.flush()
+            elif self.decompressor:
+                data = self.decompressor.decompress(data)
+                while self.decompressor.unused_data:
+                    rest = self.decompressor.unused_data
+                    self.decompressor = zlib.decompressobj(
+                        16 + zlib.MAX_WBITS)
+                    data += self.decompressor.decompress(rest)
+            if data:
+                self.buffer = self.buffer[self.position:] + data
+                self.position = 0
+                return True
+        return False
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) - self.position < size) \
+                  and self._fill():
+            pass
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = self.buffer[self.position:end]
+        self.position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        start = self.position
+        while True:
+            end = self.buffer.find('\n', start)
+            if end >= 0:
+                end += 1
+                break
+            start = len(self.buffer) - self.position
+            if not self._fill():
+                end = len(self.buffer)
+                break
+            start = self.position + start
+        if size >= 0:
+            end = min(end, self.position + size)
+        line = self.buffer[self.position:end]
+        self.position = end
+        return line
+
+    def readlines(self, size=-1):
+        while size <= 0 or len(self.buffer) - self.position < size or \
+                  self.buffer.rfind('\n', self.position) < 0:
+            if not self._fill():
+                break
+        end = self.buffer.rfind('\n', self.position) + 1
+        if self.eof or not end:
+            end = len(self.buffer)
+        lines = self.buffer[self.position:end].splitlines(True)
+        self.position = end
+        return lines
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_blocks(lines, size=BLOCK_SIZE):
+    """
+    Generate lists of lines from {lines} of about {size} bytes. If {lines}
+    is an open file, whole blocks are read at once.
+    """
+    if hasattr(lines, 'readlines'):
+        for block in iter(lambda: lines.readlines(size), []):
+            yield block
+        return
+    block = []
+    total = 0
+    for line in lines:
+        block.append(line)
+        total += len(line)
+        if total >= size:
+            yield block
+            block = []
+            total = 0
+    if block:
+        yield block
+
+
+def iter_lines(lines, size=BLOCK_SIZE):
+    """
+    Generate the lines from {lines}, reading them in blocks of about {size}
+    bytes.
+    """
+    for block in read_blocks(lines, size):
+        for line in block:
+            yield line
+
+
+def read_fastq(lines):
+    """
+    Generate the records from FASTQ {lines} (four lines per record) as
+    FastqRecord tuples, without line endings.
+    """
+    pending = []
+    for block in read_blocks(lines):
+        if pending:
+            block = pending + block
+        end = len(block) - len(block) % 4
+        for i in xrange(0, end, 4):
+            yield FastqRecord(block[i].rstrip(), block[i + 1].rstrip(),
+                              block[i + 2].rstrip(), block[i + 3].rstrip())
+        pending = block[end:]
+    if any(line.strip() for line in pending):
+        raise ValueError('Incomplete record in FASTQ file: %s'
+                         % pending[0].rstrip())
+
+
+def parse_vcf(lines):
+    """
+    Generate the records from VCF {lines} as VcfRecord tuples with the
+    position as integer, skipping header lines. Only the first five fields
+    are split.
+    """
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        parts = line.split(None, 5)
+        if len(parts) < 5:
+            raise ValueError('Could not interpret line: %s' % line)
+        try:
+            position = int(parts[1])
+        except ValueError:
+            raise ValueError('Could not read position: %s' % line)
+        yield VcfRecord(parts[0], position, parts[2], parts[3], parts[4])
+
+
+def parse_bed(lines):
+    """
+    Generate the regions from BED {lines} as BedRecord tuples with integer
+    start and end, and the remaining fields unsplit as rest. Track, browser,
+    comment, and empty lines are skipped.
+    """
+    for line in lines:
+        parts = line.split(None, 3)
+        if not parts or parts[0] in ('track', 'browser') or \
+               parts[0].startswith('#'):
+            continue
+        try:
+            yield BedRecord(parts[0], int(parts[1]), int(parts[2]),
+                            parts[3] if len(parts) > 3 else '')
+        except (IndexError, ValueError):
+            raise ValueError('Invalid line in BED file: "%s"' % line)
+
+
+def parse_pileup(lines, multi_sample=False):
+    """
+    Generate the positions from pileup {lines} as PileupRecord tuples with
+    integer position and a list of coverages. If {multi_sample} is True, the
+    lines are read as created by samtools mpileup, with three columns per
+    sample. Lines are split on tabs, as the base and quality columns of a
+    sample without coverage are empty.
+    """
+    for line in lines:
+        parts = line.rstrip('\n').split('\t')
+        try:
+            if multi_sample:
+                coverages = map(int, parts[3::3])
+            else:
+                coverages = [int(parts[3])]
+            yield PileupRecord(parts[0], int(parts[1]), coverages)
+        except IndexError:
+            raise ValueError('No coverage in line: %s' % line)
+        except ValueError:
+            raise ValueError('Cannot read coverage: %s' % line)
+
+
+def parse_wig_definition(line):
+    """
+    Parse a Wiggle 'variableStep' or 'fixedStep' definition line and return
+    it as a dictionary with 'chrom', 'start', 'step', and 'span' fields. For
+    'variableStep', the 'start' and 'step' fields are None.
+    """
+    fields = line.split()
+    arguments = dict(field.split('=', 1) for field in fields[1:]
+                     if '=' in field)
+    try:
+        section = {'chrom': arguments['chrom'],
+                   'span':  int(arguments.get('span', 1)),
+                   'start': None,
+                   'step':  None}
+        if fields[0] == 'fixedStep':
+            section.update(start=int(arguments['start']),
+                           step=int(arguments.get('step', 1)))
+    except (KeyError, ValueError):
+        raise ValueError('Error interpreting line: %s' % line)
+    return section
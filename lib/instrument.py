@@ -0,0 +1,393 @@
+"""
+Optional statistics and profiling for the scripts in this repo.
+
+With --stats, a script reports on standard error how long it spent in each
+phase of its work (such as reading, decompressing, parsing, pysam iteration,
+and writing), the number of records processed, the bytes in and out, the
+throughput, and its peak memory use. While running, a progress line is
+written every PROGRESS_INTERVAL seconds. With --profile FILE, the script is
+run under cProfile [1] and the profile is written to FILE, to be inspected
+with pstats.
+
+Phases are timed exclusively: time spent in a nested phase (reading the file
+a parser is consuming) is not counted for the outer phase. Time not spent in
+any phase is reported as other, which usually is the processing done by the
+script itself.
+
+The instrumentation is set up once per process. Without --stats, the
+wrapping functions return their argument unchanged, so there is no overhead:
+
+  parser = argparse.ArgumentParser(...)
+  instrument.add_arguments(parser)
+  args = parser.parse_args()
+  instrument.configure(args)
+  instrument.run(main, ...)
+
+In main:
+
+  instrument.add_input(bam_file)
+  for read in instrument.timed(bam, 'pysam'):
+      ...
+
+[1] http://docs.python.org/library/profile.html
+
+Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+"""
+
+
+from __future__ import division
+
+import os
+import sys
+import gzip
+import time
+import resource
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+# Number of seconds between progress lines
+PROGRESS_INTERVAL = 10
+
+# Number of records between checks for writing a progress line
+PROGRESS_RECORDS = 10000
+
+# Instrumentation state for this process
+_state = {'enabled': False,
+          'profile_file': None,
+          'name': os.path.basename(sys.argv[0]),
+          'start': None,
+          'progress': None,
+          'records': 0,
+          'inputs': [],
+          'outputs': [],
+          'bytes_out': 0}
+
+# Exclusive time per phase
+_times = defaultdict(float)
+
+# Active phases as lists [phase, start, time in nested phases]
+_stack = []
+
+
+def add_arguments(parser):
+    """
+    Add the --stats and --profile arguments to an argparse {parser}.
+    """
+    parser.add_argument('--stats', dest='stats', action='store_true',
+                        help='report time per phase, throughput, and memory '
+                        'use on standard error')
+    parser.add_argument('--profile', dest='profile_file', metavar='FILE',
+                        help='write a cProfile profile to FILE')
+
+
+def strip_arguments(arguments):
+    """
+    Remove the --stats and --profile FILE arguments from the list
+    {arguments}, configure the instrumentation with them, and return the
+    remaining arguments. This is for scripts not using argparse.
+    """
+    remaining = []
+    stats = False
+    profile_file = None
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument == '--stats':
+            stats = True
+        elif argument == '--profile':
+            profile_file = next(arguments, None)
+            if not profile_file:
+                sys.stderr.write('Argument --profile requires a FILE.\n')
+                sys.exit(1)
+        elif argument.startswith('--profile='):
+            profile_file = argument.split('=', 1)[1]
+        else:
+            remaining.append(argument)
+    configure(stats=stats, profile_file=profile_file)
+    return remaining
+
+
+def configure(args=None, stats=False, profile_file=None):
+    """
+    Enable statistics and profiling as given by the parsed arguments {args}
+    (see add_arguments), or by {stats} and {profile_file}.
+    """
+    if args is not None:
+        stats, profile_file = args.stats, args.profile_file
+    _state['enabled'] = stats
+    _state['profile_file'] = profile_file
+    _state['start'] = time.time()
+    _state['progress'] = _state['start'] + PROGRESS_INTERVAL
+
+
+def enabled():
+    """
+    Return True if statistics are enabled.
+    """
+    return _state['enabled']
+
+
+def run(function, *args, **kwargs):
+    """
+    Call {function} with {args} and {kwargs}, under cProfile if a profile
+    file is configured, and report statistics if enabled. Return the result
+    of {function}.
+    """
+    if _state['start'] is None:
+        configure()
+    profile_file = _state['profile_file']
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            result = profiler.runcall(function, *args, **kwargs)
+        finally:
+            profiler.dump_stats(profile_file)
+    else:
+        result = function(*args, **kwargs)
+    if _state['enabled']:
+        report()
+    return result
+
+
+def add_input(filename):
+    """
+    Count the size of {filename} as bytes in.
+    """
+    _state['inputs'].append(filename)
+
+
+def add_output(filename):
+    """
+    Count the size of {filename} as bytes out when reporting, unless bytes
+    are counted by timed_writer.
+    """
+    _state['outputs'].append(filename)
+
+
+def add_records(records=1):
+    """
+    Count {records} as processed and write a progress line if due.
+    """
+    if not _state['enabled']:
+        return
+    _state['records'] += records
+    if time.time() >= _state['progress']:
+        progress()
+
+
+def begin(phase):
+    """
+    Start timing {phase}. Prefer the phase context manager or the wrapping
+    functions.
+    """
+    _stack.append([phase, time.time(), 0.0])
+
+
+def end():
+    """
+    Stop timing the most recently started phase.
+    """
+    phase, start, nested = _stack.pop()
+    elapsed = time.time() - start
+    _times[phase] += elapsed - nested
+    if _stack:
+        _stack[-1][2] += elapsed
+
+
+@contextmanager
+def phase(name):
+    """
+    Context manager timing the enclosed code as phase {name}.
+    """
+    if not _state['enabled']:
+        yield
+        return
+    begin(name)
+    try:
+        yield
+    finally:
+        end()
+
+
+def timed(iterable, phase, records=True):
+    """
+    Return an iterator over {iterable} that times getting every item as
+    {phase}. If {records} is True, every item is counted as a record.
+    """
+    if not _state['enabled']:
+        return iterable
+    return _timed(iter(iterable), phase, records)
+
+
+def _timed(iterator, phase, records):
+    clock = time.time
+    count = 0
+    while True:
+        _stack.append([phase, clock(), 0.0])
+        try:
+            item = next(iterator)
+        except StopIteration:
+            end()
+            break
+        except:
+            end()
+            raise
+        end()
+        if records:
+            count += 1
+            if count == PROGRESS_RECORDS:
+                add_records(count)
+                count = 0
+        yield item
+    if count:
+        add_records(count)
+
+
+def timed_reader(handle, phase='read'):
+    """
+    Return a wrapper around the open file {handle} timing its reads as
+    {phase}. For a file opened with gzip, reading the compressed data is
+    timed as {phase} and decompressing it as 'decompress'.
+    """
+    if not _state['enabled']:
+        return handle
+    if isinstance(handle, gzip.GzipFile):
+        handle.fileobj = TimedFile(handle.fileobj, phase)
+        return TimedFile(handle, 'decompress')
+    return TimedFile(handle, phase)
+
+
+def timed_writer(handle, phase='write'):
+    """
+    Return a wrapper around the open file {handle} timing its writes as
+    {phase} and counting the bytes written as bytes out. For a file opened
+    with gzip, writing the compressed data is timed as {phase} and
+    compressing it as 'compress'.
+    """
+    if not _state['enabled']:
+        return handle
+    if isinstance(handle, gzip.GzipFile):
+        handle.fileobj = TimedFile(handle.fileobj, phase)
+        return TimedFile(handle, 'compress', count_bytes=True)
+    return TimedFile(handle, phase, count_bytes=True)
+
+
+class TimedFile(object):
+    """
+    File-like wrapper timing the read and write methods of an open file.
+    Other attributes are those of the wrapped file.
+    """
+    def __init__(self, handle, phase, count_bytes=False):
+        self.handle = handle
+        self.phase = phase
+        self.count_bytes = count_bytes
+
+    def _call(self, method, *args):
+        begin(self.phase)
+        try:
+            return getattr(self.handle, method)(*args)
+        finally:
+            end()
+
+    def read(self, *args):
+        return self._call('read', *args)
+
+    def readline(self, *args):
+        return self._call('readline', *args)
+
+    def readlines(self, *args):
+        return self._call('readlines', *args)
+
+    def next(self):
+        return self._call('next')
+
+    def __iter__(self):
+        return self
+
+    def write(self, data):
+        if self.count_bytes:
+            _state['bytes_out'] += len(data)
+        return self._call('write', data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.handle.close()
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+
+def bytes_in():
+    """
+    Return the summed size of the input files.
+    """
+    return sum(os.path.getsize(f) for f in _state['inputs']
+               if os.path.isfile(f))
+
+
+def bytes_out():
+    """
+    Return the number of bytes written through timed_writer (before any
+    compression), or the summed size of the output files if there are none.
+    Output files may not be completely written yet when reporting.
+    """
+    if _state['bytes_out']:
+        return _state['bytes_out']
+    return sum(os.path.getsize(f) for f in _state['outputs']
+               if os.path.isfile(f))
+
+
+def peak_memory():
+    """
+    Return the peak resident set size of this process and its waited-for
+    children in megabytes (ru_maxrss is in kilobytes on Linux).
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def progress():
+    """
+    Write a progress line to standard error.
+    """
+    now = time.time()
+    elapsed = max(now - _state['start'], 1e-6)
+    _state['progress'] = now + PROGRESS_INTERVAL
+    sys.stderr.write('%s: %.0fs, %d records (%.0f/s), peak memory %.1f MB\n'
+                     % (_state['name'], elapsed, _state['records'],
+                        _state['records'] / elapsed, peak_memory()))
+
+
+def report():
+    """
+    Write the statistics to standard error.
+    """
+    elapsed = max(time.time() - _state['start'], 1e-6)
+    megabytes_in = bytes_in() / 1024 / 1024
+    megabytes_out = bytes_out() / 1024 / 1024
+    lines = ['Statistics for %s:' % _state['name'],
+             '  %-16s %10.2f s' % ('Elapsed:', elapsed)]
+    for name in sorted(_times, key=_times.get, reverse=True):
+        lines.append('  %-16s %10.2f s (%4.1f%%)'
+                     % (name + ':', _times[name],
+                        _times[name] / elapsed * 100))
+    other = elapsed - sum(_times.values())
+    lines += ['  %-16s %10.2f s (%4.1f%%)'
+              % ('other:', other, other / elapsed * 100),
+              '  %-16s %10d (%.0f/s)'
+              % ('Records:', _state['records'],
+                 _state['records'] / elapsed),
+              '  %-16s %10.1f MB (%.1f MB/s)'
+              % ('Bytes in:', megabytes_in, megabytes_in / elapsed),
+              '  %-16s %10.1f MB (%.1f MB/s)'
+              % ('Bytes out:', megabytes_out, megabytes_out / elapsed),
+              '  %-16s %10.1f MB' % ('Peak memory:', peak_memory())]
+    sys.stderr.write('\n'.join(lines) + '\n')
@@ -0,0 +1,45 @@
+"""
+Tests for formats.py.
+
+Run from this directory with:
+
+  python -m unittest discover
+
+Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+"""
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from formats import parse_pileup
+
+
+class TestParsePileup(unittest.TestCase):
+    """
+    Read positions from pileup lines.
+    """
+    def test_single_sample(self):
+        records = list(parse_pileup(['chr1\t5\tA\t3\t..,\tIII\n']))
+        self.assertEqual(records, [('chr1', 5, [3])])
+
+    def test_multi_sample(self):
+        records = list(parse_pileup(['chr1\t5\tA\t2\t..\tII\t1\t,\tI\n'],
+                                    multi_sample=True))
+        self.assertEqual(records, [('chr1', 5, [2, 1])])
+
+    def test_multi_sample_no_coverage(self):
+        """
+        A sample without coverage has empty base and quality columns.
+        """
+        records = list(parse_pileup(['chr1\t5\tA\t2\t..\tII\t0\t\t\t'
+                                     '1\t,\tI\n'], multi_sample=True))
+        self.assertEqual(records, [('chr1', 5, [2, 0, 1])])
+
+    def test_no_coverage(self):
+        self.assertRaises(ValueError, list, parse_pileup(['chr1\t5\tA\n']))
@@ -4,25 +4,84 @@
 #
 # Usage:
 #   ./filter_cds.py converted.result
+#   ./filter_cds.py -a refGene.txt sample.hgvs
+#
+# Without -a, the input is the result of the Mutalyzer batch position
+# converter and all HGVS descriptions on coding transcripts (NM_) that lie
+# completely in the CDS are printed.
+#
+# With -a, the position conversion is done locally instead, using a RefSeq
+# transcript annotation in UCSC genePred format (such as refGene.txt, with or
+# without bin column) or in GFF3 format (if the filename ends in .gff or
+# .gff3). The input is then either the output of vcf_to_hgvs.py (genomic HGVS
+# descriptions) or a VCF file. For every variant in the CDS of a coding
+# transcript (NM_), its description on that transcript is printed. The
+# transcripts are indexed per chromosome, so no network access is needed.
+# Variants that cannot be described on a transcript (such as symbolic,
+# spanning, or IUPAC alleles) are skipped with a warning on standard error.
+#
+# Files compressed with gzip or bgzip are detected automatically. The input is
+# read from standard input if its filename is -, so the output of
+# vcf_to_hgvs.py can be piped in directly:
+#
+#   ./vcf_to_hgvs.py sample.vcf.gz | ./filter_cds.py -a refGene.txt.gz -
 #
 # Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
 # Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 
 
+import os
 import sys
+import re
+from bisect import bisect_right
+from collections import defaultdict
+
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import handle_broken_pipe, open_file
+from vcf_to_hgvs import convert_block
+
+
+# DNA base complements
+COMPLEMENT = {'A': 'T',
+              'T': 'A',
+              'C': 'G',
+              'G': 'C',
+              'N': 'N'}
+
+# Genomic HGVS description as written by vcf_to_hgvs.py
+GENOMIC_DESCRIPTION = re.compile(
+    r'^(?P<chromosome>[^:]+):g\.(?P<first>\d+)(_(?P<last>\d+))?'
+    r'(?P<change>([ACGTN]>[ACGTN])|dup|del(?P<deleted>[ACGTN]*)'
+    r'(ins(?P<inserted>[ACGTN]+))?|ins(?P<insertion>[ACGTN]+))$')
 
 
-def main(result_file):
+def main(result_file, annotation_file=None):
     """
     Read lines from position converter result file and print HGVS
     descriptions for variants in CDS.
+
+    If {annotation_file} is given, read genomic HGVS descriptions or VCF
+    lines instead and convert them to coding HGVS descriptions using the
+    transcripts in {annotation_file}.
     """
     try:
-        result = open(result_file, 'r')
+        result = open_file(result_file)
     except IOError as (_, message):
         print 'Could not read result file: %s' % result_file
         sys.exit(1)
 
+    if annotation_file:
+        try:
+            transcripts = read_transcripts(annotation_file)
+        except IOError as (_, message):
+            print 'Could not read annotation file: %s' % annotation_file
+            sys.exit(1)
+        convert_variants(result, transcripts)
+        return
+
     while True:
         line = result.readline()
         if not line:
@@ -37,11 +96,259 @@ def main(result_file):
                 print part
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print """Filter position converter results to keep only variants in CDS.
+def convert_variants(lines, transcripts):
+    """
+    Print coding HGVS descriptions for the genomic HGVS descriptions or VCF
+    lines in {lines}.
+    """
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
 
-Usage:
-  {command} converted.result""".format(command=sys.argv[0])
-        sys.exit(1)
-    main(sys.argv[1])
+        if ':g.' in line:
+            descriptions = line.split()
+        else:
+            try:
+                descriptions = convert_block([line]).split()
+            except ValueError as error:
+                print error
+                sys.exit(1)
+
+        for description in descriptions:
+            match = GENOMIC_DESCRIPTION.match(description)
+            if not match:
+                # Such as symbolic (<DEL>), spanning (*), or IUPAC alleles.
+                print >>sys.stderr, ('Could not interpret description, '
+                                     'skipping: %s' % description)
+                continue
+            for coding in coding_descriptions(transcripts, match):
+                print coding
+
+
+def coding_descriptions(transcripts, match):
+    """
+    Generate coding HGVS descriptions on all transcripts in {transcripts} for
+    the genomic description in {match} (a GENOMIC_DESCRIPTION match), if it
+    lies completely in their CDS.
+    """
+    first = int(match.group('first'))
+    last = int(match.group('last') or first)
+    chromosome = match.group('chromosome')
+
+    for transcript in overlapping_transcripts(transcripts, chromosome,
+                                              first - 1):
+        name, strand, coding_exons, coding_length = transcript
+
+        first_coding = coding_position(transcript, first - 1)
+        last_coding = coding_position(transcript, last - 1)
+        if first_coding is None or last_coding is None:
+            continue
+
+        change = match.group('change')
+        if strand == '-':
+            first_coding, last_coding = last_coding, first_coding
+            change = reverse_change(match)
+
+        if first_coding == last_coding:
+            position = '%d' % first_coding
+        else:
+            position = '%d_%d' % (first_coding, last_coding)
+
+        yield '%s:c.%s%s' % (name, position, change)
+
+
+def reverse_change(match):
+    """
+    Return the change in the genomic description in {match} (a
+    GENOMIC_DESCRIPTION match) for the reverse strand.
+    """
+    change = match.group('change')
+    if '>' in change:
+        return '%s>%s' % (COMPLEMENT[change[0]], COMPLEMENT[change[2]])
+    if change == 'dup':
+        return change
+    if match.group('insertion'):
+        return 'ins%s' % reverse_complement(match.group('insertion'))
+    change = 'del%s' % reverse_complement(match.group('deleted'))
+    if match.group('inserted'):
+        change += 'ins%s' % reverse_complement(match.group('inserted'))
+    return change
+
+
+def coding_position(transcript, position):
+    """
+    Return the position in the CDS of {transcript} (one-based, starting at
+    the start codon) for zero-based genomic {position}, or None if it is not
+    in the CDS.
+    """
+    name, strand, coding_exons, coding_length = transcript
+    offset = 0
+    for start, end in coding_exons:
+        if start <= position < end:
+            offset += position - start
+            if strand == '-':
+                return coding_length - offset
+            return offset + 1
+        offset += end - start
+    return None
+
+
+def overlapping_transcripts(transcripts, chromosome, position):
+    """
+    Generate transcripts from the index {transcripts} whose CDS contains
+    zero-based genomic {position} on {chromosome}.
+    """
+    for name in chromosome_names(chromosome):
+        if name in transcripts:
+            starts, ends, records, max_length = transcripts[name]
+            i = bisect_right(starts, position) - 1
+            while i >= 0 and starts[i] > position - max_length:
+                if ends[i] > position:
+                    yield records[i]
+                i -= 1
+            return
+
+
+def chromosome_names(chromosome):
+    """
+    Return possible names for {chromosome}, with and without 'chr' prefix.
+    """
+    if chromosome.startswith('chr'):
+        return [chromosome, chromosome[3:]]
+    return [chromosome, 'chr' + chromosome]
+
+
+def read_transcripts(annotation_file):
+    """
+    Read coding transcripts (NM_) from a genePred or GFF3 file and index
+    them per chromosome by CDS start.
+
+    Return a dictionary with per chromosome a tuple (starts, ends, records,
+    max_length), where starts and ends are the sorted CDS starts and the
+    corresponding CDS ends, records are tuples (name, strand, coding_exons,
+    coding_length) and max_length is the maximum CDS length. Coding exons
+    are the (start, end) parts of exons in the CDS. All positions are
+    zero-based and open-ended.
+    """
+    name = annotation_file
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.gff') or name.endswith('.gff3'):
+        transcripts = read_gff(annotation_file)
+    else:
+        transcripts = read_genepred(annotation_file)
+
+    by_chromosome = defaultdict(list)
+    for name, chromosome, strand, exons, cds_start, cds_end in transcripts:
+        if not name.startswith('NM_') or cds_start >= cds_end:
+            continue
+        coding_exons = [(max(start, cds_start), min(end, cds_end))
+                        for start, end in sorted(exons)
+                        if start < cds_end and end > cds_start]
+        coding_length = sum(end - start for start, end in coding_exons)
+        by_chromosome[chromosome].append(
+            (cds_start, cds_end, (name, strand, coding_exons, coding_length)))
+
+    index = {}
+    for chromosome, records in by_chromosome.items():
+        records.sort()
+        index[chromosome] = ([start for start, _, _ in records],
+                             [end for _, end, _ in records],
+                             [record for _, _, record in records],
+                             max(end - start for start, end, _ in records))
+    return index
+
+
+def read_genepred(annotation_file):
+    """
+    Generate transcripts as tuples (name, chromosome, strand, exons,
+    cds_start, cds_end) from a file in genePred format, with or without
+    leading bin column.
+    """
+    with open_file(annotation_file) as annotation:
+        for line in annotation:
+            if line.startswith('#'):
+                continue
+            parts = line.rstrip('\n').split('\t')
+            if parts[0].isdigit():
+                parts = parts[1:]
+            try:
+                name, chromosome, strand = parts[:3]
+                cds_start, cds_end = int(parts[5]), int(parts[6])
+                starts = [int(p) for p in parts[8].split(',') if p]
+                ends = [int(p) for p in parts[9].split(',') if p]
+            except (IndexError, ValueError):
+                print 'Invalid line in genePred file: "%s"' % line
+                sys.exit(1)
+            yield (name, chromosome, strand, zip(starts, ends), cds_start,
+                   cds_end)
+
+
+def read_gff(annotation_file):
+    """
+    Generate transcripts as tuples (name, chromosome, strand, exons,
+    cds_start, cds_end) from a file in GFF3 format, using the mRNA, exon,
+    and CDS features.
+    """
+    transcripts = {}
+    exons = defaultdict(list)
+    cds = defaultdict(list)
+
+    with open_file(annotation_file) as annotation:
+        for line in annotation:
+            if line.startswith('#'):
+                continue
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < 9:
+                continue
+            feature = parts[2]
+            if feature not in ('mRNA', 'exon', 'CDS'):
+                continue
+            try:
+                start, end = int(parts[3]) - 1, int(parts[4])
+            except ValueError:
+                print 'Invalid line in GFF3 file: "%s"' % line
+                sys.exit(1)
+            attributes = dict(field.split('=', 1)
+                              for field in parts[8].split(';')
+                              if '=' in field)
+            if feature == 'mRNA':
+                name = attributes.get('transcript_id',
+                                      attributes.get('Name', ''))
+                transcripts[attributes.get('ID')] = name, parts[0], parts[6]
+            else:
+                for parent in attributes.get('Parent', '').split(','):
+                    if feature == 'exon':
+                        exons[parent].append( (start, end) )
+                    else:
+                        cds[parent].append( (start, end) )
+
+    for identifier, (name, chromosome, strand) in transcripts.items():
+        if identifier not in cds:
+            continue
+        yield (name, chromosome, strand, exons[identifier] or cds[identifier],
+               min(start for start, _ in cds[identifier]),
+               max(end for _, end in cds[identifier]))
+
+
+def reverse_complement(sequence):
+    """
+    Return reverse complement of DNA sequence.
+    """
+    return ''.join(COMPLEMENT[b] for b in sequence[::-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""
+Filter position converter results to keep only variants in CDS, or convert
+genomic variants to variants in CDS locally using a transcript annotation.""")
+    parser.add_argument('result_file', metavar='INPUT_FILE',
+                        help='position converter result file, or genomic '
+                        'HGVS descriptions or VCF file if -a is specified '
+                        '(- for standard input)')
+    parser.add_argument('-a', dest='annotation_file',
+                        metavar='ANNOTATION_FILE', help='RefSeq transcripts '
+                        'in genePred or GFF3 format')
+    args = parser.parse_args()
+    handle_broken_pipe()
+    main(args.result_file, args.annotation_file)
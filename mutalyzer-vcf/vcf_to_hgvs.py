@@ -3,76 +3,436 @@
 # Create HGVS descriptions from a VCF file.
 #
 # Usage:
-#   ./vcf_to_hgvs.py sample.vcf
+#   ./vcf_to_hgvs.py [-j processes] [-r reference.fa] sample.vcf
+#   ./vcf_to_hgvs.py [-l chr1:1000-2000] [-b regions.bed] sample.vcf.gz
 #
 # The VCF file must be in VCFv4.1 format (as created by Samtools 0.1.16
-# for example).
+# for example). It can be compressed with gzip or bgzip (detected
+# automatically) or read from standard input (if the filename is -).
+#
+# The VCF file is read in blocks of lines, of which only the leading fields
+# are split, and output is written per block. With -j, blocks are converted
+# by that many worker processes while keeping the output in order.
+#
+# By default, every variant that is not a substitution is described as a
+# deletion-insertion of REF by ALT. With -r, variants are normalized against
+# a reference sequence in FASTA format instead: common prefixes and suffixes
+# of REF and ALT are trimmed and indels are shifted to their most 3' position
+# (as required by the HGVS recommendations [1]), resulting in del, ins, dup,
+# and delins descriptions. The FASTA file must be indexed with samtools faidx
+# and is read through a memory map, keeping the most recently used windows of
+# the reference sequence in a cache.
+#
+# With -l or -b, only variants in the given regions are converted. The VCF
+# file must then be compressed with bgzip and indexed with tabix [2], and only
+# the blocks overlapping the regions are read (requires pysam [3]).
+# Overlapping regions are merged first, so no variant is converted twice.
+#
+# [1] http://www.hgvs.org/mutnomen/
+# [2] http://samtools.sourceforge.net/tabix.shtml
+# [3] http://code.google.com/p/pysam/
 #
 # Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
 # Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 
 
+import os
 import sys
+import mmap
+import multiprocessing
+from collections import OrderedDict, defaultdict
+from functools import partial
+
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import handle_broken_pipe, open_file, parse_bed, parse_vcf, \
+     read_blocks
 
 
-def main(vcf_file):
+# Size of reference sequence windows read at once
+WINDOW_SIZE = 4096
+
+# Maximum number of reference sequence windows to keep in the cache
+CACHE_SIZE = 1024
+
+# Opened reference sequences per FASTA file (in each worker process)
+_references = {}
+
+
+def main(vcf_file, processes=1, reference_file=None, regions=None):
     """
     Read lines from VCF file and print HGVS descriptions.
+
+    If {reference_file} is given, variants are normalized against this
+    reference sequence in FASTA format.
+
+    If {regions} is given as a list of tuples (chromosome, start, end) with
+    zero-based open-ended positions, only variants overlapping these regions
+    are read from the VCF file, which must be indexed with tabix.
     """
+    if regions is not None:
+        vcf = read_regions(open_indexed(vcf_file), regions)
+    else:
+        try:
+            vcf = open_file(vcf_file)
+        except IOError as (_, message):
+            print 'Could not read VCF file: %s' % vcf_file
+            sys.exit(1)
+
+    if reference_file:
+        try:
+            get_reference(reference_file)
+        except (IOError, ValueError):
+            print 'Could not read reference file: %s' % reference_file
+            sys.exit(1)
+
+    blocks = read_blocks(vcf)
+    convert = partial(convert_block, reference_file=reference_file)
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        converted = pool.imap(convert, blocks)
+    else:
+        converted = (convert(block) for block in blocks)
+
     try:
-        vcf = open(vcf_file, 'r')
-    except IOError as (_, message):
-        print 'Could not read VCF file: %s' % vcf_file
+        for output in converted:
+            sys.stdout.write(output)
+    except ValueError as error:
+        print error
+        if processes > 1:
+            pool.terminate()
         sys.exit(1)
 
-    while True:
-        line = vcf.readline()
-        if not line:
-            break
+    if processes > 1:
+        pool.close()
+        pool.join()
+
+
+def open_indexed(vcf_file):
+    """
+    Open a VCF file compressed with bgzip and indexed with tabix.
+    """
+    try:
+        import pysam
+    except ImportError:
+        print 'Region queries require the pysam Python module.'
+        sys.exit(1)
 
-        if line.startswith('#'):
-            continue
+    try:
+        return pysam.Tabixfile(vcf_file)
+    except IOError:
+        print 'Could not read indexed VCF file: %s' % vcf_file
+        sys.exit(1)
 
-        parts = line.split()
 
-        if len(parts) < 5:
-            print 'Could not interpret line: %s' % line
-            sys.exit(1)
+def read_regions(vcf, regions):
+    """
+    Generate the lines from an open VCF file indexed with tabix that overlap
+    {regions}, a list of tuples (chromosome, start, end) with zero-based
+    open-ended positions (end can be None for the end of the chromosome).
+
+    Overlapping and adjacent regions are merged and visited in the order of
+    the chromosomes in the index, so that every line is generated once.
+    """
+    by_chromosome = defaultdict(list)
+    for chromosome, start, end in regions:
+        by_chromosome[chromosome].append(
+            (start, end if end is not None else sys.maxint))
+
+    try:
+        for chromosome in vcf.contigs:
+            merged = []
+            for start, end in sorted(by_chromosome[chromosome]):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(end, merged[-1][1])
+                else:
+                    merged.append([start, end])
+
+            # A variant overlapping two regions is only generated for the
+            # first of them.
+            previous_end = None
+            for start, end in merged:
+                for line in vcf.fetch(chromosome, start,
+                                      None if end == sys.maxint else end):
+                    if previous_end is not None and \
+                           int(line.split(None, 2)[1]) - 1 < previous_end:
+                        continue
+                    yield line + '\n'
+                previous_end = end
+    finally:
+        vcf.close()
 
+
+def read_regions_file(regions_file):
+    """
+    Read regions from a BED file as a list of tuples (chromosome, start,
+    end).
+    """
+    with open_file(regions_file) as bed:
         try:
-            chromosome = 'chr%d' % int(parts[0])
-        except ValueError:
-            chromosome = parts[0]
+            return [(chromosome, start, end)
+                    for chromosome, start, end, _ in parse_bed(bed)]
+        except ValueError as error:
+            print error
+            sys.exit(1)
+
 
+def parse_region(region):
+    """
+    Parse a region string chromosome:first-last (one-based, or just
+    chromosome) and return it as a tuple (chromosome, start, end) with
+    zero-based open-ended positions, or None if it is not such a string.
+    """
+    if ':' not in region:
+        return region, 0, None
+    try:
+        chromosome, positions = region.rsplit(':', 1)
+        first, last = positions.replace(',', '').split('-')
+        return chromosome, int(first) - 1, int(last)
+    except ValueError:
+        return None
+
+
+def convert_block(lines, reference_file=None):
+    """
+    Convert a list of VCF lines to HGVS descriptions and return them as one
+    string. Raise ValueError if a line cannot be interpreted.
+
+    If {reference_file} is given, variants are normalized against this
+    reference sequence in FASTA format.
+    """
+    if reference_file:
+        genome = get_reference(reference_file)
+
+    descriptions = []
+
+    for record in parse_vcf(lines):
         try:
-            position = int(parts[1])
-        except:
-            print 'Could not read position: %s' % line
+            chromosome = 'chr%d' % int(record.chrom)
+        except ValueError:
+            chromosome = record.chrom
 
-        reference = parts[3].upper()
-        alternates = parts[4].upper()
+        position = record.pos
+        reference = record.ref.upper()
+        alternates = record.alt.upper()
 
         for alternate in alternates.split(','):
 
-            if len(reference) == len(alternate) == 1:
+            if reference_file:
+                description = describe(genome, record.chrom, position,
+                                       reference, alternate)
+                if description:
+                    descriptions.append('%s:g.%s\n' %
+                                        (chromosome, description))
+            elif len(reference) == len(alternate) == 1:
                 # SNP
-                print '%s:g.%d%s>%s' % \
-                      (chromosome, position, reference, alternate)
+                descriptions.append('%s:g.%d%s>%s\n' %
+                                    (chromosome, position, reference,
+                                     alternate))
             else:
                 # Consider this an indel
-                print '%s:g.%d_%ddel%sins%s' % \
-                      (chromosome, position, position + len(reference) - 1,
-                       reference, alternate)
+                descriptions.append('%s:g.%d_%ddel%sins%s\n' %
+                                    (chromosome, position,
+                                     position + len(reference) - 1,
+                                     reference, alternate))
 
+    return ''.join(descriptions)
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print """Create HGVS descriptions from a VCF file.
 
-Usage:
-  {command} sample.vcf
+def get_reference(reference_file):
+    """
+    Return a function fetch(chromosome, start, end) for the reference
+    sequence in {reference_file}, opening it only once per process.
+    """
+    if reference_file not in _references:
+        _references[reference_file] = open_reference(reference_file)
+    return _references[reference_file]
 
-The VCF file must be in VCFv4.1 format (as created by Samtools 0.1.16
-for example).""".format(command=sys.argv[0])
-        sys.exit(1)
-    main(sys.argv[1])
+
+def open_reference(reference_file):
+    """
+    Open a reference sequence in FASTA format indexed with samtools faidx
+    as a memory map. Return a function fetch(chromosome, start, end) that
+    returns the upper case sequence from zero-based position start up to
+    end on chromosome, or None if chromosome is not in the reference. The
+    sequence is shorter than requested at the end of the chromosome.
+
+    The sequence is read in windows of WINDOW_SIZE bases, of which the
+    CACHE_SIZE most recently used are kept.
+    """
+    index = {}
+    with open(reference_file + '.fai', 'r') as fai:
+        for line in fai:
+            name, length, offset, line_bases, line_width = line.split()[:5]
+            index[name] = (int(length), int(offset), int(line_bases),
+                           int(line_width))
+
+    with open(reference_file, 'rb') as fasta:
+        data = mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ)
+
+    cache = OrderedDict()
+
+    def read_window(name, window):
+        key = name, window
+        try:
+            sequence = cache.pop(key)
+        except KeyError:
+            length, offset, line_bases, line_width = index[name]
+            start = window * WINDOW_SIZE
+            end = min(start + WINDOW_SIZE, length)
+            byte_start = offset + start // line_bases * line_width + \
+                         start % line_bases
+            byte_end = offset + (end - 1) // line_bases * line_width + \
+                       (end - 1) % line_bases + 1
+            sequence = data[byte_start:byte_end].translate(None, '\r\n')
+            sequence = sequence.upper()
+            if len(cache) >= CACHE_SIZE:
+                cache.popitem(last=False)
+        cache[key] = sequence
+        return sequence
+
+    def fetch(name, start, end):
+        if name not in index:
+            return None
+        start = max(start, 0)
+        end = min(end, index[name][0])
+        if start >= end:
+            return ''
+        first = start // WINDOW_SIZE
+        last = (end - 1) // WINDOW_SIZE
+        sequence = ''.join(read_window(name, window)
+                           for window in range(first, last + 1))
+        return sequence[start - first * WINDOW_SIZE:end - first * WINDOW_SIZE]
+
+    return fetch
+
+
+def describe(genome, chromosome, position, reference, alternate):
+    """
+    Normalize a variant at {position} (one-based) on {chromosome} in the
+    reference sequence fetched with {genome} and return its HGVS description
+    without the prefix, or None if {alternate} equals {reference}.
+
+    Common suffixes and prefixes of {reference} and {alternate} are trimmed,
+    after which deletions and insertions are shifted to their most 3'
+    position.
+    """
+    name = reference_name(genome, chromosome)
+
+    # Trim common suffix and prefix.
+    while reference and alternate and reference[-1] == alternate[-1]:
+        reference, alternate = reference[:-1], alternate[:-1]
+    while reference and alternate and reference[0] == alternate[0]:
+        reference, alternate = reference[1:], alternate[1:]
+        position += 1
+
+    # Zero-based start of the affected reference region.
+    start = position - 1
+    end = start + len(reference)
+
+    if not reference and not alternate:
+        return None
+
+    if len(reference) == len(alternate) == 1:
+        return '%d%s>%s' % (position, reference, alternate)
+
+    if reference and alternate:
+        return '%sdelins%s' % (format_range(start, end), alternate)
+
+    if reference:
+        # Deletion, shift deleted sequence.
+        start, deleted = shift(genome, name, start, reference, deletion=True)
+        return '%sdel' % format_range(start, start + len(deleted))
+
+    # Insertion, shift inserted sequence.
+    start, inserted = shift(genome, name, start, alternate)
+    if genome(name, start - len(inserted), start) == inserted:
+        return '%sdup' % format_range(start - len(inserted), start)
+    return '%d_%dins%s' % (start, start + 1, inserted)
+
+
+def shift(genome, name, start, sequence, deletion=False):
+    """
+    Shift {sequence}, inserted before zero-based position {start} on {name}
+    or deleted from there if {deletion} is True, as far as possible in 3'
+    direction. Return the new start and the rotated sequence.
+    """
+    # The sequence is compared with the reference following it.
+    position = start + len(sequence) if deletion else start
+    while True:
+        flank = genome(name, position, position + WINDOW_SIZE)
+        if not flank:
+            return start, sequence
+        for base in flank:
+            if base != sequence[0]:
+                return start, sequence
+            sequence = sequence[1:] + sequence[0]
+            start += 1
+        position += len(flank)
+
+
+def format_range(start, end):
+    """
+    Format a zero-based open-ended range as a one-based HGVS position or
+    range.
+    """
+    if end - start == 1:
+        return '%d' % end
+    return '%d_%d' % (start + 1, end)
+
+
+def reference_name(genome, chromosome):
+    """
+    Find the name of {chromosome} in the reference sequence, trying with and
+    without 'chr' prefix. Raise ValueError if it cannot be found.
+    """
+    candidates = [chromosome]
+    if chromosome.startswith('chr'):
+        candidates.append(chromosome[3:])
+    else:
+        candidates.append('chr' + chromosome)
+    for candidate in candidates:
+        if genome(candidate, 0, 0) is not None:
+            return candidate
+    raise ValueError('Chromosome not in reference: %s' % chromosome)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""
+Create HGVS descriptions from a VCF file. The VCF file must be in VCFv4.1
+format (as created by Samtools 0.1.16 for example).""")
+    parser.add_argument('vcf_file', metavar='VCF_FILE',
+                        help='file in VCF format (can be gzipped or '
+                        'bgzipped, - for standard input)')
+    parser.add_argument('-j', dest='processes', default=1, type=int,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('-r', dest='reference_file', metavar='FASTA_FILE',
+                        help='normalize variants against this reference '
+                        'sequence (indexed with samtools faidx)')
+    parser.add_argument('-l', dest='regions', metavar='REGION',
+                        action='append', default=[],
+                        help='only convert variants in this region, as '
+                        'chromosome:first-last (can be specified more than '
+                        'once, VCF_FILE must be indexed with tabix)')
+    parser.add_argument('-b', dest='regions_file', metavar='BED_FILE',
+                        help='only convert variants in the regions in this '
+                        'BED file (VCF_FILE must be indexed with tabix)')
+    args = parser.parse_args()
+    regions = None
+    if args.regions or args.regions_file:
+        if args.vcf_file == '-':
+            parser.error('regions cannot be used with standard input')
+        regions = []
+        for region in args.regions:
+            parsed = parse_region(region)
+            if not parsed:
+                parser.error('region must be of the form '
+                             'chromosome:first-last')
+            regions.append(parsed)
+        if args.regions_file:
+            regions.extend(read_regions_file(args.regions_file))
+    handle_broken_pipe()
+    main(args.vcf_file, args.processes, args.reference_file, regions)
@@ -5,20 +5,34 @@
 # Usage:
 #   ./nucleotide-counts.py sequence.fasta
 #
+# The fasta file can be compressed with gzip (detected automatically), and is
+# read from standard input if its filename is -.
+#
 # Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
 # Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 
 
 from __future__ import division
+import os
 import sys
 from Bio import SeqIO
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import handle_broken_pipe, open_file
+
 
 def print_nucleotide_counts(sequence_file):
     """
     Count.
     """
-    records = SeqIO.parse(open(sys.argv[1], 'r'), 'fasta')
+    try:
+        sequences = open_file(sequence_file)
+    except IOError as (_, message):
+        print 'Could not read fasta file: %s' % sequence_file
+        sys.exit(1)
+
+    records = SeqIO.parse(sequences, 'fasta')
 
     for record in records:
         # It doesn't feel right that we need this case hack...
@@ -39,4 +53,5 @@ if __name__ == '__main__':
 Usage:
   {command} sequence.fasta""".format(command=sys.argv[0])
         sys.exit(1)
+    handle_broken_pipe()
     print_nucleotide_counts(sys.argv[1])
@@ -7,15 +7,28 @@ The optional position arguments define the region on which to do the
 calculations. If not set, the region is taken to start at the first position
 in the pileup file and end at the last position in the pileup file.
 
-All positions are 1-based.
+Alternatively, the region can be given as chromosome:first-last for a pileup
+file compressed with bgzip and indexed with tabix [1]. Only the blocks
+overlapping the region are read in that case (requires pysam [2]).
+
+All positions are 1-based. A pileup file compressed with gzip or bgzip is
+decompressed automatically. If PILEUP_FILE is -, it is read from standard
+input (for example from samtools mpileup).
 
 Usage:
   ./pileup_coverage.py file.pileup [first_position last_position]
+  ./pileup_coverage.py file.pileup.gz chromosome:first_position-last_position
+  ./pileup_coverage.py -m [-n sample_a,sample_b] file.mpileup [region]
 
 The result is a JSON object with fields 'region_size', 'maximum_coverage',
 'minimum_coverage', and 'mean_coverage'. If GROUPED_COVERAGE is set to True,
 also 'chart_url', 'grouped_coverage', and 'group_size' are added.
 
+With the -m argument, the pileup file is read as created by samtools mpileup
+from multiple samples and the statistics are calculated for all samples in
+one pass. The result is then a JSON object with one such object per sample,
+keyed by the sample names given with -n.
+
 All number are floored to integers. Example:
 
   {"maximum_coverage": 540,
@@ -23,9 +36,13 @@ All number are floored to integers. Example:
    "mean_coverage":    371,
    "minimum_coverage": 67}
 
+
 Warning: Calculations are ad-hoc and plots are not even that. Used on mtDNA,
 so not optimized for full genome alignments. Does not pay attention to
-chromosomes.
+chromosomes, unless a region with chromosome is given.
+
+[1] http://samtools.sourceforge.net/tabix.shtml
+[2] http://code.google.com/p/pysam/
 
 Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
 Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
@@ -34,108 +51,230 @@ Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 
 from __future__ import division
 
+import os
 import sys
 import json
 from collections import defaultdict
 
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import iter_lines, open_file, parse_pileup
+import instrument
+
 
 # Only set this to true on small regions (up to mtDNA is fine)
 GROUPED_COVERAGE = True
 GROUP_SIZE = 100
 
 
-def calculate_coverage(pileup_file, first_position=None, last_position=None):
+def calculate_coverage(pileup_file, first_position=None, last_position=None,
+                       chromosome=None, multi_sample=False, names=None):
     """
     Calculate coverage statistics from pileup file. Optional arguments define
     the region on which to calculate the coverage.
+
+    If {chromosome} is given, the pileup file must be compressed with bgzip
+    and indexed with tabix, and only the region on {chromosome} from
+    {first_position} to {last_position} is read from it.
+
+    If {multi_sample} is True, the pileup file is read as created by samtools
+    mpileup, with three columns per sample, and the statistics are calculated
+    for every sample in one pass. The result is then keyed by the sample
+    names in {names} (or sample_1, sample_2, etc. if not given).
     """
-    total_coverage = 0
-    minimum_coverage = 10000
-    maximum_coverage = 0
-    if GROUPED_COVERAGE:
-        grouped_coverage = defaultdict(int)
+    instrument.add_input(pileup_file)
+    if chromosome:
+        lines = instrument.timed(read_region(pileup_file, chromosome,
+                                             first_position, last_position),
+                                 'tabix', records=False)
+    else:
+        try:
+            lines = iter_lines(instrument.timed_reader(open_file(pileup_file)))
+        except IOError as (_, message):
+            print 'Could not read pileup file: %s' % pileup_file
+            sys.exit(1)
 
-    try:
-        pileup = open(pileup_file, 'r')
-    except IOError as (_, message):
-        print 'Could not read pileup file: %s' % pileup_file
-        sys.exit(1)
+    # Per-sample accumulators, indexed by sample number.
+    total_coverage = minimum_coverage = maximum_coverage = None
+    grouped_coverage = None
+
+    position = None
+
+    records = instrument.timed(parse_pileup(lines, multi_sample), 'parse')
 
     while True:
-        line = pileup.readline()
-        if not line:
-            break
         try:
-            position = int(line.split()[1])
-            coverage = int(line.split()[3])
-        except IndexError:
-            print 'No coverage in line: %s' % line
-            sys.exit(1)
-        except ValueError:
-            print 'Cannot read coverage: %s' % line.split()[3]
+            _, position, coverages = next(records)
+        except StopIteration:
+            break
+        except ValueError as error:
+            print error
             sys.exit(1)
+        if first_position and position < first_position:
+            continue
+        if last_position and position > last_position:
+            continue
         if not first_position:
             first_position = position
-        total_coverage += coverage
-        minimum_coverage = min(coverage, minimum_coverage)
-        maximum_coverage = max(coverage, maximum_coverage)
+        if total_coverage is None:
+            samples = len(coverages)
+            total_coverage = [0] * samples
+            minimum_coverage = [10000] * samples
+            maximum_coverage = [0] * samples
+            if GROUPED_COVERAGE:
+                grouped_coverage = defaultdict(lambda: [0] * samples)
+        elif len(coverages) != samples:
+            print 'Number of samples differs at position: %d' % position
+            sys.exit(1)
         if GROUPED_COVERAGE:
-            grouped_coverage[(position - first_position)
-                             // GROUP_SIZE] += coverage
+            group = grouped_coverage[(position - first_position)
+                                     // GROUP_SIZE]
+        for sample, coverage in enumerate(coverages):
+            total_coverage[sample] += coverage
+            if coverage < minimum_coverage[sample]:
+                minimum_coverage[sample] = coverage
+            if coverage > maximum_coverage[sample]:
+                maximum_coverage[sample] = coverage
+            if GROUPED_COVERAGE:
+                group[sample] += coverage
+
+    if total_coverage is None:
+        print 'No positions in pileup file: %s' % pileup_file
+        sys.exit(1)
 
     if not last_position:
         last_position = position
 
     region_size = last_position - first_position + 1
 
-    coverage = {'region_size': region_size,
-                'mean_coverage': total_coverage // region_size,
-                'minimum_coverage': minimum_coverage,
-                'maximum_coverage': maximum_coverage}
+    coverages = []
 
-    if GROUPED_COVERAGE:
-        average_grouped_coverage = []
-        for group in range(0, (region_size - 1) // GROUP_SIZE + 1):
-            group_size = GROUP_SIZE
-            if group == (region_size -1) // GROUP_SIZE:
-                group_size = region_size % GROUP_SIZE
-            average_grouped_coverage.append(
-                grouped_coverage[group] // group_size)
+    for sample in range(samples):
+        coverage = {'region_size': region_size,
+                    'mean_coverage': total_coverage[sample] // region_size,
+                    'minimum_coverage': minimum_coverage[sample],
+                    'maximum_coverage': maximum_coverage[sample]}
 
-        google_chart_url = ('http://chart.googleapis.com/chart?cht=lc&chf=' +
-                            'bg,s,F5F5F5&chs=600x200&chd=t:%s&chds=a&chxt=' +
-                            'x,y&chxr=0,%d,%d') % \
-                            (','.join(map(str, average_grouped_coverage)),
-                             first_position, last_position)
+        if GROUPED_COVERAGE:
+            average_grouped_coverage = []
+            for group in range(0, (region_size - 1) // GROUP_SIZE + 1):
+                group_size = GROUP_SIZE
+                if group == (region_size -1) // GROUP_SIZE:
+                    group_size = region_size - group * GROUP_SIZE
+                summed = grouped_coverage[group][sample] \
+                         if group in grouped_coverage else 0
+                average_grouped_coverage.append(summed // group_size)
 
-        coverage.update({'chart_url': google_chart_url,
-                         'grouped_coverage': average_grouped_coverage,
-                         'group_size': GROUP_SIZE})
+            google_chart_url = ('http://chart.googleapis.com/chart?cht=lc&' +
+                                'chf=bg,s,F5F5F5&chs=600x200&chd=t:%s&chds=' +
+                                'a&chxt=x,y&chxr=0,%d,%d') % \
+                                (','.join(map(str, average_grouped_coverage)),
+                                 first_position, last_position)
 
-    print json.dumps(coverage)
+            coverage.update({'chart_url': google_chart_url,
+                             'grouped_coverage': average_grouped_coverage,
+                             'group_size': GROUP_SIZE})
 
+        coverages.append(coverage)
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print """Calculate mean coverage, coverage range, and average coverage per N positions
-from a pileup file and write the result JSON formatted to standard output.
+    if not multi_sample:
+        print json.dumps(coverages[0])
+        return
 
-The optional position arguments define the region on which to do the
-calculations. If not set, the region is taken to start at the first position
-in the pileup file and end at the last position in the pileup file.
+    if not names:
+        names = ['sample_%d' % (sample + 1) for sample in range(samples)]
+    if len(names) != samples:
+        print 'Got %d sample names for %d samples.' % (len(names), samples)
+        sys.exit(1)
 
-All positions are 1-based.
+    print json.dumps(dict(zip(names, coverages)))
 
-Usage:
-  {command} file.pileup [first_position last_position]""".format(command=sys.argv[0])
+
+def read_region(pileup_file, chromosome, first_position, last_position):
+    """
+    Read the lines for positions {first_position} to {last_position} on
+    {chromosome} from a pileup file compressed with bgzip and indexed with
+    tabix. Only the blocks overlapping the region are decompressed.
+    """
+    try:
+        import pysam
+    except ImportError:
+        print 'Region queries require the pysam Python module.'
+        sys.exit(1)
+
+    try:
+        pileup = pysam.Tabixfile(pileup_file)
+    except IOError:
+        print 'Could not read indexed pileup file: %s' % pileup_file
         sys.exit(1)
-    if len(sys.argv) > 3:
+
+    try:
+        for line in pileup.fetch(chromosome, first_position - 1,
+                                 last_position):
+            yield line
+    except ValueError:
+        print 'Could not read region from pileup file: %s:%d-%d' % \
+              (chromosome, first_position, last_position)
+        sys.exit(1)
+    finally:
+        pileup.close()
+
+
+def parse_region(region):
+    """
+    Parse a region string chromosome:first-last and return it as a tuple
+    (chromosome, first, last), or None if it is not such a string.
+    """
+    try:
+        chromosome, positions = region.rsplit(':', 1)
+        first_position, last_position = positions.replace(',', '').split('-')
+        return chromosome, int(first_position), int(last_position)
+    except ValueError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__.split('\n\n\n')[0])
+    parser.add_argument('pileup_file', metavar='PILEUP_FILE',
+                        help='file in pileup format to read coverage from')
+    parser.add_argument('region', metavar='REGION', nargs='*',
+                        help='first and last position, or region as '
+                        'chromosome:first-last on an indexed pileup file')
+    parser.add_argument('-m', '--multi-sample', dest='multi_sample',
+                        action='store_true', help='read all samples from '
+                        'a samtools mpileup file')
+    parser.add_argument('-n', '--names', dest='names', metavar='NAMES',
+                        help='comma-separated sample names for the '
+                        'multi-sample result (default: sample_1, ...)')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args)
+    names = args.names.split(',') if args.names else None
+    if len(args.region) == 1:
+        region = parse_region(args.region[0])
+        if not region:
+            parser.error('region argument must be of the form '
+                         'chromosome:first-last')
+        chromosome, first_position, last_position = region
+        if args.pileup_file == '-':
+            parser.error('region argument cannot be used with standard '
+                         'input')
+        instrument.run(calculate_coverage, args.pileup_file, first_position,
+                       last_position, chromosome, args.multi_sample, names)
+    elif len(args.region) == 2:
         try:
-            first_position = int(sys.argv[2])
-            last_position = int(sys.argv[3])
+            first_position, last_position = map(int, args.region)
         except ValueError:
-            print 'Optional position arguments must be integers.'
-            sys.exit(1)
-        calculate_coverage(sys.argv[1], first_position, last_position)
+            parser.error('optional position arguments must be integers')
+        instrument.run(calculate_coverage, args.pileup_file, first_position,
+                       last_position, multi_sample=args.multi_sample,
+                       names=names)
+    elif not args.region:
+        instrument.run(calculate_coverage, args.pileup_file,
+                       multi_sample=args.multi_sample, names=names)
     else:
-        calculate_coverage(sys.argv[1])
+        parser.error('expected first and last position or a region')
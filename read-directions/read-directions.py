@@ -4,7 +4,7 @@
 # versus forward mapped reads.
 #
 # Usage:
-#   ./read-directions reads1.bam [reads2.bam] [reads3.bam] ...
+#   ./read-directions [--stats] [--profile file] reads1.bam [reads2.bam] ...
 #
 # Reported are:
 # - The number of reads not mapped in a propper pair (both abslute and as
@@ -14,6 +14,12 @@
 # - The number of reads single-mapped reverse (both absolute and as percentage
 #   of the total number of reads not mapped in a propper pair).
 #
+# A BAM file is read from standard input if its filename is -, otherwise it
+# must be indexed.
+#
+# With --stats, time spent per phase, throughput, and memory use are reported
+# on standard error. With --profile, a cProfile profile is written to file.
+#
 # Requires the pysam Python module [1].
 #
 # [1] http://code.google.com/p/pysam/
@@ -23,19 +29,31 @@
 
 
 from __future__ import division
+import os
 import sys
 import pysam
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+import instrument
+
 
 def count_directions(reads_file):
     """
     Count.
     """
+    instrument.add_input(reads_file)
     reads = pysam.Samfile(reads_file, 'rb')
 
     total = forward = reverse = 0
 
-    for read in reads.fetch():
+    # Reads without reference are not fetched from an indexed file either.
+    if reads_file == '-':
+        iterator = (read for read in reads if read.tid >= 0)
+    else:
+        iterator = reads.fetch()
+
+    for read in instrument.timed(iterator, 'pysam'):
         total += 1
         if not read.is_proper_pair:
             if read.is_reverse:
@@ -79,12 +97,13 @@ def main(files):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
+    files = instrument.strip_arguments(sys.argv[1:])
+    if not files:
         print """From the reads not mapped in a propper pair, count the number of reverse
 versus forward mapped reads.
 
 Usage:
-  {command} reads1.bam [reads2.bam] [reads3.bam] ...
+  {command} [--stats] [--profile file] reads1.bam [reads2.bam] ...
 
 Reported are:
 - The number of reads not mapped in a propper pair (both abslute and as
@@ -94,4 +113,4 @@ Reported are:
 - The number of reads single-mapped reverse (both absolute and as percentage
   of the total number of reads not mapped in a propper pair).""".format(command=sys.argv[0])
         sys.exit(1)
-    main(sys.argv[1:])
+    instrument.run(main, files)
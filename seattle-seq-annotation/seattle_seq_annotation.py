@@ -7,10 +7,52 @@
 # tab-separated file.
 #
 # Usage:
-#   ./seattle_seq_annotation.py snp|indel <input.vcf> <mail@domain.com>
+#   ./seattle_seq_annotation.py [-c cache.sqlite] <input.vcf> <mail@domain.com>
+#   ./seattle_seq_annotation.py [-c cache.sqlite] -b <mail@domain.com> \
+#       <input.vcf> ...
 #
-# The result is written to disk as <input.vcf.annotation>. Temporary data is
-# written to <input.vcf.part.*> files and removed afterwards.
+# The result is written to disk as <input.vcf.annotation>.
+#
+# With -b, many VCF files (sorted by chromosome and position) are annotated
+# in one batch. They are merged into one list of distinct variants, written
+# to <input.vcf.sites.vcf> next to the first VCF file, which is submitted
+# once (and removed when the run is completed). The annotation rows are
+# written to an annotation file per VCF file, matched to its variants by
+# chromosome, position, and alleles, with the summary counts recalculated
+# from its rows.
+#
+# Large VCF files are submitted in parts. The parts are not written to disk,
+# but uploaded directly from the byte ranges of their lines in the VCF file.
+# Results are downloaded with compressed transfer and kept compressed in
+# memory until they can be written. All parts are monitored at the same
+# time and each part is downloaded as soon as it is completed, after which
+# the results are written in part order. The time between polls for a part
+# is estimated from its progress so far, backing off while it makes none.
+#
+# With -c, annotations are cached per variant in a local SQLite database,
+# keyed by chromosome, position, reference, alternate, the requested columns,
+# and the server version (the version lines in the result summary, such as
+# the geneDataSource line). Only variants not in the cache are submitted, and
+# the result rows for cached and submitted variants are written in VCF order,
+# with the summary counts recalculated from the rows. Result rows are matched
+# to variants by their chromosome and position, so the VCF file must be
+# sorted by chromosome and position. Parts of an interrupted run are all
+# downloaded again, as their rows are only cached once the run completed.
+#
+# Variants are looked up in the cache under the server version of the last
+# result. If the submitted variants come back with another version, the
+# cached variants are annotated again. A run with all variants in the cache
+# does not contact the server, so it cannot notice a new server version.
+#
+# The state of a run is kept in a journal <input.vcf.annotation.journal>,
+# recording for each part its urls, its status, and the size of the
+# annotation file after it was written. If the script is run again on the
+# same VCF file after it was interrupted, parts are not submitted again and
+# only the parts not yet written are waited for and downloaded. The journal
+# is removed when the run is completed.
+#
+# Tests against a local stand-in for the SeattleSeq Annotation server are in
+# the tests directory (run with: python -m unittest discover).
 #
 # Requires the poster Python library [2].
 #
@@ -21,8 +63,17 @@
 # Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 
 
-# Seconds to wait between polling for job result
-WAIT_STEP = 120
+# Minimum seconds to wait between polling for job result
+WAIT_MIN = 10
+
+# Maximum seconds to wait between polling for job result
+WAIT_INTERVAL_MAX = 600
+
+# Factor to increase the time between polls by while there is no progress
+WAIT_BACKOFF = 2
+
+# Fraction of the time between polls to randomly add or subtract
+WAIT_JITTER = 0.1
 
 # Maximum seconds to wait for job result
 WAIT_MAX = 43200
@@ -30,6 +81,12 @@ WAIT_MAX = 43200
 # Print debugging information
 DEBUG = True
 
+# Maximum number of parts to wait for and download at the same time
+MAX_THREADS = 8
+
+# Bytes to read at once when downloading a result
+BUFFER_SIZE = 1024 * 1024
+
 # Columns to include (order must be maintained)
 COLUMNS = ['sampleAlleles',
 #           'dbSNPGenotype',
@@ -55,6 +112,30 @@ COLUMNS = ['sampleAlleles',
 # Maximum number of variants SeattleSeq accepts
 MAX_VARIANTS = 900000   # To be sure, actually 1000000
 
+# Summary descriptions to count variants under when the summary is calculated
+# from the rows (in batch mode and with the cache), per value of the
+# functionGVS column
+FUNCTION_COUNTS = {'missense':            'Count Missense SNPs',
+                   'stop-gained':         'Count Nonsense SNPs',
+                   'stop-lost':           'Count Nonsense SNPs',
+                   'nonsense':            'Count Nonsense SNPs',
+                   'splice-3':            'Count SNPs in Splice Sites',
+                   'splice-5':            'Count SNPs in Splice Sites',
+                   'coding-synonymous':   'Count SNPs in Coding Synonymous',
+                   'coding-notMod3':      'Count SNPs in Coding (not mod 3)',
+                   'utr-3':               'Count SNPs in a UTR',
+                   'utr-5':               'Count SNPs in a UTR',
+                   'near-gene-3':         'Count SNPs near a gene',
+                   'near-gene-5':         'Count SNPs near a gene',
+                   'intron':              'Count SNPs in Introns',
+                   'intergenic':          'Count Intergenic SNPs'}
+
+# SQLite database to cache annotations in (None to disable, set with -c)
+CACHE_FILE = None
+
+# Cache version of annotation rows stored before the server version is known
+PENDING_VERSION = ''
+
 # SeattleSeq Annotation location
 BASE_URL = 'http://snp.gs.washington.edu/SeattleSeqAnnotation137/'
 POST_URL = BASE_URL + 'BatchQueryServlet'
@@ -63,9 +144,20 @@ POST_URL = BASE_URL + 'BatchQueryServlet'
 import sys
 import os
 import time
+from array import array
 from collections import defaultdict
-import uuid
-from poster.encode import multipart_encode
+from itertools import groupby
+import heapq
+import random
+import gzip
+import shutil
+import filecmp
+import threading
+from cStringIO import StringIO
+import Queue
+import sqlite3
+import json
+from poster.encode import MultipartParam, multipart_encode
 from poster.streaminghttp import register_openers
 import urllib
 import urllib2
@@ -76,40 +168,817 @@ def seattle_seq_annotation(vcf_file, address):
     Submit a VCF file to the SeattleSeq Annotation web interface. The
     annotation result is retrieved as plain-text tab-separated and written
     to disk.
+
+    If CACHE_FILE is set, only variants that are not in the cache are
+    submitted.
+
+    Return the set of version descriptions from the result.
+    """
+    if CACHE_FILE:
+        return cached_annotation(vcf_file, address)
+
+    annotation_file = vcf_file + '.annotation'
+
+    header, parts = create_parts(vcf_file)
+
+    journal = submit_parts(vcf_file, header, parts, address)
+
+    versions = set(journal['versions'])
+    summary = defaultdict(int, journal['summary'])
+
+    # Parts are written in order, so only the first parts can be written
+    # already. Anything written after them is discarded.
+    written = [part for part in journal['parts']
+               if part['status'] == 'written']
+    try:
+        annotation = open(annotation_file, 'ab')
+        annotation.truncate(written[-1]['offset'] if written else 0)
+        annotation.close()
+    except IOError as (_, message):
+        fatal_error(message)
+
+    pending = journal['parts'][len(written):]
+    submissions = [(part['monitor_url'], part['result_url'])
+                   for part in pending]
+
+    for index, result in retrieve_results(submissions):
+        append_result(result, annotation_file, versions, summary,
+                      discard_header=index + len(written) > 0)
+        result.close()
+
+        pending[index]['status'] = 'written'
+        pending[index]['offset'] = os.path.getsize(annotation_file)
+        journal['versions'] = sorted(versions)
+        journal['summary'] = summary
+        write_journal(vcf_file, journal)
+
+    append_summary(annotation_file, versions, summary)
+
+    os.unlink(journal_file(vcf_file))
+
+    return versions
+
+
+def cached_annotation(vcf_file, address):
     """
-    part_files = create_parts(vcf_file)
+    Submit the variants in a VCF file that are not in the cache to the
+    SeattleSeq Annotation web interface, and write the annotation of all
+    variants to disk. The cache is updated with the new annotations.
 
-    submissions = [submit_part(p, address) for p in part_files]
+    The VCF file must be sorted by chromosome and position, so the result
+    rows can be matched to the variants in one pass.
+    """
+    cache = open_cache(CACHE_FILE)
+    version = cached_version(cache)
+
+    # For every variant, whether it was found in the cache.
+    known = array('b')
+
+    # Chromosomes in order of appearance in the VCF file.
+    chromosomes = {}
+    previous = [None]
+
+    def is_known(line):
+        parts = line.split('\t', 2)
+        try:
+            variant_site = site(parts[0], parts[1])
+            key = (chromosomes.setdefault(variant_site[0], len(chromosomes)),
+                   int(variant_site[1]))
+        except (IndexError, ValueError):
+            fatal_error('Invalid line in VCF file: "%s"' % line.rstrip('\n'))
+        if previous[0] and key < previous[0]:
+            fatal_error('VCF file is not sorted by chromosome and position: '
+                        '%s' % vcf_file)
+        previous[0] = key
+        hit = version is not None and \
+              cached_rows(cache, line, version) is not None
+        known.append(hit)
+        return hit
+
+    header, parts = create_parts(vcf_file, is_known)
+
+    debug('Variants found in cache: %d / %d' % (sum(known), len(known)))
+
+    # Results of earlier runs are only in the cache once the run completed,
+    # so all parts in the journal are downloaded again.
+    journal = submit_parts(vcf_file, header, parts, address)
+    submissions = [(part['monitor_url'], part['result_url'])
+                   for part in journal['parts']]
 
-    waiting = 0
-    first = True
     versions = set()
     summary = defaultdict(int)
 
-    # Todo: perhaps first truncate the annotation file
-
-    for monitor_url, result_url in submissions:
-        waiting += wait_for_result(monitor_url, waiting)
-        append_result(result_url, vcf_file + '.annotation', versions,
-                      summary, discard_header=not first)
-        first = False
+    merge_results(vcf_file, known, version, chromosomes,
+                  retrieve_results(submissions), cache,
+                  vcf_file + '.annotation', versions, summary)
 
     append_summary(vcf_file + '.annotation', versions, summary)
 
+    cache.commit()
+    cache.close()
+
+    os.unlink(journal_file(vcf_file))
+
+    if any(known) and '\n'.join(sorted(versions)) != version:
+        warning('The server version changed since the cached annotations '
+                'were made, annotating the cached variants again.')
+        return cached_annotation(vcf_file, address)
+
+    return versions
+
+
+def merge_results(vcf_file, known, version, chromosomes, results, cache,
+                  output_file, versions, summary):
+    """
+    Write the annotation of the variants in a VCF file to a file, in VCF
+    order. Rows for variants marked in {known} are taken from the cache
+    under server {version} and rows for the other variants from {results}
+    (as generated by retrieve_results), which are stored in the cache under
+    the version reported in the results. The summary counts are calculated
+    from the rows of all variants.
+
+    Rows from {results} are matched to the variants by chromosome and
+    position, in the order of the VCF file with chromosomes ordered as in
+    the dictionary {chromosomes} (normalized name to rank). Rows that match
+    no variant are written in place and reported. If several submitted
+    variants are at the same position, their rows cannot be told apart and
+    are not cached. The same holds for submitted variants without rows.
+    """
+    try:
+        vcf = open(vcf_file, 'r')
+        output = open(output_file, 'wb', BUFFER_SIZE)
+    except IOError as (_, message):
+        fatal_error(message)
+
+    header = []
+    # The summary counts of the server only cover the submitted variants.
+    rows = result_rows(results, header, versions, defaultdict(int))
+    row = next(rows, None)
+
+    columns = ','.join(COLUMNS)
+    submitted = bool(header)
+
+    if not submitted:
+        # Nothing was submitted, all variants are in the cache.
+        cached = cache.execute('SELECT header, versions FROM headers WHERE '
+                               'columns = ?', (columns,)).fetchone()
+        if cached:
+            header = cached[0].splitlines(True)
+            versions.update(v for v in cached[1].split('\n') if v)
+
+    output.writelines(header)
+
+    names = header_columns(header)
+    site_columns = names.index('chromosome'), names.index('position')
+
+    def row_site(row):
+        parts = row.split('\t')
+        return site(*[parts[c] for c in site_columns])
+
+    def row_key(row):
+        chromosome, position = row_site(row)
+        try:
+            return chromosomes.get(chromosome, -1), int(position)
+        except ValueError:
+            fatal_error('Invalid position in annotation row: "%s"'
+                        % row.rstrip('\n'))
+
+    for description in FUNCTION_COUNTS.values():
+        summary[description] = 0
+
+    # Rows of the last submitted variant, stored once we know it is the only
+    # submitted variant at its position.
+    pending = None
+    last_site = None
+
+    variant = -1
+    from_cache = 0
+    unmatched = 0
+
+    for line in vcf:
+        if line.startswith('#'):
+            continue
+        variant += 1
+
+        if known[variant]:
+            variant_rows = cached_rows(cache, line, version)
+            output.write(variant_rows)
+            count_variant(summary, names, variant_rows.splitlines(True))
+            from_cache += 1
+            continue
+
+        parts = line.split('\t')
+        variant_site = site(parts[0], parts[1])
+        variant_key = chromosomes[variant_site[0]], int(variant_site[1])
+
+        # Rows before the variant do not match any submitted variant.
+        while row is not None and row_key(row) < variant_key:
+            output.write(row)
+            unmatched += 1
+            row = next(rows, None)
+
+        variant_rows = []
+        while row is not None and row_site(row) == variant_site:
+            variant_rows.append(row)
+            row = next(rows, None)
+        output.writelines(variant_rows)
+        count_variant(summary, names, variant_rows)
+
+        if variant_site == last_site:
+            pending = None
+            continue
+        if pending:
+            cache_rows(cache, *pending)
+        pending = (line, ''.join(variant_rows)) if variant_rows else None
+        last_site = variant_site
+
+    if pending:
+        cache_rows(cache, *pending)
+
+    # Rows after the last variant do not match any submitted variant.
+    while row is not None:
+        output.write(row)
+        unmatched += 1
+        row = next(rows, None)
+
+    if unmatched:
+        warning('Could not match %d result rows to variants, they are '
+                'written at their position.' % unmatched)
+
+    if submitted:
+        # The version is in the summary lines after the rows, so the rows
+        # were stored under a placeholder.
+        version = '\n'.join(sorted(versions))
+        cache.execute('UPDATE OR REPLACE variants SET version = ? WHERE '
+                      'version = ?', (version, PENDING_VERSION))
+        cache.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?)',
+                      (columns, ''.join(header), version))
+
+    if from_cache:
+        summary['number variants from local cache'] += from_cache
+
+    debug('Result written to: %s' % output_file)
+
+    vcf.close()
+    output.close()
+
+
+def header_columns(header):
+    """
+    Return the column names from the last line in the annotation {header}.
+    """
+    try:
+        names = [name.strip() for name in header[-1].lstrip('#').split('\t')]
+        names.index('chromosome'), names.index('position')
+    except (IndexError, ValueError):
+        fatal_error('Could not find chromosome and position columns in '
+                    'annotation header.')
+    return names
+
+
+def count_variant(summary, names, rows):
+    """
+    Count a variant with annotation {rows} in the dictionary {summary}: in
+    total, by dbSNP membership of its first row, and once under each
+    description in FUNCTION_COUNTS of its rows. The column names are given
+    by {names}.
+    """
+    summary['number SNPs total'] += 1
+    if not rows:
+        return
+    rows = [row.split('\t') for row in rows]
+    if 'inDBSNPOrNot' in names:
+        if rows[0][names.index('inDBSNPOrNot')].strip() in ('none', ''):
+            summary['number SNPs not in dbSNP'] += 1
+        else:
+            summary['number SNPs in dbSNP'] += 1
+    if 'functionGVS' in names:
+        column = names.index('functionGVS')
+        for description in set(FUNCTION_COUNTS[parts[column].strip()]
+                               for parts in rows
+                               if parts[column].strip() in FUNCTION_COUNTS):
+            summary[description] += 1
+
+
+def result_rows(results, header, versions, summary):
+    """
+    Generate the annotation rows from {results} (as generated by
+    retrieve_results). The header lines of the first result are added to the
+    list {header} and the summary lines to {versions} and {summary}.
+    """
+    for index, result in results:
+        in_header = True
+        for line in result:
+            if line.startswith('#'):
+                if in_header and index == 0:
+                    header.append(line)
+                if not in_header:
+                    add_to_summary(versions, summary, line)
+            else:
+                in_header = False
+                yield line
+        result.close()
+
+
+def site(chromosome, position):
+    """
+    Return a normalized (chromosome, position) tuple to match result rows to
+    variants.
+    """
+    if chromosome.startswith('chr'):
+        chromosome = chromosome[3:]
+    return chromosome, position.strip()
+
+
+def open_cache(cache_file):
+    """
+    Open the SQLite annotation cache, creating it if needed, and return the
+    connection.
+    """
+    try:
+        cache = sqlite3.connect(os.path.expanduser(cache_file))
+        cache.execute('CREATE TABLE IF NOT EXISTS variants ('
+                      'chromosome TEXT, position INTEGER, reference TEXT, '
+                      'alternate TEXT, columns TEXT, version TEXT, rows TEXT, '
+                      'PRIMARY KEY (chromosome, position, reference, '
+                      'alternate, columns, version))')
+        cache.execute('CREATE TABLE IF NOT EXISTS headers ('
+                      'columns TEXT, header TEXT, versions TEXT, '
+                      'PRIMARY KEY (columns))')
+    except sqlite3.Error as error:
+        fatal_error('Could not open cache %s: %s' % (cache_file, error))
+    cache.text_factory = str
+    return cache
+
+
+def cached_version(cache):
+    """
+    Return the server version of the last result stored in the cache (its
+    version lines separated by newlines), or None if there is none.
+    """
+    row = cache.execute('SELECT versions FROM headers WHERE columns = ?',
+                        (','.join(COLUMNS),)).fetchone()
+    return row[0] if row else None
+
+
+def cache_key(line, version):
+    """
+    Return the cache key for the variant on VCF line {line} under server
+    {version}.
+    """
+    parts = line.split('\t')
+    try:
+        return (parts[0], int(parts[1]), parts[3], parts[4], ','.join(COLUMNS),
+                version)
+    except (IndexError, ValueError):
+        fatal_error('Invalid line in VCF file: "%s"' % line.rstrip('\n'))
+
+
+def cached_rows(cache, line, version):
+    """
+    Return the cached annotation rows for the variant on VCF line {line}
+    under server {version}, or None if it is not in the cache.
+    """
+    row = cache.execute('SELECT rows FROM variants WHERE chromosome = ? AND '
+                        'position = ? AND reference = ? AND alternate = ? AND '
+                        'columns = ? AND version = ?',
+                        cache_key(line, version)).fetchone()
+    return row[0] if row else None
+
+
+def cache_rows(cache, line, rows):
+    """
+    Store annotation rows for the variant on VCF line {line} in the cache,
+    under PENDING_VERSION until the server version is known.
+    """
+    cache.execute('INSERT OR REPLACE INTO variants VALUES (?, ?, ?, ?, ?, ?, '
+                  '?)', cache_key(line, PENDING_VERSION) + (rows,))
+
+
+def batch_annotation(vcf_files, address):
+    """
+    Annotate the variants in many VCF files at once. The distinct variants
+    in all files are submitted as one VCF file, after which the annotation
+    rows are written to an annotation file per VCF file.
+
+    The VCF files must be sorted by chromosome and position.
+
+    The distinct variants are written to <first.vcf.sites.vcf>, which is
+    annotated like any other VCF file (with its journal and annotation file
+    next to it). It is only removed once the run is completed, so a batch
+    run that was interrupted is resumed when started again with the same
+    VCF files.
+    """
+    sites_file = vcf_files[0] + '.sites.vcf'
+
+    order = chromosome_order(vcf_files)
+    chromosomes = write_sites(vcf_files, sites_file, order)
+    versions = seattle_seq_annotation(sites_file, address)
+    split_annotation(vcf_files, sites_file + '.annotation', order,
+                     chromosomes, versions)
+
+    try:
+        os.unlink(sites_file + '.annotation')
+        os.unlink(sites_file)
+    except OSError as (_, message):
+        fatal_error(message)
+
+
+def chromosome_order(vcf_files):
+    """
+    Return a function giving the sort key for a chromosome name. The order
+    of the ##contig header lines in {vcf_files} is used, with chromosomes
+    not in those lines sorted after them by number or name.
+    """
+    contigs = {}
+
+    for vcf_file in vcf_files:
+        try:
+            vcf = open(vcf_file, 'r')
+        except IOError as (_, message):
+            fatal_error(message)
+        for line in vcf:
+            if not line.startswith('##'):
+                break
+            if line.startswith('##contig=<'):
+                fields = dict(field.split('=', 1) for field in
+                              line.strip()[10:-1].split(',') if '=' in field)
+                if 'ID' in fields:
+                    contigs.setdefault(fields['ID'], len(contigs))
+        vcf.close()
+
+    def key(chromosome):
+        if chromosome in contigs:
+            return 0, contigs[chromosome], ''
+        name = chromosome[3:] if chromosome.startswith('chr') else chromosome
+        if name.isdigit():
+            return 1, int(name), ''
+        return 2, 0, name
+
+    return key
+
+
+def read_variants(vcf_file, index, order):
+    """
+    Generate the variants in a sorted VCF file as tuples (key, index, line),
+    where key is a tuple (chromosome order, position, reference, alternate,
+    chromosome) to sort on.
+    """
+    try:
+        vcf = open(vcf_file, 'r')
+    except IOError as (_, message):
+        fatal_error(message)
+
+    previous = None
+
+    for line in vcf:
+        if line.startswith('#'):
+            continue
+        parts = line.split('\t', 5)
+        try:
+            key = (order(parts[0]), int(parts[1]), parts[3], parts[4],
+                   parts[0])
+        except (IndexError, ValueError):
+            fatal_error('Invalid line in VCF file: "%s"' % line.rstrip('\n'))
+        if previous and key[:2] < previous[:2]:
+            fatal_error('VCF file is not sorted by chromosome and position: '
+                        '%s' % vcf_file)
+        previous = key
+        yield key, index, line
+
+    vcf.close()
+
+
+def write_sites(vcf_files, sites_file, order):
+    """
+    Merge the sorted VCF files into one VCF file with every distinct variant
+    once, without sample columns.
+
+    If {sites_file} already exists with the same variants, it is left
+    untouched, so the journal of an interrupted run on it is still valid.
+
+    Return a dictionary with for every chromosome (normalized as in the
+    annotation) its sort key given by {order}.
+    """
+    try:
+        sites = open(sites_file + '.tmp', 'w', BUFFER_SIZE)
+    except IOError as (_, message):
+        fatal_error(message)
+
+    sites.write('##fileformat=VCFv4.1\n'
+                '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+
+    variants = heapq.merge(*[read_variants(vcf_file, index, order)
+                             for index, vcf_file in enumerate(vcf_files)])
+
+    previous = None
+    count = 0
+    chromosomes = {}
+
+    for key, _, _ in variants:
+        if key == previous:
+            continue
+        _, position, reference, alternate, chromosome = key
+        chromosomes[site(chromosome, '')[0]] = key[0]
+        sites.write('%s\t%d\t.\t%s\t%s\t.\t.\t.\n' %
+                    (chromosome, position, reference, alternate))
+        previous = key
+        count += 1
+
+    sites.close()
+
+    try:
+        if os.path.exists(sites_file) and \
+               filecmp.cmp(sites_file, sites_file + '.tmp', shallow=False):
+            os.unlink(sites_file + '.tmp')
+        else:
+            os.rename(sites_file + '.tmp', sites_file)
+    except OSError as (_, message):
+        fatal_error(message)
+
+    debug('Distinct variants in %d VCF files: %d' % (len(vcf_files), count))
 
-def submit_part(part_file, address):
+    return chromosomes
+
+
+def split_annotation(vcf_files, annotation_file, order, chromosomes,
+                     versions):
     """
-    Submit a VCF file to the SeattleSeq Annotation server and return as a
-    tuple the url to monitor the job and the url to get the result.
+    Write the rows in the annotation of the merged variants to an annotation
+    file for each VCF file, with a summary calculated from its rows.
+
+    Rows are matched to variants by chromosome and position, in the order of
+    the merged variants given by {order}, and with {chromosomes} giving the
+    order of the chromosome names in the annotation (as returned by
+    write_sites). Rows that match no variant are reported and left out.
+
+    At a position with several variants, a row is given to the variants
+    whose reference and alternate alleles include those in its sampleAlleles
+    column. Rows of which the alleles match no variant at their position
+    (e.g., indels written differently) are given to all variants there.
     """
     try:
-        part = open(part_file, 'r')
+        annotation = open(annotation_file, 'r')
+        outputs = [open(vcf_file + '.annotation', 'wb', BUFFER_SIZE)
+                   for vcf_file in vcf_files]
     except IOError as (_, message):
         fatal_error(message)
 
+    header = []
+    row = annotation.readline()
+    while row.startswith('#'):
+        header.append(row)
+        row = annotation.readline()
+
+    names = header_columns(header)
+    site_columns = names.index('chromosome'), names.index('position')
+    alleles_column = names.index('sampleAlleles') \
+                     if 'sampleAlleles' in names else None
+
+    def row_key(row):
+        parts = row.split('\t')
+        chromosome, position = site(*[parts[c] for c in site_columns])
+        try:
+            return chromosomes.get(chromosome), int(position)
+        except ValueError:
+            fatal_error('Invalid position in annotation row: "%s"'
+                        % row.rstrip('\n'))
+
+    # Trailing comment lines are the summary.
+    def next_row():
+        row = annotation.readline()
+        return None if not row or row.startswith('#') else row
+
+    if not row or row.startswith('#'):
+        row = None
+
+    summaries = []
+    for output in outputs:
+        output.writelines(header)
+        summary = defaultdict(int)
+        for description in FUNCTION_COUNTS.values():
+            summary[description] = 0
+        summaries.append(summary)
+
+    variants = heapq.merge(*[read_variants(vcf_file, index, order)
+                             for index, vcf_file in enumerate(vcf_files)])
+
+    unmatched = 0
+
+    for position, site_variants in groupby(variants, lambda v: v[0][:2]):
+        # Rows before the variants (or on another chromosome) do not match
+        # any variant.
+        while row is not None:
+            row_position = row_key(row)
+            if row_position[0] is not None and row_position >= position:
+                break
+            unmatched += 1
+            row = next_row()
+
+        rows = []
+        while row is not None and row_key(row) == position:
+            rows.append(row)
+            row = next_row()
+
+        site_variants = list(site_variants)
+        alleles = [set([key[2]] + key[3].split(','))
+                   for key, _, _ in site_variants]
+
+        # For every row the variants it is given to.
+        matches = []
+        for row_parts in (r.split('\t') for r in rows):
+            matching = []
+            if alleles_column is not None:
+                row_alleles = set(row_parts[alleles_column].strip()
+                                  .split('/'))
+                matching = [i for i, variant_alleles in enumerate(alleles)
+                            if row_alleles <= variant_alleles]
+            matches.append(matching or range(len(site_variants)))
+
+        for i, (_, index, _) in enumerate(site_variants):
+            variant_rows = [r for r, matching in zip(rows, matches)
+                            if i in matching]
+            outputs[index].writelines(variant_rows)
+            count_variant(summaries[index], names, variant_rows)
+
+    while row is not None:
+        unmatched += 1
+        row = next_row()
+
+    if unmatched:
+        warning('Could not match %d annotation rows to variants, they are '
+                'left out.' % unmatched)
+
+    annotation.close()
+
+    for vcf_file, output, summary in zip(vcf_files, outputs, summaries):
+        output.close()
+        append_summary(vcf_file + '.annotation', versions, summary)
+        debug('Result written to: %s' % (vcf_file + '.annotation'))
+
+
+def retrieve_results(submissions):
+    """
+    Wait for all submitted parts at the same time, and download the result
+    of each part to a temporary file as soon as it is completed.
+
+    Generate tuples (index, result) in the order of {submissions}, where
+    result is the open temporary file. Results that are completed before an
+    earlier part are kept until that part is completed.
+    """
+    jobs = Queue.Queue()
+    for job in enumerate(submissions):
+        jobs.put(job)
+
+    completed = Queue.Queue()
+    deadline = time.time() + WAIT_MAX
+
+    def worker():
+        while True:
+            try:
+                index, (monitor_url, result_url) = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                wait_for_result(monitor_url, deadline)
+                result = download_result(result_url)
+            except SystemExit:
+                # Already reported by fatal_error, which cannot exit the
+                # program from this thread.
+                completed.put( (index, None, None) )
+                return
+            except BaseException:
+                # Other errors are raised again in the main thread.
+                completed.put( (index, None, sys.exc_info()) )
+                return
+            completed.put( (index, result, None) )
+
+    for _ in range(min(MAX_THREADS, len(submissions))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    # Reorder buffer for results completed before an earlier part.
+    buffered = {}
+
+    for index in range(len(submissions)):
+        while index not in buffered:
+            try:
+                done, result, error = completed.get(True, WAIT_MAX)
+            except Queue.Empty:
+                fatal_error('Job took too long.')
+            if error:
+                if isinstance(error[1], IOError):
+                    fatal_error('Could not retrieve result: %s' % error[1])
+                raise error[0], error[1], error[2]
+            if result is None:
+                sys.exit(1)
+            buffered[done] = result
+        yield index, buffered.pop(index)
+
+
+def submit_parts(vcf_file, header, parts, address):
+    """
+    Submit the parts of a VCF file (as returned by create_parts) and return
+    the journal of the run.
+
+    If the journal of an earlier run on the same VCF file exists, it is
+    returned with the parts it does not yet contain submitted. The journal
+    is written after each submission.
+
+    The journal is a dictionary with the list of parts under 'parts', each
+    part a dictionary with 'monitor_url', 'result_url', 'status' (submitted
+    or written), and 'offset' (size of the annotation file after the part
+    was written). The summary of the written parts is under 'versions' and
+    'summary'.
+    """
+    try:
+        stat = os.stat(vcf_file)
+    except OSError as (_, message):
+        fatal_error(message)
+
+    # The journal is only used for the same parts of the same file.
+    identity = {'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'server': POST_URL,
+                'parts': [part_size(header, ranges) for ranges in parts]}
+
+    journal = read_journal(vcf_file)
+
+    if journal and journal.get('identity') == identity:
+        debug('Resuming from journal: %d / %d parts submitted' %
+              (len(journal['parts']), len(parts)))
+    else:
+        journal = {'identity': identity,
+                   'parts': [],
+                   'versions': [],
+                   'summary': {}}
+        write_journal(vcf_file, journal)
+
+    for ranges in parts[len(journal['parts']):]:
+        monitor_url, result_url = submit_part(vcf_file, header, ranges,
+                                              address)
+        journal['parts'].append({'monitor_url': monitor_url,
+                                 'result_url':  result_url,
+                                 'status':      'submitted',
+                                 'offset':      None})
+        write_journal(vcf_file, journal)
+
+    return journal
+
+
+def journal_file(vcf_file):
+    """
+    Return the filename of the journal for a VCF file.
+    """
+    return vcf_file + '.annotation.journal'
+
+
+def read_journal(vcf_file):
+    """
+    Read the journal for a VCF file, or return None if there is none.
+    """
+    try:
+        with open(journal_file(vcf_file), 'r') as journal:
+            return json.load(journal)
+    except (IOError, ValueError):
+        return None
+
+
+def write_journal(vcf_file, journal):
+    """
+    Write the journal for a VCF file. The journal is replaced at once, so it
+    is never left half written.
+    """
+    filename = journal_file(vcf_file)
+    try:
+        with open(filename + '.tmp', 'w') as output:
+            json.dump(journal, output)
+        os.rename(filename + '.tmp', filename)
+    except (IOError, OSError) as (_, message):
+        fatal_error(message)
+
+
+def submit_part(vcf_file, header, ranges, address):
+    """
+    Submit a part of a VCF file to the SeattleSeq Annotation server and
+    return as a tuple the url to monitor the job and the url to get the
+    result. The part consists of {header} followed by the byte ranges in
+    {ranges} of the VCF file, and is read while it is uploaded.
+    """
+    try:
+        part = PartReader(vcf_file, header, ranges)
+    except IOError as (_, message):
+        fatal_error(message)
+
+    genotypes = MultipartParam('GenotypeFile',
+                               filename=os.path.basename(vcf_file),
+                               filetype='text/plain', filesize=part.size,
+                               fileobj=part)
+
     parameters = [('genotypeSource',   'FileInput'),
                   ('EMail',            address),
-                  ('GenotypeFile',     part),
+                  ('GenotypeFile',     genotypes),
                   ('fileFormat',       'VCFSNVsAndIndels'),
                   ('outputFileFormatBoth', 'originalBoth'),
                   ('geneData',         'NCBI'),
@@ -118,7 +987,7 @@ def submit_part(part_file, address):
     for column in COLUMNS:
         parameters.append( ('columns', column) )
 
-    debug('Submitting for annotation: %s' % part_file)
+    debug('Submitting for annotation: %s (%d bytes)' % (vcf_file, part.size))
 
     # Response contains result url and monitor url separated by a comma
     response = post_multipart(POST_URL, parameters)
@@ -126,7 +995,6 @@ def submit_part(part_file, address):
     response.close()
 
     part.close()
-    os.unlink(part_file)
 
     if not len(urls) == 2:
         fatal_error('Could not read urls from submit response.')
@@ -139,86 +1007,144 @@ def submit_part(part_file, address):
     return monitor_url, result_url
 
 
-def create_parts(vcf_file):
+class PartReader(object):
+    """
+    File-like object reading a part of a VCF file: a header followed by a
+    list of (start, end) byte ranges of the file.
+    """
+    def __init__(self, vcf_file, header, ranges):
+        self.vcf = open(vcf_file, 'rb')
+        self.header = header
+        self.ranges = ranges
+        self.size = part_size(header, ranges)
+        self.seek(0)
+
+    def seek(self, offset):
+        # Only rewinding is needed for uploading.
+        if offset:
+            raise IOError(0, 'Can only seek to the start of a part.')
+        self.header_offset = 0
+        self.next_range = 0
+        self.remaining = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size
+        blocks = [self.header[self.header_offset:self.header_offset + size]]
+        self.header_offset += len(blocks[0])
+        size -= len(blocks[0])
+        while size > 0:
+            if not self.remaining:
+                if self.next_range == len(self.ranges):
+                    break
+                start, end = self.ranges[self.next_range]
+                self.next_range += 1
+                self.vcf.seek(start)
+                self.remaining = end - start
+            block = self.vcf.read(min(size, self.remaining))
+            if not block:
+                break
+            self.remaining -= len(block)
+            size -= len(block)
+            blocks.append(block)
+        return ''.join(blocks)
+
+    def close(self):
+        self.vcf.close()
+
+
+def part_size(header, ranges):
+    """
+    Return the size in bytes of a part consisting of {header} followed by
+    the byte ranges in {ranges}.
+    """
+    return len(header) + sum(end - start for start, end in ranges)
+
+
+def create_parts(vcf_file, skip=None):
     """
     Split the VCF file in parts that contain less variants than the maximum
-    number allowed by SeattleSeq.
+    number allowed by SeattleSeq. The parts are not written, but described
+    by the byte ranges of their lines in the VCF file.
 
-    Make sure to include the header lines in each part and prepend a line
-    needed by the SeattleSeq Annotation server.
+    If {skip} is given, variant lines for which it returns True are left
+    out.
 
-    Return the filenames of the generated parts.
+    Return a tuple (header, parts), where header contains the header lines
+    to include in each part, prepended by a line needed by the SeattleSeq
+    Annotation server, and parts is a list with per part a list of (start,
+    end) byte ranges.
     """
     try:
-        vcf = open(vcf_file, 'r')
+        vcf = open(vcf_file, 'rb')
     except IOError as (_, message):
         fatal_error(message)
 
     # Header line for automated processing
     header = '# autoFile vcfAuto.txt\n'
 
-    # Filenames for parts
-    part_files = []
-
-    # Open a new part file
-    def open_part():
-        # Nicer would be to use something like mktemp()
-        part_file = vcf_file + '.part.' + uuid.uuid1().hex
-        try:
-            part = open(part_file, 'w')
-        except IOError as (_, message):
-            fatal_error(message)
-        part_files.append(part_file)
-        part.write(header)
-        return part
-
-    part = None
+    parts = []
+    ranges = None
+    variants = 0
+    offset = 0
 
-    # Start with MAX_VARIANTS so we first open a new part file
+    # Start with MAX_VARIANTS so we first start a new part
     line_count = MAX_VARIANTS
 
-    # Buffered read/write
-    while True:
-        line = vcf.readline()
-        if not line:
-            break
+    for line in vcf:
+        start = offset
+        offset += len(line)
 
         # Read the original header lines
         if line.startswith('#'):
             header += line
             continue
 
+        variants += 1
+        if skip and skip(line):
+            continue
+
         line_count += 1
         if line_count > MAX_VARIANTS:
-            if part:
-                part.close()
-            part = open_part()
-            line_count = 0
+            ranges = []
+            parts.append(ranges)
+            line_count = 1
 
-        part.write(line)
+        # Consecutive lines are merged into one range.
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = ranges[-1][0], offset
+        else:
+            ranges.append( (start, offset) )
 
     # Call for help in case of an empty VCF file (SeattleSeq does not handle
     # this gracefully)
-    if line_count == 0:
+    if not variants:
         fatal_error('VCF file contains no variants.')
 
-    debug('Splitted VCF file to temporary files.')
+    debug('Split VCF file in %d parts.' % len(parts))
 
     vcf.close()
-    return part_files
+    return header, parts
 
 
-def wait_for_result(monitor_url, waiting):
+def wait_for_result(monitor_url, deadline):
     """
-    Monitor the job for progress. Return the number of seconds it took when
-    the job is completed.
+    Monitor the job for progress until it is completed. Give up if it is
+    not completed before {deadline} (in seconds since the epoch).
+
+    The time between polls is estimated from the progress reported by the
+    monitor with poll_interval.
     """
+    observations = []
+    interval = None
+
     while True:
-        if waiting > WAIT_MAX:
+        now = time.time()
+        if now > deadline:
             fatal_error('Job took too long.')
 
-        time.sleep(WAIT_STEP)
-        waiting += WAIT_STEP
+        interval = poll_interval(observations, interval)
+        time.sleep(min(interval, max(deadline - now, 0) + 1))
 
         # Response contains number of variants processed and total number of
         # variants separated by a comma
@@ -229,7 +1155,10 @@ def wait_for_result(monitor_url, waiting):
         if not len(monitor) == 2:
             fatal_error('Could not read progress from monitor.')
 
-        processed, total = monitor
+        try:
+            processed, total = map(int, monitor)
+        except ValueError:
+            fatal_error('Could not read progress from monitor.')
 
         # Todo: If we submit a file with 0 variants, the monitor page keeps
         # saying '0 variations in your file have been processed', even after
@@ -239,39 +1168,83 @@ def wait_for_result(monitor_url, waiting):
         # special case.
 
         # If no variants have yet been processed, we always get 0,0
-        if total == '0':
+        if total == 0:
             debug('Waiting for part: 0%')
             continue
 
-        debug('Waiting for part: %s / %s' % (processed, total))
+        debug('Waiting for part: %d / %d' % (processed, total))
 
         # See if we are done
         if processed == total:
             break
 
-    return waiting
+        observations.append( (time.time(), processed, total) )
+
+
+def poll_interval(observations, previous=None, uniform=random.uniform):
+    """
+    Estimate the number of seconds to wait before polling the monitor again.
+
+    The list {observations} contains tuples (time, processed, total) from
+    previous polls and {previous} is the previous interval. Jitter is added
+    with {uniform}.
 
+    If the job made progress, the interval is the estimated time until
+    completion at the rate observed so far. Otherwise, the previous interval
+    is multiplied by WAIT_BACKOFF. The interval is kept between WAIT_MIN and
+    WAIT_INTERVAL_MAX.
+    """
+    interval = None
+
+    if len(observations) > 1:
+        first_time, first_processed, _ = observations[0]
+        last_time, last_processed, total = observations[-1]
+        if last_time > first_time and last_processed > first_processed:
+            rate = (last_processed - first_processed) / \
+                   float(last_time - first_time)
+            interval = (total - last_processed) / rate
+
+    if interval is None:
+        interval = previous * WAIT_BACKOFF if previous else WAIT_MIN
+
+    interval *= uniform(1 - WAIT_JITTER, 1 + WAIT_JITTER)
+    return min(max(interval, WAIT_MIN), WAIT_INTERVAL_MAX)
 
-def append_result(result_url, output_file, versions, summary,
+
+def download_result(result_url):
+    """
+    Get plain-text result from server, asking for compressed transfer, and
+    return it as an open file reading from a compressed copy in memory.
+    """
+    response = get(result_url, {'Accept-Encoding': 'gzip'})
+    compressed = StringIO()
+    if response.info().get('Content-Encoding') == 'gzip':
+        shutil.copyfileobj(response, compressed, BUFFER_SIZE)
+    else:
+        result = gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=1)
+        shutil.copyfileobj(response, result, BUFFER_SIZE)
+        result.close()
+    response.close()
+    compressed.seek(0)
+
+    debug('Result downloaded: %s' % result_url)
+
+    return gzip.GzipFile(fileobj=compressed, mode='rb')
+
+
+def append_result(result, output_file, versions, summary,
                   discard_header=False):
     """
-    Get plain-text result from server and write it to a file.
+    Write plain-text result from an open file to a file.
     """
     try:
-        output = open(output_file, 'ab')
+        output = open(output_file, 'ab', BUFFER_SIZE)
     except IOError as (_, message):
         fatal_error(message)
 
-    response = get(result_url)
-
     in_header = True
 
-    # Buffered read/write
-    while True:
-        line = response.readline()
-        if not line:
-            break
-
+    for line in result:
         if line.startswith('#'):
             # Comment lines
             if in_header and not discard_header:
@@ -284,7 +1257,6 @@ def append_result(result_url, output_file, versions, summary,
 
     debug('Result written to: %s' % output_file)
 
-    response.close()
     output.close()
 
 
@@ -358,11 +1330,11 @@ def add_to_summary(versions, summary, line):
         summary[description] += count
 
 
-def get(url):
+def get(url, headers={}):
     """
     Do a HTTP GET request and return file-like response object.
     """
-    request = urllib2.Request(url)
+    request = urllib2.Request(url, headers=headers)
     response = urllib2.urlopen(request)
     return response
 
@@ -374,7 +1346,7 @@ def post_multipart(url, parameters={}):
     """
     register_openers()
     datagen, headers = multipart_encode(parameters)
-    request = urllib2.Request(POST_URL, datagen, headers)
+    request = urllib2.Request(url, datagen, headers)
     response = urllib2.urlopen(request)
     return response
 
@@ -383,24 +1355,45 @@ def debug(message):
     if DEBUG: print message
 
 
+def warning(message):
+    print 'Warning: %s' % message
+
+
 def fatal_error(message):
     print 'Error: %s' % message
     sys.exit(1)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
+    arguments = sys.argv[1:]
+    batch = False
+    while len(arguments) > 1 and arguments[0] in ('-b', '-c'):
+        if arguments[0] == '-b':
+            batch = True
+            arguments = arguments[1:]
+        else:
+            CACHE_FILE = arguments[1]
+            arguments = arguments[2:]
+    if len(arguments) < 2 or (not batch and len(arguments) > 2):
         print """Annotate variants using SeattleSeq Annotation.
 
 Given a VCF file with variants, submit the file to the SeattleSeq Annotation
 web interface [1]. The annotation result is retrieved as tab-separated file.
 
 Usage:
-  {command} <input.vcf> <mail@domain.com>
+  {command} [-c <cache.sqlite>] <input.vcf> <mail@domain.com>
+  {command} [-c <cache.sqlite>] -b <mail@domain.com> <input.vcf> [...]
+
+The result is written to disk as <input.vcf.annotation>. With -c,
+annotations are cached in the given SQLite database and only variants not in
+the cache are submitted (the VCF file must be sorted by position).
 
-The result is written to disk as <input.vcf.annotation>. Temporary data is
-written to <input.vcf.part.*> files and removed afterwards.
+With -b, the distinct variants in all (sorted) VCF files are submitted at
+once and the result is written to <input.vcf.annotation> for each file.
 
 [1] {url}""".format(command=sys.argv[0], url=BASE_URL)
         sys.exit(1)
-    seattle_seq_annotation(sys.argv[1], sys.argv[2])
+    if batch:
+        batch_annotation(arguments[1:], arguments[0])
+    else:
+        seattle_seq_annotation(arguments[0], arguments[1])
@@ -0,0 +1,152 @@
+"""
+Local stand-in for the SeattleSeq Annotation BatchQueryServlet.
+
+Mimics the protocol used by seattle_seq_annotation.py: a multipart POST to
+/BatchQueryServlet with a GenotypeFile is answered by a result url and a
+monitor url separated by a comma. The monitor url answers with the number of
+processed variants and the total number of variants separated by a comma
+(0,0 before processing started). The result url serves a tab-separated
+annotation with one row per variant, followed by summary comment lines,
+gzip compressed if the client accepts that.
+
+Every job needs a number of polls before it is completed, taken from the
+server's `polls` list in submission order (default: DEFAULT_POLLS).
+
+Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+"""
+
+
+import cgi
+import gzip
+import threading
+from cStringIO import StringIO
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+# Number of polls before a job is completed
+DEFAULT_POLLS = 2
+
+# Columns in the annotation result
+COLUMNS = ['inDBSNPOrNot', 'chromosome', 'position', 'referenceBase',
+           'sampleGenotype', 'sampleAlleles', 'functionGVS']
+
+# Version reported in the result summary
+VERSION = 'NCBI_hg19 SeattleSeqAnnotation137Version_stand-in'
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server keeping track of submitted jobs.
+    """
+    daemon_threads = True
+
+    def __init__(self, polls=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.polls = list(polls or [])
+        self.jobs = []
+        self.downloads = []
+        self.compressed = []
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Handle requests for the BatchQueryServlet, monitor, and result urls.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, body, status=200, compress=False):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        if compress:
+            buffer = StringIO()
+            compressed = gzip.GzipFile(fileobj=buffer, mode='wb')
+            compressed.write(body)
+            compressed.close()
+            body = buffer.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.endswith('/BatchQueryServlet'):
+            return self.respond('Not found\n', 404)
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST',
+                                         'CONTENT_TYPE':
+                                         self.headers['Content-Type']})
+        genotypes = form['GenotypeFile'].value
+        variants = [line.split('\t')[:5] for line in genotypes.splitlines()
+                    if line and not line.startswith('#')]
+        server = self.server
+        with server.lock:
+            index = len(server.jobs)
+            polls = server.polls[index] if index < len(server.polls) \
+                    else DEFAULT_POLLS
+            server.jobs.append({'variants': variants,
+                                'columns': form.getlist('columns'),
+                                'polls': polls,
+                                'polled': 0})
+        self.respond('%sresult/%d,%smonitor/%d\n' % (server.base_url, index,
+                                                     server.base_url, index))
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        try:
+            job = self.server.jobs[int(parts[-1])]
+        except (IndexError, ValueError):
+            return self.respond('Not found\n', 404)
+        if parts[-2] == 'monitor':
+            with self.server.lock:
+                job['polled'] += 1
+                polled = job['polled']
+            total = len(job['variants'])
+            if polled == 1:
+                return self.respond('0,0\n')
+            processed = min(total, total * (polled - 1) // job['polls'])
+            return self.respond('%d,%d\n' % (processed, total))
+        if parts[-2] == 'result':
+            compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+            with self.server.lock:
+                self.server.downloads.append(int(parts[-1]))
+                self.server.compressed.append(compress)
+            return self.respond(annotation(job['variants']),
+                                compress=compress)
+        self.respond('Not found\n', 404)
+
+
+def annotation(variants):
+    """
+    Create an annotation result for {variants}, a list of (chromosome,
+    position, id, reference, alternate) tuples.
+    """
+    lines = ['# %s\n' % '\t'.join(COLUMNS)]
+    missense = 0
+    for chromosome, position, _, reference, alternate in variants:
+        function = 'missense' if int(position) % 2 else 'intron'
+        missense += function == 'missense'
+        lines.append('\t'.join(['none', chromosome, position, reference,
+                                alternate, '%s/%s' % (reference, alternate),
+                                function]) + '\n')
+    lines.append('# geneDataSource %s\n' % VERSION)
+    lines.append('#\n')
+    lines.append('# Count Missense SNPs = %d\n' % missense)
+    lines.append('# number SNPs total = %d\n' % len(variants))
+    return ''.join(lines)
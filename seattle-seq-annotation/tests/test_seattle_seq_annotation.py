@@ -0,0 +1,557 @@
+"""
+Tests for seattle_seq_annotation.py against a local stand-in server.
+
+Run from this directory with:
+
+  python -m unittest discover
+
+Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+"""
+
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+import urllib2
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import seattle_seq_annotation
+import stand_in_server
+from stand_in_server import StandInServer
+
+
+VCF_HEADER = '##fileformat=VCFv4.1\n' \
+             '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def vcf_lines(count):
+    return ['1\t%d\t.\tA\tG\t50\tPASS\t.\n' % (100 + i) for i in range(count)]
+
+
+class TestSeattleSeqAnnotation(unittest.TestCase):
+    """
+    Submit VCF files to a stand-in server and check the annotation file.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = dict((name, getattr(seattle_seq_annotation, name))
+                             for name in ('POST_URL', 'WAIT_MIN',
+                                          'WAIT_INTERVAL_MAX', 'DEBUG',
+                                          'MAX_VARIANTS', 'CACHE_FILE'))
+        seattle_seq_annotation.WAIT_MIN = 0.01
+        seattle_seq_annotation.WAIT_INTERVAL_MAX = 0.05
+        seattle_seq_annotation.DEBUG = False
+        seattle_seq_annotation.MAX_VARIANTS = 3
+        seattle_seq_annotation.CACHE_FILE = None
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            setattr(seattle_seq_annotation, name, value)
+        shutil.rmtree(self.directory)
+
+    def start_server(self, polls=None):
+        server = StandInServer(polls)
+        server.start()
+        self.addCleanup(server.stop)
+        seattle_seq_annotation.POST_URL = server.base_url + \
+                                          'BatchQueryServlet'
+        return server
+
+    def annotate(self, lines=None):
+        vcf_file = os.path.join(self.directory, 'sample.vcf')
+        if lines is not None:
+            with open(vcf_file, 'w') as vcf:
+                vcf.write(VCF_HEADER + ''.join(lines))
+        seattle_seq_annotation.seattle_seq_annotation(vcf_file,
+                                                      'test@example.com')
+        with open(vcf_file + '.annotation') as annotation:
+            return annotation.read().splitlines()
+
+    def rows(self, annotation):
+        return [line.split('\t') for line in annotation
+                if not line.startswith('#')]
+
+    def test_annotation(self):
+        """
+        All variants are annotated once, with the header once and a summary
+        over all parts.
+        """
+        self.start_server()
+        annotation = self.annotate(vcf_lines(7))
+        self.assertEqual([int(row[2]) for row in self.rows(annotation)],
+                         range(100, 107))
+        self.assertEqual(annotation[0].split('\t')[1], 'chromosome')
+        self.assertEqual(annotation.count(annotation[0]), 1)
+        self.assertIn('# number SNPs total = 7', annotation)
+        self.assertIn('# Count Missense SNPs = 3', annotation)
+
+    def test_streaming(self):
+        """
+        Parts are uploaded without writing them to disk and results are
+        downloaded compressed.
+        """
+        server = self.start_server()
+        lines = vcf_lines(7)
+        lines[-1] = lines[-1].rstrip('\n')
+        annotation = self.annotate(lines)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['sample.vcf', 'sample.vcf.annotation'])
+        self.assertEqual(server.compressed, [True] * 3)
+        self.assertEqual([job['variants'] for job in server.jobs],
+                         [[line.split('\t')[:5] for line in lines[i:i + 3]]
+                          for i in range(0, 7, 3)])
+        self.assertEqual(len(self.rows(annotation)), 7)
+
+    def test_resume(self):
+        """
+        An interrupted run is resumed without submitting parts again and
+        without writing parts twice.
+        """
+        server = self.start_server(polls=[1, 1, 8])
+        append_result = seattle_seq_annotation.append_result
+        written = []
+
+        def interrupted(*args, **kwargs):
+            if len(written) == 2:
+                raise KeyboardInterrupt()
+            written.append(args[1])
+            append_result(*args, **kwargs)
+
+        seattle_seq_annotation.append_result = interrupted
+        self.addCleanup(setattr, seattle_seq_annotation, 'append_result',
+                        append_result)
+        self.assertRaises(KeyboardInterrupt, self.annotate, vcf_lines(7))
+        journal = os.path.join(self.directory,
+                               'sample.vcf.annotation.journal')
+        self.assertTrue(os.path.exists(journal))
+
+        seattle_seq_annotation.append_result = append_result
+        with open(os.path.join(self.directory, 'sample.vcf.annotation'),
+                  'a') as annotation:
+            annotation.write('partial line')
+        annotation = self.annotate()
+        self.assertEqual(len(server.jobs), 3)
+        self.assertEqual([int(row[2]) for row in self.rows(annotation)],
+                         range(100, 107))
+        self.assertEqual(annotation.count(annotation[0]), 1)
+        self.assertIn('# number SNPs total = 7', annotation)
+        self.assertFalse(os.path.exists(journal))
+
+    def test_changed_file(self):
+        """
+        A journal for another version of the VCF file is not used.
+        """
+        server = self.start_server()
+        self.annotate(vcf_lines(4))
+        vcf_file = os.path.join(self.directory, 'sample.vcf')
+        with open(vcf_file + '.annotation.journal', 'w') as journal:
+            journal.write('{"identity": {}, "parts": []}')
+        annotation = self.annotate(vcf_lines(5))
+        self.assertEqual(len(server.jobs), 4)
+        self.assertEqual(len(self.rows(annotation)), 5)
+
+    def test_batch(self):
+        """
+        The distinct variants in many VCF files are submitted once, and the
+        rows and summary counts are split per file.
+        """
+        server = self.start_server()
+        lines = vcf_lines(6)
+        samples = {'a.vcf': lines[0:4],
+                   'b.vcf': lines[2:6],
+                   'c.vcf': lines[1:2] + lines[5:6]}
+        vcf_files = []
+        for name, sample_lines in sorted(samples.items()):
+            vcf_files.append(os.path.join(self.directory, name))
+            with open(vcf_files[-1], 'w') as vcf:
+                vcf.write(VCF_HEADER + ''.join(sample_lines))
+        seattle_seq_annotation.batch_annotation(vcf_files, 'test@example.com')
+
+        self.assertEqual(sum(len(job['variants']) for job in server.jobs), 6)
+        for vcf_file in vcf_files:
+            sample_lines = samples[os.path.basename(vcf_file)]
+            positions = [int(line.split('\t')[1]) for line in sample_lines]
+            with open(vcf_file + '.annotation') as annotation:
+                annotation = annotation.read().splitlines()
+            self.assertEqual([int(row[2]) for row in self.rows(annotation)],
+                             positions)
+            self.assertEqual(annotation[0].split('\t')[1], 'chromosome')
+            self.assertIn('# number SNPs total = %d' % len(positions),
+                          annotation)
+            self.assertIn('# Count Missense SNPs = %d' %
+                          sum(p % 2 for p in positions), annotation)
+            self.assertIn('# Count SNPs in Introns = %d' %
+                          sum(1 - p % 2 for p in positions), annotation)
+            self.assertIn('# geneDataSource NCBI_hg19 '
+                          'SeattleSeqAnnotation137Version_stand-in',
+                          annotation)
+
+    def test_batch_unmatched(self):
+        """
+        Annotation rows matching no variant are left out, and the rows of
+        the following variants are still split per file.
+        """
+        annotation = stand_in_server.annotation
+        self.addCleanup(setattr, stand_in_server, 'annotation', annotation)
+
+        def shifted(variants):
+            # An extra row at position 102, as for an indel reported at a
+            # shifted position.
+            lines = annotation(variants).splitlines(True)
+            lines.insert(3, lines[2].replace('\t101\t', '\t102\t'))
+            return ''.join(lines)
+
+        stand_in_server.annotation = shifted
+        self.start_server()
+        seattle_seq_annotation.MAX_VARIANTS = 5
+        lines = vcf_lines(5)
+        del lines[2]
+        vcf_files = []
+        for name, sample_lines in ('a.vcf', lines[0:3]), ('b.vcf', lines[1:]):
+            vcf_files.append(os.path.join(self.directory, name))
+            with open(vcf_files[-1], 'w') as vcf:
+                vcf.write(VCF_HEADER + ''.join(sample_lines))
+        seattle_seq_annotation.batch_annotation(vcf_files, 'test@example.com')
+        for vcf_file, positions in zip(vcf_files, [[100, 101, 103],
+                                                   [101, 103, 104]]):
+            with open(vcf_file + '.annotation') as annotation_file:
+                rows = self.rows(annotation_file.read().splitlines())
+            self.assertEqual([int(row[2]) for row in rows], positions)
+
+    def test_batch_alleles(self):
+        """
+        At a position with different variants in different files, each file
+        gets only the rows of its own alleles.
+        """
+        self.start_server()
+        lines = vcf_lines(2)
+        other = lines[0].replace('\tG\t', '\tT\t')
+        vcf_files = []
+        for name, sample_lines in ('a.vcf', lines), ('b.vcf', [other]):
+            vcf_files.append(os.path.join(self.directory, name))
+            with open(vcf_files[-1], 'w') as vcf:
+                vcf.write(VCF_HEADER + ''.join(sample_lines))
+        seattle_seq_annotation.batch_annotation(vcf_files, 'test@example.com')
+        for vcf_file, alternates in zip(vcf_files, [['G', 'G'], ['T']]):
+            with open(vcf_file + '.annotation') as annotation:
+                annotation = annotation.read().splitlines()
+            self.assertEqual([row[4] for row in self.rows(annotation)],
+                             alternates)
+            self.assertIn('# number SNPs total = %d' % len(alternates),
+                          annotation)
+
+    def test_batch_resume(self):
+        """
+        An interrupted batch run is resumed without submitting the merged
+        variants again, and the merged variants are removed when done.
+        """
+        server = self.start_server(polls=[1, 8])
+        lines = vcf_lines(6)
+        vcf_files = []
+        for name, sample_lines in ('a.vcf', lines[0:4]), ('b.vcf', lines[2:6]):
+            vcf_files.append(os.path.join(self.directory, name))
+            with open(vcf_files[-1], 'w') as vcf:
+                vcf.write(VCF_HEADER + ''.join(sample_lines))
+
+        append_result = seattle_seq_annotation.append_result
+        self.addCleanup(setattr, seattle_seq_annotation, 'append_result',
+                        append_result)
+
+        def interrupted(*args, **kwargs):
+            append_result(*args, **kwargs)
+            raise KeyboardInterrupt()
+
+        seattle_seq_annotation.append_result = interrupted
+        self.assertRaises(KeyboardInterrupt,
+                          seattle_seq_annotation.batch_annotation, vcf_files,
+                          'test@example.com')
+        self.assertTrue(os.path.exists(
+            vcf_files[0] + '.sites.vcf.annotation.journal'))
+
+        seattle_seq_annotation.append_result = append_result
+        seattle_seq_annotation.batch_annotation(vcf_files, 'test@example.com')
+        self.assertEqual(len(server.jobs), 2)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['a.vcf', 'a.vcf.annotation', 'b.vcf',
+                          'b.vcf.annotation'])
+        with open(vcf_files[1] + '.annotation') as annotation:
+            rows = self.rows(annotation.read().splitlines())
+        self.assertEqual([int(row[2]) for row in rows], range(102, 106))
+
+    def test_batch_unsorted(self):
+        """
+        Unsorted VCF files are rejected in batch mode.
+        """
+        self.start_server()
+        vcf_file = os.path.join(self.directory, 'unsorted.vcf')
+        with open(vcf_file, 'w') as vcf:
+            vcf.write(VCF_HEADER + ''.join(reversed(vcf_lines(3))))
+        self.assertRaises(SystemExit, seattle_seq_annotation.batch_annotation,
+                          [vcf_file], 'test@example.com')
+
+    def test_part_order(self):
+        """
+        Parts completed out of order are written in part order.
+        """
+        server = self.start_server(polls=[12, 1, 6])
+        annotation = self.annotate(vcf_lines(7))
+        self.assertEqual(server.downloads, [1, 2, 0])
+        self.assertEqual([int(row[2]) for row in self.rows(annotation)],
+                         range(100, 107))
+
+    def test_download_error(self):
+        """
+        A failing download in a worker thread is reported before exiting,
+        and other errors are raised again.
+        """
+        self.start_server()
+        download_result = seattle_seq_annotation.download_result
+        self.addCleanup(setattr, seattle_seq_annotation, 'download_result',
+                        download_result)
+
+        def unreachable(result_url):
+            raise urllib2.URLError('unreachable')
+
+        seattle_seq_annotation.download_result = unreachable
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertRaises(SystemExit, self.annotate, vcf_lines(2))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn('Error: Could not retrieve result', output)
+
+        def broken(result_url):
+            raise KeyError('broken')
+
+        seattle_seq_annotation.download_result = broken
+        self.assertRaises(KeyError, self.annotate, vcf_lines(2))
+
+    def test_cache(self):
+        """
+        Only variants not in the cache are submitted, and cached and fresh
+        rows are written in VCF order.
+        """
+        seattle_seq_annotation.CACHE_FILE = os.path.join(self.directory,
+                                                         'cache.sqlite')
+        server = self.start_server()
+        lines = vcf_lines(9)
+        first = self.annotate(lines[2:4] + lines[6:8])
+        second = self.annotate(lines)
+        self.assertEqual([len(job['variants']) for job in server.jobs],
+                         [3, 1, 3, 2])
+        self.assertEqual([int(row[2]) for row in self.rows(second)],
+                         range(100, 109))
+        self.assertEqual(second[0], first[0])
+        self.assertIn('# number variants from local cache = 4', second)
+        self.assertIn('# number SNPs total = 9', second)
+        self.assertIn('# Count Missense SNPs = 4', second)
+        self.assertIn('# Count SNPs in Introns = 5', second)
+
+    def test_cache_unmatched(self):
+        """
+        A result row matching no variant is written in place, and the rows
+        of the following variants are still matched and cached.
+        """
+        seattle_seq_annotation.CACHE_FILE = os.path.join(self.directory,
+                                                         'cache.sqlite')
+        annotation = stand_in_server.annotation
+        self.addCleanup(setattr, stand_in_server, 'annotation', annotation)
+
+        def shifted(variants):
+            # An extra row at position 102, as for an indel reported at a
+            # shifted position.
+            lines = annotation(variants).splitlines(True)
+            if len(variants) > 2:
+                lines.insert(3, lines[2].replace('\t101\t', '\t102\t'))
+            return ''.join(lines)
+
+        stand_in_server.annotation = shifted
+        server = self.start_server()
+        seattle_seq_annotation.MAX_VARIANTS = 5
+        lines = vcf_lines(5)
+        del lines[2]
+        first = self.annotate(lines)
+        self.assertEqual([int(row[2]) for row in self.rows(first)],
+                         [100, 101, 102, 103, 104])
+        self.assertIn('# number SNPs total = 4', first)
+        second = self.annotate(lines)
+        self.assertEqual(len(server.jobs), 1)
+        self.assertEqual([int(row[2]) for row in self.rows(second)],
+                         [100, 101, 103, 104])
+        self.assertIn('# number variants from local cache = 4', second)
+
+    def test_cache_only(self):
+        """
+        Nothing is submitted if all variants are in the cache.
+        """
+        seattle_seq_annotation.CACHE_FILE = os.path.join(self.directory,
+                                                         'cache.sqlite')
+        server = self.start_server()
+        first = self.annotate(vcf_lines(5))
+        second = self.annotate(vcf_lines(5))
+        self.assertEqual(len(server.jobs), 2)
+        self.assertEqual(self.rows(second), self.rows(first))
+        self.assertEqual(second[0], first[0])
+        self.assertIn('# geneDataSource NCBI_hg19 '
+                      'SeattleSeqAnnotation137Version_stand-in', second)
+
+    def test_cache_version(self):
+        """
+        Cached variants are annotated again if the server version changed.
+        """
+        seattle_seq_annotation.CACHE_FILE = os.path.join(self.directory,
+                                                         'cache.sqlite')
+        self.addCleanup(setattr, stand_in_server, 'VERSION',
+                        stand_in_server.VERSION)
+        server = self.start_server()
+        lines = vcf_lines(5)
+        self.annotate(lines[:3])
+        stand_in_server.VERSION = 'NCBI_hg19 SeattleSeqAnnotation138Version_1'
+        annotation = self.annotate(lines)
+        self.assertEqual([len(job['variants']) for job in server.jobs],
+                         [3, 2, 3])
+        self.assertEqual([int(row[2]) for row in self.rows(annotation)],
+                         range(100, 105))
+        self.assertIn('# geneDataSource NCBI_hg19 '
+                      'SeattleSeqAnnotation138Version_1', annotation)
+        self.assertNotIn('# geneDataSource NCBI_hg19 '
+                         'SeattleSeqAnnotation137Version_stand-in',
+                         annotation)
+        self.assertIn('# number variants from local cache = 2', annotation)
+        self.annotate(lines)
+        self.assertEqual(len(server.jobs), 3)
+
+    def test_cache_alleles(self):
+        """
+        Variants with other alleles at a cached position are submitted.
+        """
+        seattle_seq_annotation.CACHE_FILE = os.path.join(self.directory,
+                                                         'cache.sqlite')
+        server = self.start_server()
+        self.annotate(vcf_lines(3))
+        other = [line.replace('\tG\t', '\tT\t') for line in vcf_lines(3)]
+        annotation = self.annotate(other)
+        self.assertEqual(len(server.jobs), 2)
+        self.assertEqual([row[4] for row in self.rows(annotation)],
+                         ['T'] * 3)
+
+
+class SimulatedMonitor(object):
+    """
+    Simulated clock and monitor for a job of {total} variants that starts
+    processing after {delay} seconds and is completed after {duration}
+    seconds.
+    """
+    def __init__(self, total, delay, duration):
+        self.total = total
+        self.delay = delay
+        self.duration = duration
+        self.now = 0.0
+        self.polls = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def get(self, url):
+        self.polls.append(self.now)
+        if self.now < self.delay:
+            return StringIO('0,0\n')
+        fraction = min(1.0, (self.now - self.delay) /
+                       (self.duration - self.delay))
+        return StringIO('%d,%d\n' % (int(fraction * self.total), self.total))
+
+
+class TestPolling(unittest.TestCase):
+    """
+    Test the poll interval estimator, also against a simulated monitor.
+    """
+    def setUp(self):
+        random.seed(42)
+        self.patched = dict((name, getattr(seattle_seq_annotation, name))
+                            for name in ('time', 'get', 'DEBUG'))
+        seattle_seq_annotation.DEBUG = False
+
+    def tearDown(self):
+        for name, value in self.patched.items():
+            setattr(seattle_seq_annotation, name, value)
+
+    def wait(self, monitor):
+        seattle_seq_annotation.time = monitor
+        seattle_seq_annotation.get = monitor.get
+        seattle_seq_annotation.wait_for_result('monitor', 43200)
+        return monitor.now
+
+    def test_first_interval(self):
+        """
+        Without observations, the first poll is after the minimum interval.
+        """
+        interval = seattle_seq_annotation.poll_interval([], uniform=max)
+        self.assertAlmostEqual(interval, seattle_seq_annotation.WAIT_MIN *
+                               (1 + seattle_seq_annotation.WAIT_JITTER))
+
+    def test_backoff(self):
+        """
+        Without progress, the interval is backed off up to the maximum.
+        """
+        no_progress = [(0, 10, 100), (30, 10, 100)]
+        interval = seattle_seq_annotation.poll_interval(
+            no_progress, 40, uniform=lambda a, b: 1)
+        self.assertEqual(interval, 40 * seattle_seq_annotation.WAIT_BACKOFF)
+        interval = seattle_seq_annotation.poll_interval(
+            no_progress, 10000, uniform=lambda a, b: 1)
+        self.assertEqual(interval, seattle_seq_annotation.WAIT_INTERVAL_MAX)
+
+    def test_estimate(self):
+        """
+        With progress, the interval is the estimated time to completion.
+        """
+        interval = seattle_seq_annotation.poll_interval(
+            [(0, 10, 100), (20, 30, 100)], 20, uniform=lambda a, b: 1)
+        self.assertEqual(interval, 70)
+
+    def test_jitter(self):
+        """
+        Intervals vary by at most the jitter fraction.
+        """
+        intervals = [seattle_seq_annotation.poll_interval([], 100)
+                     for _ in range(100)]
+        jitter = seattle_seq_annotation.WAIT_JITTER
+        self.assertTrue(all(200 * (1 - jitter) <= i <= 200 * (1 + jitter)
+                            for i in intervals))
+        self.assertTrue(len(set(intervals)) > 1)
+
+    def test_small_job(self):
+        """
+        A small job is detected as completed shortly after it completes.
+        """
+        monitor = SimulatedMonitor(1000, delay=5, duration=20)
+        waited = self.wait(monitor)
+        self.assertTrue(20 <= waited < 50)
+
+    def test_large_job(self):
+        """
+        A large job is polled much less often than every two minutes, and
+        never more often than the minimum interval.
+        """
+        monitor = SimulatedMonitor(900000, delay=600, duration=6 * 3600)
+        waited = self.wait(monitor)
+        self.assertTrue(6 * 3600 <= waited < 6 * 3600 + 900)
+        self.assertTrue(len(monitor.polls) < 6 * 3600 / 120 / 2)
+        intervals = [b - a for a, b in zip(monitor.polls, monitor.polls[1:])]
+        self.assertTrue(min(intervals) >= seattle_seq_annotation.WAIT_MIN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,14 +7,21 @@ re-sync the filtered reads by filtering out anything that is only present in
 one of the two files.
 
 Usage:
-  {command} <orig.fq> <reads_1.fq> <reads_2.fq> \\
-      <reads_1.synced.fq> <reads_2.synced.fq>
+  {command} [--stats] [--profile <file>] <orig.fq> <reads_1.fq> \\
+      <reads_2.fq> <reads_1.synced.fq> <reads_2.synced.fq>
 
 The synced reads are written to disk as <reads_1.synced.fq> and
 <reads_2.synced.fq>. Afterwards some counts are printed.
 
-Both Illumina old-style and new-style paired-end header lines are supported
-and any (input or output) filename ending in .gz is assumed to be gzipped.
+Both Illumina old-style and new-style paired-end header lines are supported.
+Input files compressed with gzip are detected automatically and any output
+filename ending in .gz is written gzipped. One of the input files can be read
+from standard input and one of the output files can be written to standard
+output by using - as its filename, the counts are then printed to standard
+error.
+
+With --stats, time spent per phase, throughput, and memory use are reported
+on standard error. With --profile, a cProfile profile is written to <file>.
 
 
 The original read file is used to speed up processing: it contains all
@@ -29,10 +36,19 @@ Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
 """
 
 
-import gzip
+import os
 import re
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import open_file, read_fastq
+import instrument
+
+
+# Record returned at the end of a read file
+NO_RECORD = ('', '', '', '')
+
 
 def sync_paired_end_reads(original, reads_a, reads_b, synced_a, synced_b):
     """
@@ -60,60 +76,68 @@ def sync_paired_end_reads(original, reads_a, reads_b, synced_a, synced_b):
     # match in a header line is used to identify the read pair.
     sep = re.compile('[\s_/][123]')
 
-    def next_record(fh):
-        return [fh.readline().strip() for i in range(4)]
+    records_a = instrument.timed(read_fastq(reads_a), 'parse', records=False)
+    records_b = instrument.timed(read_fastq(reads_b), 'parse', records=False)
 
     def head(record):
         return sep.split(record[0])[:-1]
 
-    headers = (sep.split(x.strip())[:-1] for i, x in enumerate(original)
-               if not (i % 4))
+    headers = (head(record) for record
+               in instrument.timed(read_fastq(original), 'parse'))
 
     filtered_a = filtered_b = kept = 0
 
-    a, b = next_record(reads_a), next_record(reads_b)
+    a, b = next(records_a, NO_RECORD), next(records_b, NO_RECORD)
 
     for header in headers:
         if header == head(a) and head(b) != header:
-            a = next_record(reads_a)
+            a = next(records_a, NO_RECORD)
             filtered_a += 1
 
         if header == head(b) and head(a) != header:
-            b = next_record(reads_b)
+            b = next(records_b, NO_RECORD)
             filtered_b += 1
 
         if header == head(a) == head(b):
             print >>synced_a, '\n'.join(a)
             print >>synced_b, '\n'.join(b)
-            a, b = next_record(reads_a), next_record(reads_b)
+            a, b = next(records_a, NO_RECORD), next(records_b, NO_RECORD)
             kept += 1
 
     return filtered_a, filtered_b, kept
 
 
-def _open(filename, mode='r'):
-    if filename.endswith('.gz'):
-        return gzip.open(filename, mode)
-    return open(filename, mode)
-
-
 if __name__ == '__main__':
-    if len(sys.argv) < 6:
+    arguments = instrument.strip_arguments(sys.argv[1:])
+    if len(arguments) < 5:
         sys.stderr.write(__doc__.split('\n\n\n')[0].strip().format(
             command=sys.argv[0]) + '\n')
         sys.exit(1)
+    if arguments[:3].count('-') > 1 or arguments[3:5].count('-') > 1:
+        sys.stderr.write('Error: Only one input and one output file can be '
+                         '-.\n')
+        sys.exit(1)
+    counts = sys.stderr if '-' in arguments[3:5] else sys.stdout
     try:
-        original = _open(sys.argv[1], 'r')
-        reads_a = _open(sys.argv[2], 'r')
-        reads_b = _open(sys.argv[3], 'r')
-        synced_a = _open(sys.argv[4], 'w')
-        synced_b = _open(sys.argv[5], 'w')
+        for filename in arguments[:3]:
+            instrument.add_input(filename)
+        for filename in arguments[3:5]:
+            instrument.add_output(filename)
+        original = instrument.timed_reader(open_file(arguments[0], 'r'))
+        reads_a = instrument.timed_reader(open_file(arguments[1], 'r'))
+        reads_b = instrument.timed_reader(open_file(arguments[2], 'r'))
+        synced_a = instrument.timed_writer(open_file(arguments[3], 'w'))
+        synced_b = instrument.timed_writer(open_file(arguments[4], 'w'))
         filtered_a, filtered_b, kept = \
-                    sync_paired_end_reads(original, reads_a, reads_b,
-                                          synced_a, synced_b)
-        print 'Filtered %i reads from first read file.' % filtered_a
-        print 'Filtered %i reads from second read file.' % filtered_b
-        print 'Synced read files contain %i reads.' % kept
+                    instrument.run(sync_paired_end_reads, original, reads_a,
+                                   reads_b, synced_a, synced_b)
+        print >>counts, 'Filtered %i reads from first read file.' % filtered_a
+        print >>counts, 'Filtered %i reads from second read file.' % \
+              filtered_b
+        print >>counts, 'Synced read files contain %i reads.' % kept
     except IOError as (_, message):
         sys.stderr.write('Error: %s\n' % message)
         sys.exit(1)
+    except ValueError as error:
+        sys.stderr.write('Error: %s\n' % error)
+        sys.exit(1)
@@ -0,0 +1,678 @@
+#!/usr/bin/env python
+
+# Merge VCF files sorted by position into one multi-sample VCF file.
+#
+# Usage:
+#   ./vcf_merge.py [-o merged.vcf] sample1.vcf.gz sample2.vcf.gz ...
+#   ./vcf_merge.py -j processes -o merged.vcf.gz sample1.vcf.gz ...
+#
+# The VCF files can be compressed with gzip or bgzip (detected automatically)
+# and must be sorted by chromosome and position. The chromosome order is
+# taken from the ##contig header lines, or is by number and name if there are
+# none. The files are merged with a heap, reading one record at a time from
+# each file, so memory use does not depend on the size or number of files.
+#
+# Records at the same position are merged into one line if their REF alleles
+# agree, where a shorter REF (e.g., of a SNP) is extended with the reference
+# bases of a longer one (e.g., of a deletion) and its ALT alleles likewise.
+# The ALT alleles of all records are combined and the GT fields are remapped
+# to the combined alleles. Records that cannot be merged (or a second record
+# of the same file at that position) are written on separate lines.
+#
+# All FORMAT fields (such as DP) are kept per sample. Fields with a value per
+# allele (Number=R, Number=A, e.g., AD) or per genotype (Number=G, e.g., PL)
+# are remapped to the combined alleles. Samples without a record on a line
+# get missing values. The QUAL is the maximum of the records (written as in
+# its file), IDs and FILTERs are combined, and the INFO field is replaced by
+# AC and AN calculated from the merged genotypes.
+#
+# If sample names are not unique over the files, the samples are named by
+# filename and sample name.
+#
+# If the output filename ends in .gz, it is compressed with bgzip and (if
+# pysam [1] is available) indexed with tabix [2]. One of the VCF files can be
+# read from standard input by giving - as its filename (not with -j), and the
+# output is written to standard output if its filename is - or not given.
+#
+# With -j, the files must be compressed with bgzip and indexed with tabix.
+# The genome is split in chunks of CHUNK_SIZE bases (using the contig lengths
+# from the ##contig header lines), and chunks are merged in parallel by that
+# many worker processes, each reading only its chunk from the indexes. Every
+# chunk is compressed to BGZF blocks by its worker (per BUFFER_SIZE bytes of
+# merged lines), and the blocks are written to the output file as they are,
+# in order. This requires pysam.
+#
+# [1] http://code.google.com/p/pysam/
+# [2] http://samtools.sourceforge.net/tabix.shtml
+#
+# Copyright (c) 2011 Leiden University Medical Center <humgen@lumc.nl>
+# Copyright (c) 2011 Martijn Vermaat <m.vermaat.hg@lumc.nl>
+
+
+import sys
+import os
+import heapq
+import multiprocessing
+import re
+import struct
+import zlib
+from collections import OrderedDict
+from functools import partial
+
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from formats import handle_broken_pipe, open_file
+
+
+# Genotype for samples without a record
+MISSING_GENOTYPE = './.'
+
+# Number of values of FORMAT fields without header definition
+DEFAULT_NUMBERS = {'AD': 'R',
+                   'GL': 'G',
+                   'PL': 'G'}
+
+# Header lines for the calculated INFO fields
+INFO_HEADER = """
+##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count in genotypes, for each ALT allele">
+##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of alleles in called genotypes">
+""".lstrip()
+
+# Number of bases to merge per worker process
+CHUNK_SIZE = 5000000
+
+# Maximum number of bytes in a BGZF block before compression
+BGZF_BLOCK_SIZE = 65280
+
+# Approximate number of bytes to compress to BGZF blocks at once
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# Empty BGZF block marking the end of a BGZF file
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43' \
+           '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# Header line fields like ##FORMAT=<ID=DP,Number=1,...>
+HEADER_FIELDS = re.compile(r'([A-Za-z]+)=("[^"]*"|[^,>]*)')
+
+
+def main(vcf_files, output_file=None, processes=1):
+    """
+    Merge the VCF files and write the result to {output_file} (or standard
+    output).
+
+    If {processes} is more than one, the files must be indexed with tabix
+    and are merged per chunk by that many worker processes.
+    """
+    inputs = []
+    for vcf_file in vcf_files:
+        try:
+            vcf = open_file(vcf_file)
+        except IOError as (_, message):
+            print 'Could not read VCF file: %s' % vcf_file
+            sys.exit(1)
+        inputs.append( (vcf, read_header(vcf, vcf_file)) )
+
+    headers = [header for _, header in inputs]
+
+    if output_file:
+        try:
+            output = open(output_file, 'wb')
+        except IOError as (_, message):
+            print 'Could not write output file: %s' % output_file
+            sys.exit(1)
+    else:
+        output = sys.stdout
+
+    compress = bool(output_file) and output_file.endswith('.gz')
+
+    if compress:
+        output.write(bgzf_compress(merged_header(headers, vcf_files)))
+    else:
+        output.write(merged_header(headers, vcf_files))
+
+    if processes > 1:
+        for vcf, _ in inputs:
+            vcf.close()
+        # Chunks are listed before starting, as errors in a generator
+        # feeding the pool would leave it waiting.
+        chunks = list(genome_chunks(vcf_files, headers))
+        pool = multiprocessing.Pool(processes)
+        chunks = pool.imap(partial(merge_chunk, vcf_files, headers), chunks)
+        try:
+            for blocks in chunks:
+                output.write(blocks)
+        except RuntimeError:
+            pool.terminate()
+            sys.exit(1)
+        pool.close()
+        pool.join()
+    else:
+        lines = merge_files([vcf for vcf, _ in inputs], headers)
+        if compress:
+            for blocks in compress_lines(lines):
+                output.write(blocks)
+        else:
+            for line in lines:
+                output.write(line)
+        for vcf, _ in inputs:
+            vcf.close()
+
+    if compress:
+        output.write(BGZF_EOF)
+
+    if output_file:
+        output.close()
+
+    if compress:
+        index_output(output_file)
+
+
+def merge_files(inputs, headers):
+    """
+    Generate merged VCF lines from the records in {inputs}, a list of
+    iterables with per VCF file the lines of its records.
+    """
+    order = chromosome_order(headers)
+    numbers = format_numbers(headers)
+    sample_counts = [len(header['samples']) for header in headers]
+
+    records = heapq.merge(*[sort_records(lines, index, order,
+                                         header['filename'])
+                            for index, (lines, header)
+                            in enumerate(zip(inputs, headers))])
+
+    for group in group_records(records):
+        for line in merge_records(group, sample_counts, numbers):
+            yield line
+
+
+def genome_chunks(vcf_files, headers):
+    """
+    Generate the chunks of the genome to merge in parallel as tuples
+    (chromosome, start, end), where end is None for the end of the
+    chromosome. Positions are zero-based and open-ended.
+
+    The chromosomes are taken from the tabix indexes, and are split in
+    chunks of CHUNK_SIZE bases if their length is in the ##contig lines.
+    """
+    chromosomes = set()
+    for vcf_file in vcf_files:
+        vcf = open_indexed(vcf_file)
+        chromosomes.update(vcf.contigs)
+        vcf.close()
+
+    lengths = {}
+    for header in headers:
+        for line in header['lines']:
+            if line.startswith('##contig=<'):
+                fields = header_fields(line)
+                try:
+                    lengths[fields.get('ID')] = int(fields.get('length'))
+                except (TypeError, ValueError):
+                    pass
+
+    for chromosome in sorted(chromosomes, key=chromosome_order(headers)):
+        if chromosome not in lengths:
+            yield chromosome, 0, None
+            continue
+        for start in range(0, lengths[chromosome], CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            # Records past the contig length still belong to the last chunk.
+            if end >= lengths[chromosome]:
+                end = None
+            yield chromosome, start, end
+
+
+def merge_chunk(vcf_files, headers, chunk):
+    """
+    Merge the records starting in one chunk of the genome in a worker
+    process. Return the merged lines compressed as BGZF blocks.
+    """
+    try:
+        chromosome, start, end = chunk
+        inputs = []
+        for vcf_file in vcf_files:
+            vcf = open_indexed(vcf_file)
+            if chromosome in vcf.contigs:
+                inputs.append(fetch_chunk(vcf, chromosome, start, end))
+            else:
+                inputs.append([])
+        return ''.join(compress_lines(merge_files(inputs, headers)))
+    except SystemExit:
+        # The error is already reported, but the pool would not notice the
+        # worker exiting.
+        raise RuntimeError('Could not merge chunk in worker.')
+
+
+def fetch_chunk(vcf, chromosome, start, end):
+    """
+    Generate the lines of the records starting in a chunk from an indexed
+    VCF file. Records overlapping the chunk from before its start are left
+    to the previous chunk.
+    """
+    for line in vcf.fetch(chromosome, start, end):
+        if int(line.split('\t', 2)[1]) > start:
+            yield line
+    vcf.close()
+
+
+def open_indexed(vcf_file):
+    """
+    Open a VCF file compressed with bgzip and indexed with tabix.
+    """
+    try:
+        import pysam
+    except ImportError:
+        print 'Merging in parallel requires the pysam Python module.'
+        sys.exit(1)
+
+    try:
+        return pysam.Tabixfile(vcf_file)
+    except IOError:
+        print 'Could not read indexed VCF file: %s' % vcf_file
+        sys.exit(1)
+
+
+def index_output(output_file):
+    """
+    Index the compressed output file with tabix, if pysam is available.
+    """
+    try:
+        import pysam
+    except ImportError:
+        print 'Not indexing output file (requires the pysam Python module).'
+        return
+
+    pysam.tabix_index(output_file, preset='vcf', force=True)
+
+
+def compress_lines(lines):
+    """
+    Compress {lines} to BGZF blocks, generating a string of blocks per
+    BUFFER_SIZE bytes of lines.
+    """
+    buffered = []
+    size = 0
+    for line in lines:
+        buffered.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield bgzf_compress(''.join(buffered))
+            buffered = []
+            size = 0
+    if buffered:
+        yield bgzf_compress(''.join(buffered))
+
+
+def bgzf_compress(data):
+    """
+    Compress {data} to a string of BGZF blocks (without end-of-file block).
+    BGZF blocks are gzip members with their size in an extra field, so
+    strings of them can be concatenated into one BGZF file.
+    """
+    blocks = []
+    for offset in range(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[offset:offset + BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(block) + compressor.flush()
+        blocks.append(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255,
+                                  6, 66, 67, 2, len(compressed) + 25))
+        blocks.append(compressed)
+        blocks.append(struct.pack('<2I', zlib.crc32(block) & 0xffffffff,
+                                  len(block)))
+    return ''.join(blocks)
+
+
+def read_header(vcf, vcf_file):
+    """
+    Read the header lines of an open VCF file, leaving it at the first
+    record. Return a dictionary with the filename ('filename'), the header
+    lines ('lines'), and the sample names ('samples').
+    """
+    lines = []
+    for line in vcf:
+        if line.startswith('##'):
+            lines.append(line)
+            continue
+        if line.startswith('#CHROM'):
+            return {'filename': vcf_file,
+                    'lines': lines,
+                    'samples': line.rstrip('\r\n').split('\t')[9:]}
+        break
+    print 'No #CHROM header line in VCF file: %s' % vcf_file
+    sys.exit(1)
+
+
+def header_fields(line):
+    """
+    Return the fields of a structured header line such as ##FORMAT=<...> as
+    a dictionary.
+    """
+    return dict((key, value.strip('"'))
+                for key, value in HEADER_FIELDS.findall(line[line.find('<'):]))
+
+
+def chromosome_order(headers):
+    """
+    Return a function giving the sort key for a chromosome name. The order
+    of the ##contig header lines is used, with chromosomes not in those
+    lines sorted after them by number or name.
+    """
+    contigs = {}
+    for header in headers:
+        for line in header['lines']:
+            if line.startswith('##contig=<'):
+                contigs.setdefault(header_fields(line).get('ID'), len(contigs))
+
+    def key(chromosome):
+        if chromosome in contigs:
+            return 0, contigs[chromosome], ''
+        name = chromosome[3:] if chromosome.startswith('chr') else chromosome
+        if name.isdigit():
+            return 1, int(name), ''
+        return 2, 0, name
+
+    return key
+
+
+def format_numbers(headers):
+    """
+    Return a dictionary with the Number of each FORMAT field.
+    """
+    numbers = dict(DEFAULT_NUMBERS)
+    for header in headers:
+        for line in header['lines']:
+            if line.startswith('##FORMAT=<'):
+                fields = header_fields(line)
+                numbers[fields.get('ID')] = fields.get('Number')
+    return numbers
+
+
+def merged_header(headers, vcf_files):
+    """
+    Return the header lines of the merged VCF file, including the #CHROM
+    line.
+    """
+    lines = ['##fileformat=VCFv4.1\n', '##source=vcf_merge.py\n']
+
+    # Structured lines are taken once per ID, in order of appearance.
+    seen = set()
+    for kind in ('##contig=<', '##FILTER=<', '##FORMAT=<'):
+        if kind == '##FORMAT=<':
+            lines.append(INFO_HEADER)
+        for header in headers:
+            for line in header['lines']:
+                if line.startswith(kind):
+                    key = kind, header_fields(line).get('ID')
+                    if key not in seen:
+                        seen.add(key)
+                        lines.append(line)
+
+    samples = [sample for header in headers for sample in header['samples']]
+    if len(set(samples)) < len(samples):
+        samples = ['%s:%s' % (file_stem(vcf_file), sample)
+                   for header, vcf_file in zip(headers, vcf_files)
+                   for sample in header['samples']]
+
+    lines.append('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL',
+                            'FILTER', 'INFO', 'FORMAT'] + samples) + '\n')
+    return ''.join(lines)
+
+
+def file_stem(vcf_file):
+    """
+    Return the filename of {vcf_file} without directory and extensions.
+    """
+    if vcf_file == '-':
+        return 'stdin'
+    name = os.path.basename(vcf_file)
+    for extension in ('.gz', '.vcf'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name
+
+
+def sort_records(lines, index, order, vcf_file):
+    """
+    Generate the records in {lines} as tuples (key, index, number, fields),
+    where key is a tuple (chromosome order, position) to sort on, number is
+    the record number, and fields are the tab-separated fields of the
+    record.
+    """
+    previous = None
+    for number, line in enumerate(lines):
+        if line.startswith('#') or not line.strip():
+            continue
+        fields = line.rstrip('\r\n').split('\t')
+        try:
+            key = order(fields[0]), int(fields[1])
+        except (IndexError, ValueError):
+            print 'Invalid line in VCF file: "%s"' % line
+            sys.exit(1)
+        if len(fields) < 8:
+            print 'Invalid line in VCF file: "%s"' % line
+            sys.exit(1)
+        if previous and key < previous:
+            print 'VCF file is not sorted by chromosome and position: %s' \
+                  % vcf_file
+            sys.exit(1)
+        previous = key
+        yield key, index, number, fields
+
+
+def group_records(records):
+    """
+    Generate lists of records at the same position, each record as a tuple
+    (index, fields).
+    """
+    group = []
+    position = None
+    for key, index, _, fields in records:
+        if key != position and group:
+            yield group
+            group = []
+        position = key
+        group.append( (index, fields) )
+    if group:
+        yield group
+
+
+def merge_records(group, sample_counts, numbers):
+    """
+    Generate merged VCF lines for the records at one position in {group}.
+
+    Records are put on the first line where their REF agrees and their file
+    has no record yet.
+    """
+    lines = []
+    for index, fields in group:
+        reference = fields[3]
+        for line in lines:
+            if index not in line['records'] and \
+                   (line['reference'].startswith(reference) or
+                    reference.startswith(line['reference'])):
+                break
+        else:
+            line = {'reference': reference, 'records': OrderedDict()}
+            lines.append(line)
+        line['records'][index] = fields
+        if len(reference) > len(line['reference']):
+            line['reference'] = reference
+
+    for line in lines:
+        yield merge_line(line['reference'], line['records'], sample_counts,
+                         numbers)
+
+
+def merge_line(reference, records, sample_counts, numbers):
+    """
+    Return one merged VCF line for the records (a dictionary of fields by
+    file index) with REF alleles that agree with {reference}.
+    """
+    alternates = []
+    mappings = {}
+    ids = []
+    qualities = []
+    filters = []
+    keys = []
+
+    for index, fields in records.items():
+        # Extend the alleles with the reference bases after their REF.
+        suffix = reference[len(fields[3]):]
+        mapping = [0]
+        for alternate in fields[4].split(','):
+            if alternate == '.':
+                continue
+            if not alternate.startswith(('<', '*')):
+                alternate += suffix
+            if alternate == reference:
+                mapping.append(0)
+                continue
+            if alternate not in alternates:
+                alternates.append(alternate)
+            mapping.append(alternates.index(alternate) + 1)
+        mappings[index] = mapping
+
+        for identifier in fields[2].split(';'):
+            if identifier != '.' and identifier not in ids:
+                ids.append(identifier)
+        try:
+            qualities.append( (float(fields[5]), fields[5]) )
+        except ValueError:
+            pass
+        for name in fields[6].split(';'):
+            if name not in filters:
+                filters.append(name)
+        if len(fields) > 8:
+            for key in fields[8].split(':'):
+                if key not in keys:
+                    keys.append(key)
+
+    if 'GT' in keys:
+        keys.remove('GT')
+    keys.insert(0, 'GT')
+
+    allele_count = len(alternates) + 1
+    counts = [0] * allele_count
+
+    samples = []
+    for index, sample_count in enumerate(sample_counts):
+        if index not in records:
+            samples.extend([':'.join([MISSING_GENOTYPE] +
+                                     ['.'] * (len(keys) - 1))] * sample_count)
+            continue
+        fields = records[index]
+        record_keys = fields[8].split(':') if len(fields) > 8 else []
+        for sample in fields[9:9 + sample_count]:
+            values = dict(zip(record_keys, sample.split(':')))
+            genotype = remap_genotype(values.get('GT', MISSING_GENOTYPE),
+                                      mappings[index])
+            for allele in re.split('[/|]', genotype):
+                if allele != '.':
+                    counts[int(allele)] += 1
+            samples.append(':'.join(
+                [genotype] +
+                [remap_values(values.get(key, '.'), numbers.get(key),
+                              mappings[index], allele_count)
+                 for key in keys[1:]]))
+        # Samples missing on the record line itself.
+        for _ in range(sample_count - len(fields[9:9 + sample_count])):
+            samples.append(':'.join([MISSING_GENOTYPE] +
+                                    ['.'] * (len(keys) - 1)))
+
+    if 'PASS' in filters and len(filters) > 1:
+        filters.remove('PASS')
+    if '.' in filters and len(filters) > 1:
+        filters.remove('.')
+
+    info = 'AN=%d' % sum(counts)
+    if alternates:
+        info = 'AC=%s;%s' % (','.join(map(str, counts[1:])), info)
+
+    fields = records.values()[0]
+    return '\t'.join([fields[0], fields[1], ';'.join(ids) or '.', reference,
+                      ','.join(alternates) or '.',
+                      max(qualities)[1] if qualities else '.',
+                      ';'.join(filters), info, ':'.join(keys)] +
+                     samples) + '\n'
+
+
+def remap_genotype(genotype, mapping):
+    """
+    Return the GT value {genotype} with allele indices replaced according to
+    {mapping}.
+    """
+    parts = re.split('([/|])', genotype)
+    try:
+        for i in range(0, len(parts), 2):
+            if parts[i] != '.':
+                parts[i] = str(mapping[int(parts[i])])
+    except (IndexError, ValueError):
+        return MISSING_GENOTYPE
+    return ''.join(parts)
+
+
+def remap_values(value, number, mapping, allele_count):
+    """
+    Return the comma-separated FORMAT {value} with per-allele (Number=R or
+    Number=A) or per-genotype (Number=G, diploid) values moved according to
+    the allele {mapping}. Values for alleles not in the record are missing.
+    """
+    if value == '.' or number not in ('R', 'A', 'G'):
+        return value
+    if mapping == range(allele_count):
+        return value
+
+    values = value.split(',')
+
+    if number == 'R':
+        remapped = ['.'] * allele_count
+        pairs = zip(mapping, values)
+    elif number == 'A':
+        remapped = ['.'] * (allele_count - 1)
+        pairs = [(m - 1, v) for m, v in zip(mapping[1:], values)]
+    else:
+        if len(values) != len(mapping) * (len(mapping) + 1) // 2:
+            return '.'
+        remapped = ['.'] * (allele_count * (allele_count + 1) // 2)
+        pairs = []
+        for b in range(len(mapping)):
+            for a in range(b + 1):
+                low, high = sorted( (mapping[a], mapping[b]) )
+                pairs.append( (high * (high + 1) // 2 + low,
+                               values[b * (b + 1) // 2 + a]) )
+
+    for position, v in pairs:
+        if position >= 0:
+            remapped[position] = v
+    return ','.join(remapped)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""
+Merge VCF files sorted by position into one multi-sample VCF file.""")
+    parser.add_argument('vcf_files', metavar='VCF_FILE', nargs='+',
+                        help='file in VCF format sorted by position '
+                        '(can be gzipped or bgzipped, - for standard input)')
+    parser.add_argument('-o', dest='output_file', metavar='OUTPUT_FILE',
+                        help='file to write the merged VCF to, compressed '
+                        'with bgzip if ending in .gz (default: standard '
+                        'output)')
+    parser.add_argument('-j', dest='processes', default=1, type=int,
+                        help='number of worker processes merging chunks of '
+                        'indexed VCF files (default: 1)')
+    args = parser.parse_args()
+    if args.vcf_files.count('-') > 1:
+        parser.error('standard input can be read only once')
+    if '-' in args.vcf_files and args.processes > 1:
+        parser.error('standard input cannot be read by worker processes')
+    if args.processes > 1 and not (args.output_file and
+                                   args.output_file.endswith('.gz')):
+        parser.error('merging in parallel requires an output file ending '
+                     'in .gz')
+    if args.output_file == '-':
+        args.output_file = None
+    handle_broken_pipe()
+    main(args.vcf_files, args.output_file, args.processes)